@@ -1,47 +1,353 @@
-from datetime import timedelta
-from typing import Optional
+import asyncio
+import functools
+from datetime import datetime, timedelta
+from typing import AsyncIterator, Optional
 
-from fastapi import Depends, FastAPI, Form, HTTPException, status
+from fastapi import Depends, FastAPI, Form, HTTPException, Request, status
+from fastapi.concurrency import run_in_threadpool
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import OAuth2PasswordRequestForm
-from passlib.context import CryptContext
 import uvicorn
 
+import async_db
+import availability
 import db
-from db import Device
-from pipeline import FunctionNotFoundError, FunctionParamUnmatchError, Pipeline
+from db import HEARTBEAT_LOG_INTERVAL_MINUTES, gmt2jst, heartbeat_log_bucket
+import device_auth
+from events import KEEPALIVE_SECONDS, broadcaster
+from fleet_stats import SAME_REPORT_MARKER, UnknownReportError, fleet_stats
+import heartbeat_batch
+from heartbeat_log_writer import heartbeat_log_writer
+from heartbeat_table import heartbeat_table
+import history
+import maintenance
+from mhpl_functions import EvalContext, fleet_cache, invalidate_fleet, resync_fleet_stats
+import notify_bus
+import nvidia_smi
+from report_history import report_at, report_history
+from pipeline import FunctionNotFoundError, FunctionParamUnmatchError, Pipeline, program_cache
+from signals import is_stale_cursor, signals_body
+from snapshot import JSONSnapshot
 import user_authorization as user_auth
 
 
-hashed_api_password = b'$2b$12$3jMfq3IMzFOzJ.LqXiaelOBKbU4A7n.LyBKNAR39lTyKF44WcPscK'
-pw_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+async def load_state() -> None:
+    device_auth.token_index.load(await async_db.select_device_tokens())
+    fleet_stats.load(heartbeat_table.read_through(await async_db.select_devices()))
+
+
+def resync_state() -> None:
+    """
+    Drop everything derived from the database, after notifications may have been missed.
+
+    """
+    signals_snapshot.invalidate()
+    signals_summary_snapshot.invalidate()
+    invalidate_fleet()
+    user_auth.user_cache.clear()
+    asyncio.get_event_loop().create_task(load_state())
+
+
+def apply_remote_event(event: str, data: dict) -> None:
+    """
+    Apply a change notified by another worker.
+
+    """
+    if data.pop('report_truncated', False):  # too long for NOTIFY; read it from the DB
+        asyncio.get_event_loop().create_task(apply_remote_heartbeat(event, data))
+    elif event == 'device_token':
+        device_auth.token_index.remove(data['device_id'])  # the new token is looked up on first use
+    elif event == 'user':
+        user_auth.invalidate_user(data['user_name'])
+    else:
+        apply_device_event(event, data)
+
+
+async def apply_remote_heartbeat(event: str, data: dict) -> None:
+    data['report'] = await async_db.select_report(data['device_name'])
+    apply_device_event(event, data)
+
+
+listener = notify_bus.Listener(apply_remote_event, resync_state)
+heartbeat_notifier = notify_bus.Coalescer('heartbeat', 'device_name')
+
+
+@app.on_event('startup')
+async def open_db_pool() -> None:
+    await async_db.pool.open()
+    await load_state()
+    await listener.start()
+    heartbeat_notifier.start()
+    heartbeat_log_writer.start()
+    heartbeat_table.start()
+    maintenance.scheduler.start()
+
+
+@app.on_event('shutdown')
+async def close_db_pool() -> None:
+    await heartbeat_notifier.close()
+    await listener.close()
+    await maintenance.scheduler.close()
+    await heartbeat_log_writer.close()
+    await heartbeat_table.close()
+    await async_db.pool.close()
+    db.pool.close()
+
+
 @app.get('/')
 async def root() -> FileResponse:
     return FileResponse('static/index.html')
 
 
+async def build_signals(summary: bool = False) -> dict:
+    # Read the cursor first: a change racing with the query is sent again, never lost
+    version = await async_db.select_devices_revision()
+    devices = heartbeat_table.read_through(await async_db.select_devices())
+    return signals_body(version, devices, await async_db.select_heartbeat_log_summation(), summary)
+
+
+signals_snapshot = JSONSnapshot(build_signals)
+signals_summary_snapshot = JSONSnapshot(functools.partial(build_signals, summary=True))
+
+
+def apply_device_event(event: str, data: dict) -> None:
+    """
+    Bring the in-memory state of this worker up to date with a device change,
+    and push it to live viewers.
+
+    """
+    device_name = data['device_name']
+    if event == 'heartbeat':
+        at = datetime.fromisoformat(data['last_heartbeat_timestamp'])
+        heartbeat_table.observe(device_name, at.astimezone().replace(tzinfo=None))
+        fleet_stats.heartbeat(device_name, data.get('report', fleet_stats.report(device_name)))
+    elif event == 'is_active':
+        fleet_stats.set_active(device_name, data['is_active'])
+    elif event == 'registered':
+        fleet_stats.register(device_name)
+    signals_snapshot.invalidate()
+    signals_summary_snapshot.invalidate()
+    if event in ('is_active', 'registered'):  # mere heartbeats are left to the snapshot TTL
+        invalidate_fleet()
+    broadcaster.publish(event, data)
+
+
+def is_time_only(event: str, data: dict) -> bool:
+    """
+    :return: whether the event is a heartbeat that changes nothing but the time
+    """
+    return event == 'heartbeat' and 'report' not in data
+
+
+async def devices_changed(event: str, data: dict) -> None:
+    """
+    Apply a device change here and notify the other workers;
+    heartbeats that change nothing but the time are notified in batches.
+
+    """
+    await devices_changed_many(event, [data])
+
+
+async def devices_changed_many(event: str, datas: list[dict]) -> None:
+    """
+    devices_changed() of many devices.
+
+    """
+    changes = []
+    for data in datas:
+        apply_device_event(event, data)
+        if is_time_only(event, data):
+            heartbeat_notifier.add(data)
+        else:
+            if event == 'heartbeat':  # sent now with its report, and the newer time
+                heartbeat_notifier.discard(data['device_name'])
+            changes.append(data)
+    if len(changes) == 1:
+        await notify_bus.notify(event, changes[0])
+    elif changes:
+        await notify_bus.notify_many(event, changes)
+
+
 @app.get('/json/signals')
-def json_last_signal_ts() -> JSONResponse:
-    devices: list[Device] = db.select_devices()
-    devices = [device.dict() for device in devices]
-    for device in devices:
-        device['last_heartbeat_timestamp'] = str(device['last_heartbeat_timestamp'])
-    
-    retval = {
-        'devices': devices,
-        'heartbeat_log': db.select_heartbeat_log_summation(),
-    }
-    return JSONResponse(jsonable_encoder(retval))
+async def json_last_signal_ts(request: Request, since: Optional[int] = None, summary: bool = False) -> Response:
+    """
+    :param since: `version` of a previous response; only devices changed since it are returned
+                  (some of them again), with the last two heartbeat_log buckets.
+                  A cursor this database did not hand out gets a full response.
+    :param summary: leave out report bodies
+    """
+    version = None
+    if since is not None:
+        version = await async_db.select_devices_revision()  # before the rows, as in build_signals
+    if since is None or is_stale_cursor(since, version):
+        snapshot = signals_summary_snapshot if summary else signals_snapshot
+        return await snapshot.response(
+            request.headers.get('if-none-match'),
+            request.headers.get('if-modified-since'),
+        )
+
+    changed = await async_db.select_devices_since(since)
+    devices = heartbeat_table.read_through([device for _, device in changed])
+    log_start = heartbeat_log_bucket() - timedelta(minutes=HEARTBEAT_LOG_INTERVAL_MINUTES)
+    retval = signals_body(version, devices, await async_db.select_heartbeat_log_since(log_start), summary, delta=True)
+    return JSONResponse(jsonable_encoder(retval), headers={'Cache-Control': 'no-cache'})
+
+
+@app.get('/events/signals')
+async def events_signals() -> StreamingResponse:
+    """
+    Server-Sent Events: the full snapshot first, then one event per device change.
+
+    """
+    async def stream() -> AsyncIterator[bytes]:
+        with broadcaster.subscribe() as queue:
+            # Subscribed before reading the snapshot, so no change falls in between
+            await signals_snapshot.refresh()
+            yield b'retry: 5000\nevent: snapshot\ndata: ' + signals_snapshot.body + b'\n\n'
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield b': keepalive\n\n'
+                    continue
+                if message is None:  # too slow; the browser will reconnect
+                    return
+                yield message
+
+    return StreamingResponse(stream(), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
+@app.get('/json/history')
+async def json_history(start: Optional[datetime] = None, end: Optional[datetime] = None,
+                       resolution: str = str(HEARTBEAT_LOG_INTERVAL_MINUTES)) -> JSONResponse:
+    """
+    Online device counts as parallel arrays, e.g. ?start=2021-06-01T00:00:00&resolution=6h
+
+    :param start: defaults to 24 hours before `end`
+    :param end: defaults to now
+    :param resolution: minutes per point, or with a unit: 15m, 6h, 1d
+    """
+    try:
+        minutes = history.parse_resolution(resolution)
+        first, last, source = history.plan(start, end, minutes)
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+
+    key = (first, last, minutes, source)
+    retval = history.history_cache.get(key)
+    if retval is None:
+        rows = await async_db.select_heartbeat_history(first, last, minutes, source)
+        retval = jsonable_encoder({
+            'start': first,
+            'end': last + timedelta(minutes=minutes),
+            'resolution': minutes,
+            'source': source,
+            **history.to_columns(rows, minutes),
+        })
+        history.history_cache.put(key, retval)
+    return JSONResponse(retval)
+
+
+@app.get('/json/availability')
+async def json_availability(device_name: Optional[str] = None) -> JSONResponse:
+    """
+    Uptime ratio and longest outage of each device over the last 24h, 7d and 30d,
+    and how long ago it was last seen.
+
+    :param device_name: only this device
+    """
+    devices = await availability.load()
+    if device_name is not None:
+        if device_name not in devices:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No such device.")
+        devices = {device_name: devices[device_name]}
+    return JSONResponse(jsonable_encoder({
+        'windows': list(availability.WINDOWS),
+        'devices': list(devices.values()),
+    }))
+
+
+@app.get('/json/gpus')
+async def json_gpus(min_free_mib: Optional[int] = None, max_utilization: Optional[int] = None,
+                    device_name: Optional[str] = None, processes: bool = False) -> JSONResponse:
+    """
+    GPUs parsed from nvidia-smi reports, e.g. ?min_free_mib=10240 for GPUs with 10 GiB free
+
+    :param max_utilization: percent
+    :param processes: include the processes running on each GPU
+    """
+    gpus = await async_db.select_gpus(min_free_mib, max_utilization, device_name, with_processes=processes)
+    return JSONResponse(jsonable_encoder({'gpus': gpus}))
+
+
+@app.get('/json/report_history')
+async def json_report_history(device_name: str, at: Optional[datetime] = None,
+                              start: Optional[datetime] = None, end: Optional[datetime] = None) -> JSONResponse:
+    """
+    :param at: return the report the device had at that time
+    :param start, end: otherwise list the stored reports in this range (defaults to the last 24 hours)
+    """
+    if at is not None:
+        found = await report_at(device_name, history.to_local(at))
+        if found is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No report recorded by then.")
+        return JSONResponse(jsonable_encoder({
+            'device_name': device_name,
+            'recorded_at': found[0],
+            'report': found[1],
+        }))
+
+    end = datetime.now() if end is None else history.to_local(end)
+    start = end - history.DEFAULT_RANGE if start is None else history.to_local(start)
+    rows = await async_db.select_report_history(device_name, start, end)
+    return JSONResponse(jsonable_encoder({
+        'device_name': device_name,
+        'entries': [{'recorded_at': recorded_at, 'keyframe': keyframe, 'size': size}
+                    for recorded_at, keyframe, size in rows],
+    }))
+
+
+@app.get('/json/summary')
+async def json_summary() -> JSONResponse:
+    await resync_fleet_stats()  # also on workers that never evaluate a program
+    return JSONResponse(fleet_stats.summary())
+
+
+@app.get('/json/stats')
+async def json_stats() -> JSONResponse:
+    return JSONResponse({
+        'db_pool': db.pool_stats(),
+        'async_db_pool': async_db.pool_stats(),
+        'device_auth': device_auth.stats(),
+        'user_cache': user_auth.user_cache.stats(),
+        'mhpl_program_cache': program_cache.stats(),
+        'mhpl_fleet_cache': fleet_cache.stats(),
+        'fleet_stats': fleet_stats.stats(),
+        'history_cache': history.history_cache.stats(),
+        'availability_cache': availability.availability_cache.stats(),
+        'nvidia_smi_parser': nvidia_smi.cache_stats(),
+        'report_history': report_history.stats(),
+        'signals_snapshot': signals_snapshot.stats(),
+        'signals_summary_snapshot': signals_summary_snapshot.stats(),
+        'events': broadcaster.stats(),
+        'notify_bus': listener.stats(),
+        'heartbeat_notifier': heartbeat_notifier.stats(),
+        'heartbeat_log_writer': heartbeat_log_writer.stats(),
+        'heartbeat_table': heartbeat_table.stats(),
+        'maintenance': maintenance.scheduler.stats(),
+    })
 
 
 @app.post('/devices/active')
-def update_is_active(
+async def update_is_active(
     user: user_auth.UserInDB = Depends(user_auth.get_current_user),
     device_name: str = Form(...),
     is_active: str = Form(...),
@@ -54,64 +360,244 @@ def update_is_active(
         )
     
     active = False if is_active.lower() == 'false' else True
-    db.update_is_active(device_name, active)
+    await async_db.update_is_active(device_name, active)
+    await devices_changed('is_active', {'device_name': device_name, 'is_active': active})
     return PlainTextResponse('successfully registered\n', status_code=200)
 
 
-@app.post('/api/heartbeat')
-def api_heartbeat(
-    password: str = Form(...),
-    name: str = Form(...),
-    nvidia_smi: Optional[str] = Form(None)
-) -> PlainTextResponse:
-    if not pw_context.verify(password, hashed_api_password):  # check credential
+def client_address(request: Request) -> str:
+    # X-Forwarded-For counts only when sent by one of our proxies
+    return device_auth.client_address(
+        request.client.host if request.client else '', request.headers.get('x-forwarded-for'))
+
+
+def rate_limited_response() -> PlainTextResponse:
+    return PlainTextResponse(
+        content='too many failed attempts\n',
+        status_code=429,
+        headers={'Retry-After': str(int(device_auth.FAILURE_WINDOW_SECONDS))},
+    )
+
+
+async def check_device_password(password: str, request: Request) -> Optional[PlainTextResponse]:
+    """
+    :return: error response if the credential is rejected
+    """
+    client = client_address(request)
+    try:
+        if device_auth.is_verified(password, client):
+            return None
+    except device_auth.RateLimitedError:
+        return rate_limited_response()
+    if not await run_in_threadpool(device_auth.verify_api_password, password, client):
         return PlainTextResponse(content='invalid password\n', status_code=403)
+    return None
+
+
+REPORT_REQUIRED = 'report required: the previous report is not known'  # to SAME_REPORT_MARKER of an unknown device
+
+gpu_reports: dict[int, Optional[nvidia_smi.NvidiaSmiReport]] = {}  # last written by this worker, by device_id
+
+
+async def ingest_report(device_id: int, report: Optional[str]) -> None:
+    """
+    Store the GPUs of an nvidia-smi report in gpu_metrics / gpu_processes,
+    unless they are the same as last time (reports differ by their clock alone).
+
+    """
+    parsed = nvidia_smi.parse(report)
+    if device_id in gpu_reports and gpu_reports[device_id] == parsed:
+        return
+    await async_db.replace_gpu_metrics(device_id, parsed)
+    gpu_reports[device_id] = parsed
+
+
+async def touch_heartbeat(device_name: str, device_id: Optional[int], report: Optional[str],
+                          report_hash: Optional[bytes]) -> tuple[int, str, Optional[bytes]]:
+    if device_id is not None:
+        return await async_db.touch_heartbeat_by_id(device_id, report, report_hash, resolution=None)
+    return await async_db.touch_heartbeat(device_name, report, report_hash, resolution=None)
+
+
+async def record_heartbeat(device_id: int, device_name: str, report: Optional[str]) -> dict:
+    """
+    Record a heartbeat whose devices row is up to date everywhere else.
+
+    :return: the heartbeat event, to pass to devices_changed
+    """
+    at = heartbeat_table.touch(device_id, device_name)
+    heartbeat_log_writer.add(device_id)
+    await report_history.record(device_id, report, at)
+    event = {
+        'device_name': device_name,
+        'last_heartbeat_timestamp': str(gmt2jst(at)),
+    }
+    if report != fleet_stats.report(device_name):
+        event['report'] = report
+        await ingest_report(device_id, report)
+    return event
 
+
+def run_program(return_message: str, context: Optional[EvalContext]) -> str:
+    """
+    :param context: loaded EvalContext if the program uses one
+    """
+    program = Pipeline.compile(return_message)
     try:
-        db.post_heartbeat(name, nvidia_smi)
-        db.insert_heartbeat_log(name)
+        return program.run(context) if program.uses_context else program.run()
+    except (FunctionNotFoundError, FunctionParamUnmatchError):
+        return return_message
+
+
+async def load_context(return_messages: list[str]) -> Optional[EvalContext]:
+    """
+    Load the fleet snapshot here, so evaluation itself never blocks on the DB.
+
+    :return: EvalContext shared by the programs, if any of them needs one
+    """
+    programs = [Pipeline.compile(return_message) for return_message in return_messages]
+    if not any(program.uses_context for program in programs):
+        return None
+    return await EvalContext.load(with_availability=any(program.uses_availability for program in programs))
+
+
+async def process_heartbeat(device_name: str, report: Optional[str], device_id: Optional[int] = None) -> PlainTextResponse:
+    """
+    :param report: report, or SAME_REPORT_MARKER when it is the same as the previous one
+    """
+    try:
+        report, body, digest = fleet_stats.resolve_report(device_name, report)
+    except UnknownReportError:
+        return PlainTextResponse(content=REPORT_REQUIRED + '\n', status_code=409)
+    try:
+        device_id, return_message, stored_hash = await touch_heartbeat(device_name, device_id, body, digest)
+        if body is None and digest is not None and stored_hash != digest:  # changed by another worker meanwhile
+            device_id, return_message, stored_hash = await touch_heartbeat(device_name, device_id, report, digest)
     except ValueError:
         return PlainTextResponse(content='invalid name\n', status_code=400)
-    
-    return_message = db.select_return_message(name)
-    try:
-        content = Pipeline.feed(return_message)
-    except (FunctionNotFoundError, FunctionParamUnmatchError):
-        content = return_message
+    await devices_changed('heartbeat', await record_heartbeat(device_id, device_name, report))
 
     return PlainTextResponse(
-        content=content,
+        content=run_program(return_message, await load_context([return_message])),
         status_code=200
     )
 
-@app.post('/api/v2/heartbeat')
-def api_heartbeat(
+
+async def process_heartbeats(entries: list[tuple[str, Optional[str]]]) -> list[dict]:
+    """
+    process_heartbeat() of many devices, with set-based writes and a single EvalContext.
+    The last heartbeat of a device repeated in `entries` wins.
+
+    :return: {device_name, status, content} of each entry
+    """
+    resolved = {}
+    for device_name, report in entries:
+        if report == SAME_REPORT_MARKER and device_name in resolved:  # sent earlier in this batch
+            continue
+        try:
+            resolved[device_name] = fleet_stats.resolve_report(device_name, report)
+        except UnknownReportError:
+            resolved.pop(device_name, None)
+    rows = await async_db.touch_heartbeats([
+        (device_name, body, digest) for device_name, (_, body, digest) in resolved.items()
+    ])
+    stale = [  # changed by another worker meanwhile
+        (device_name, report, digest) for device_name, (report, body, digest) in resolved.items()
+        if device_name in rows and body is None and digest is not None and rows[device_name][2] != digest
+    ]
+    if stale:
+        rows.update(await async_db.touch_heartbeats(stale))
+
+    events = [
+        await record_heartbeat(device_id, device_name, resolved[device_name][0])
+        for device_name, (device_id, _, _) in rows.items()
+    ]
+    await devices_changed_many('heartbeat', events)
+
+    context = await load_context([return_message for _, return_message, _ in rows.values()])
+    contents = {
+        device_name: run_program(return_message, context)
+        for device_name, (_, return_message, _) in rows.items()
+    }
+    return [
+        {'device_name': device_name, 'status': 200, 'content': contents[device_name]}
+        if device_name in contents else
+        {'device_name': device_name, 'status': 409, 'content': REPORT_REQUIRED}
+        if device_name not in resolved else
+        {'device_name': device_name, 'status': 400, 'content': 'invalid name'}
+        for device_name, _ in entries
+    ]
+
+
+@app.post('/api/heartbeat')
+async def api_heartbeat(
+    request: Request,
     password: str = Form(...),
-    device_name: str = Form(...),
-    report: Optional[str] = Form(None)
+    name: str = Form(...),
+    nvidia_smi: Optional[str] = Form(None)
 ) -> PlainTextResponse:
-    if not pw_context.verify(password, hashed_api_password):  # check credential
-        return PlainTextResponse(content='invalid password\n', status_code=403)
+    error = await check_device_password(password, request)  # check credential
+    if error is not None:
+        return error
 
+    return await process_heartbeat(name, nvidia_smi)
+
+@app.post('/api/v2/heartbeat')
+async def api_heartbeat(
+    request: Request,
+    password: Optional[str] = Form(None),
+    device_name: Optional[str] = Form(None),
+    report: Optional[str] = Form(None),
+    token: Optional[str] = Form(None),
+) -> PlainTextResponse:
+    if token is not None:  # per-device token identifies the device by itself
+        try:
+            device = await device_auth.find_device_by_token(token, client_address(request))
+        except device_auth.RateLimitedError:
+            return rate_limited_response()
+        if device is None:
+            return PlainTextResponse(content='invalid token\n', status_code=403)
+        device_id, device_name = device
+        return await process_heartbeat(device_name, report, device_id=device_id)
+
+    if password is None or device_name is None:
+        return PlainTextResponse(content='token, or password and device_name are required\n', status_code=400)
+
+    error = await check_device_password(password, request)  # check credential
+    if error is not None:
+        return error
+
+    return await process_heartbeat(device_name, report)
+
+
+@app.post('/api/v2/heartbeats')
+async def api_heartbeats(request: Request) -> Response:
+    """
+    Heartbeats of many devices relayed by a gateway (see heartbeat_batch),
+    authenticated once by the X-Device-Password header.
+
+    """
+    password = request.headers.get('x-device-password')
+    if password is None:
+        return PlainTextResponse(content='X-Device-Password header is required\n', status_code=400)
+    error = await check_device_password(password, request)  # check credential
+    if error is not None:
+        return error
+
+    ndjson = request.headers.get('content-type', '').startswith(heartbeat_batch.NDJSON)
     try:
-        db.post_heartbeat(device_name, report)
-        db.insert_heartbeat_log(device_name)
-    except ValueError:
-        return PlainTextResponse(content='invalid name\n', status_code=400)
-    
-    return_message = db.select_return_message(device_name)
-    try:
-        content = Pipeline.feed(return_message)
-    except (FunctionNotFoundError, FunctionParamUnmatchError):
-        content = return_message
+        entries = heartbeat_batch.parse(await request.body(), ndjson)
+    except ValueError as e:
+        return PlainTextResponse(content='%s\n' % e, status_code=400)
 
-    return PlainTextResponse(
-        content=content,
-        status_code=200
+    return Response(
+        content=heartbeat_batch.encode(await process_heartbeats(entries), ndjson),
+        media_type=heartbeat_batch.NDJSON if ndjson else 'application/json',
     )
 
+
 @app.post('/api/return_message')
-def api_register_return_message(
+async def api_register_return_message(
     user: user_auth.UserInDB = Depends(user_auth.get_current_user),
     name: str = Form(...),
     return_message: str = Form(...)
@@ -127,15 +613,17 @@ def api_register_return_message(
     if return_message == '#empty':
         return_message = ''
 
-    db.update_return_message(name, return_message)
+    await async_db.update_return_message(name, return_message)
+    await devices_changed('return_message', {'device_name': name, 'return_message': return_message})
+    Pipeline.precompile(return_message)
     return PlainTextResponse('successfully registered\n', status_code=200)
 
 
 @app.post('/api/v2/register/device')
-def api_register_device(
+async def api_register_device(
     user: user_auth.UserInDB = Depends(user_auth.get_current_user),
     device_name: str = Form(...),
-) -> PlainTextResponse|HTTPException:
+) -> JSONResponse|HTTPException:
     if not user:  # User authorization
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -149,21 +637,86 @@ def api_register_device(
             detail="Device name must be more than 3 characters.",
         )
 
+    token, digest = device_auth.issue_token()
     try:
-        db.register_device(device_name, None, None)
+        device_id = await async_db.register_device(device_name, None, None, api_token_hash=digest)
     except ValueError:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="This device is already registered.",
         )
-    return PlainTextResponse('successfully registered\n', status_code=200)
+    device_auth.token_index.add(digest, device_id, device_name)
+    await devices_changed('registered', {
+        'device_name': device_name,
+        'last_heartbeat_timestamp': None,
+        'report': '',
+        'return_message': '',
+        'is_active': True,
+    })
+    return JSONResponse({
+        'device_name': device_name,
+        'token': token,
+    })
+
+
+@app.post('/api/v2/register/device_token')
+async def api_register_device_token(
+    user: user_auth.UserInDB = Depends(user_auth.get_current_user),
+    device_name: str = Form(...),
+) -> JSONResponse|HTTPException:
+    if not user:  # User authorization
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Incorrect username or password",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    token, digest = device_auth.issue_token()  # replaces the previous token
+    try:
+        device_id = await async_db.update_device_token(device_name, digest)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="This device is not registered.",
+        )
+    device_auth.token_index.add(digest, device_id, device_name)
+    await notify_bus.notify('device_token', {'device_id': device_id})
+    return JSONResponse({
+        'device_name': device_name,
+        'token': token,
+    })
+
+
+@app.post('/api/v2/revoke/device_token')
+async def api_revoke_device_token(
+    user: user_auth.UserInDB = Depends(user_auth.get_current_user),
+    device_name: str = Form(...),
+) -> PlainTextResponse|HTTPException:
+    if not user:  # User authorization
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Incorrect username or password",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+
+    try:
+        device_id = await async_db.update_device_token(device_name, None)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="This device is not registered.",
+        )
+    device_auth.token_index.remove(device_id)
+    await notify_bus.notify('device_token', {'device_id': device_id})
+    return PlainTextResponse('successfully revoked\n', status_code=200)
 
 
 @app.post('/api/token')
-def login_for_access_token(
+async def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends()
 ) -> JSONResponse|HTTPException:
-    user: user_auth.UserInDB|bool = user_auth.authenticate_user(form_data.username, form_data.password)
+    user: user_auth.UserInDB|bool = await run_in_threadpool(
+        user_auth.authenticate_user, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
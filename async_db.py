@@ -0,0 +1,1135 @@
+"""
+asyncio counterpart of db.py for the FastAPI endpoints.
+
+Functions mirror db.py one by one (same names, arguments and return values)
+but are coroutines running on an asyncpg pool, so a request waiting for
+PostgreSQL does not hold a threadpool worker.
+The pool has to be opened on application startup and closed on shutdown.
+
+"""
+import asyncio
+import datetime
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import asyncpg
+
+import nvidia_smi
+from connection_pool import PoolTimeoutError, pool_settings_from_env
+from db import (DATABASE, HEARTBEAT_HISTORY_SOURCES, HEARTBEAT_LOG_INTERVAL_MINUTES, HEARTBEAT_WRITE_RESOLUTION_SECONDS,
+                Device, gmt2jst, heartbeat_log_bucket, report_digest)
+
+
+class AsyncConnectionPool:
+    """
+    asyncpg pool taking the settings of connection_pool.ConnectionPool:
+    idle connections beyond `min_size` are closed by asyncpg after `max_idle`,
+    connections older than `max_lifetime` are closed instead of being handed out,
+    and connections idle for more than `health_check_interval` are checked with `SELECT 1`.
+
+    """
+    def __init__(self, dsn: str, min_size: int = 1, max_size: int = 10, timeout: float = 30.0,
+                 max_lifetime: float = 3600.0, max_idle: float = 600.0, health_check_interval: float = 30.0) -> None:
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+        self._pool: Optional[asyncpg.Pool] = None
+        self._waiting = 0
+        self._created_at: dict[int, float] = {}  # by backend pid, while the connection is open
+        self._last_used_at: dict[int, float] = {}
+        self._counters = {
+            'acquisitions': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'timeouts': 0,
+            'connections_created': 0,
+            'connections_recycled': 0,
+            'health_check_failures': 0,
+        }
+
+    async def open(self) -> None:
+        if self._pool is None:
+            self._pool = await asyncpg.create_pool(
+                self.dsn,
+                min_size=self.min_size,
+                max_size=self.max_size,
+                max_inactive_connection_lifetime=self.max_idle,
+                init=self._init,
+            )
+
+    async def close(self) -> None:
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await pool.close()
+
+    async def _init(self, conn: asyncpg.Connection) -> None:
+        pid = conn.get_server_pid()
+        self._created_at[pid] = self._last_used_at[pid] = time.monotonic()
+        self._counters['connections_created'] += 1
+        conn.add_termination_listener(lambda _: self._forget(pid))
+
+    def _forget(self, pid: int) -> None:
+        self._created_at.pop(pid, None)
+        self._last_used_at.pop(pid, None)
+
+    async def _is_usable(self, conn: asyncpg.Connection) -> bool:
+        """
+        :return: False if the connection has been closed for being too old or broken
+        """
+        pid = conn.get_server_pid()
+        now = time.monotonic()
+        if now - self._created_at.get(pid, now) > self.max_lifetime:
+            self._counters['connections_recycled'] += 1
+        elif now - self._last_used_at.get(pid, now) > self.health_check_interval:
+            try:
+                await conn.execute('SELECT 1;')
+                return True
+            except (asyncpg.PostgresError, asyncpg.InterfaceError, OSError):
+                self._counters['health_check_failures'] += 1
+        else:
+            return True
+        self._forget(pid)
+        conn.terminate()  # the pool replaces it on a later acquire
+        return False
+
+    async def _acquire(self) -> asyncpg.Connection:
+        try:
+            return await self._pool.acquire(timeout=self.timeout)
+        except asyncio.TimeoutError:
+            self._counters['timeouts'] += 1
+            raise PoolTimeoutError(
+                'no connection available within %.1f seconds (max_size=%d)'
+                % (self.timeout, self.max_size))
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[asyncpg.Connection]:
+        """
+        Borrow a connection. Statements run in autocommit mode;
+        use `conn.transaction()` for multi-statement work.
+
+        """
+        if self._pool is None:
+            await self.open()
+        begin = time.monotonic()
+        self._waiting += 1
+        try:
+            conn = await self._acquire()
+            if not await self._is_usable(conn):
+                conn = await self._acquire()  # a fresh one, or used just now: not checked again
+        finally:
+            self._waiting -= 1
+        wait_time = time.monotonic() - begin
+        self._counters['acquisitions'] += 1
+        self._counters['wait_time_total'] += wait_time
+        self._counters['wait_time_max'] = max(self._counters['wait_time_max'], wait_time)
+        try:
+            yield conn
+        finally:
+            if not conn.is_closed():
+                self._last_used_at[conn.get_server_pid()] = time.monotonic()
+            await self._pool.release(conn)
+
+    def stats(self) -> dict:
+        size = self._pool.get_size() if self._pool is not None else 0
+        idle = self._pool.get_idle_size() if self._pool is not None else 0
+        acquisitions = self._counters['acquisitions']
+        return {
+            'min_size': self.min_size,
+            'max_size': self.max_size,
+            'size': size,
+            'idle': idle,
+            'in_use': size - idle,
+            'waiting': self._waiting,
+            'wait_time_avg': self._counters['wait_time_total'] / acquisitions if acquisitions else 0.0,
+            **self._counters,
+        }
+
+
+pool = AsyncConnectionPool(DATABASE, **pool_settings_from_env())
+
+
+def pool_stats() -> dict:
+    """
+    :return: statistics of the connection pool
+    """
+    return pool.stats()
+
+
+async def read_JWT_secret() -> str:
+    """
+    Read JWT secret
+
+    :return: JWT secret
+    """
+    async with pool.connection() as conn:
+        return await conn.fetchval("select secret from jwt;")
+
+
+async def read_password_from_users(name: str) -> bytes:
+    """
+    Read user's password
+
+    :return: Hashed password if user exists.
+    """
+
+    SQL = """
+    SELECT hashed_password
+      FROM users
+     WHERE user_name = $1;
+    """
+
+    async with pool.connection() as conn:
+        res: Optional[bytes] = await conn.fetchval(SQL, name)
+    if res is None:
+        raise ValueError("User not exist:", name)
+    return res
+
+
+async def select_devices() -> list[Device]:
+    """
+    :return: list of Device
+    """
+    SQL = """
+    SELECT device_name, last_heartbeat, report, return_message, is_active
+      FROM devices
+     ORDER BY device_name asc;  -- this sort should be in javascript
+    """
+
+    async with pool.connection() as conn:
+        res: list[asyncpg.Record] = await conn.fetch(SQL)
+    return [Device(**{
+        'device_name': tp[0],
+        'last_heartbeat_timestamp': gmt2jst(tp[1]),
+        'report': tp[2],
+        'return_message': tp[3],
+        'is_active': tp[4],
+    }) for tp in res]
+
+
+async def select_devices_revision() -> int:
+    """
+    Revisions are IDs of the writing transactions, which commit in any order.
+    The cursor is the oldest one still running: no change below it can appear later.
+
+    :return: cursor for select_devices_since
+    """
+    SQL = """
+    SELECT txid_snapshot_xmin(txid_current_snapshot());
+    """
+
+    async with pool.connection() as conn:
+        return await conn.fetchval(SQL)
+
+
+async def select_devices_since(revision: int) -> list[tuple[int, Device]]:
+    """
+    :param revision: cursor of select_devices_revision
+    :return: list of (revision, Device) changed since `revision`
+    """
+    SQL = """
+    SELECT revision, device_name, last_heartbeat, report, return_message, is_active
+      FROM devices
+     WHERE revision >= $1
+     ORDER BY device_name asc;
+    """
+
+    async with pool.connection() as conn:
+        res: list[asyncpg.Record] = await conn.fetch(SQL, revision)
+    return [(tp[0], Device(**{
+        'device_name': tp[1],
+        'last_heartbeat_timestamp': gmt2jst(tp[2]),
+        'report': tp[3],
+        'return_message': tp[4],
+        'is_active': tp[5],
+    })) for tp in res]
+
+
+async def select_heartbeat_log_summation(period_of_hour: int = 24):
+    """
+    :return: list of (heartbeat_ts, count) of the buckets of the last `period_of_hour` hours, 0 for empty buckets
+    """
+    last = heartbeat_log_bucket()
+    first = last - datetime.timedelta(hours=period_of_hour) + datetime.timedelta(minutes=HEARTBEAT_LOG_INTERVAL_MINUTES)
+    return [(ts, online) for ts, online, _ in await select_heartbeat_history(first, last, HEARTBEAT_LOG_INTERVAL_MINUTES)]
+
+
+async def select_heartbeat_log_since(start_dt: datetime.datetime) -> list[tuple]:
+    """
+    :return: list of (heartbeat_ts, count) of buckets from `start_dt`, without padding
+    """
+    SQL = """
+    SELECT heartbeat_ts, online
+      FROM public.heartbeat_counts
+     WHERE heartbeat_ts >= $1
+     ORDER BY heartbeat_ts ASC;
+    """
+
+    async with pool.connection() as conn:
+        return [tuple(tp) for tp in await conn.fetch(SQL, start_dt)]
+
+
+async def select_heartbeat_history(first: datetime.datetime, last: datetime.datetime, resolution: int,
+                                source: str = 'counts') -> list[tuple]:
+    """
+    Online counts resampled to bins of `resolution` minutes from `first` to `last` (bin starts),
+    buckets without any row counting as 0.
+
+    :param source: 'counts', 'hourly' or 'daily'; see HEARTBEAT_HISTORY_SOURCES
+    :return: list of (bin, max online, sum of online)
+    """
+    table, ts, online_max, online_sum = HEARTBEAT_HISTORY_SOURCES[source]
+    SQL = """
+    SELECT bins.ts, COALESCE(MAX(src.{max}), 0), COALESCE(SUM(src.{sum}), 0)
+      FROM generate_series($1::timestamp, $2::timestamp, make_interval(mins => $3)) AS bins(ts)
+      LEFT JOIN public.{table} src
+        ON src.{ts} >= bins.ts AND src.{ts} < bins.ts + make_interval(mins => $3)
+     GROUP BY bins.ts
+     ORDER BY bins.ts ASC;
+    """.format(table=table, ts=ts, max=online_max, sum=online_sum)
+
+    async with pool.connection() as conn:
+        return [tuple(tp) for tp in await conn.fetch(SQL, first, last, resolution)]
+
+
+async def select_device_availability(starts: list[datetime.datetime]) -> tuple[list[tuple], list[tuple], list[tuple]]:
+    """
+    :param starts: beginnings of the windows
+    :return: (devices, uptime, outages) where
+             devices are (device_id, device_name, last_heartbeat, last_logged_ts),
+             uptime are (device_id, index of the window in `starts`, buckets logged) and
+             outages are (device_id, started_at, ended_at) of outages ending after the earliest start
+    """
+    SQL1 = """
+    SELECT d.device_id, d.device_name, d.last_heartbeat, a.last_logged_ts
+      FROM public.devices d
+      LEFT JOIN public.device_availability a USING (device_id)
+     ORDER BY d.device_id ASC;
+    """
+    SQL2 = """
+    SELECT u.device_id, w.i - 1, SUM(u.buckets)
+      FROM public.device_uptime_hourly u
+      JOIN unnest($1::timestamp[]) WITH ORDINALITY AS w(start, i) ON u.hour_ts >= w.start
+     WHERE u.hour_ts >= $2
+     GROUP BY 1, 2;
+    """
+    SQL3 = """
+    SELECT device_id, started_at, ended_at
+      FROM public.device_outages
+     WHERE ended_at > $1
+     ORDER BY device_id ASC, started_at ASC;
+    """
+
+    async with pool.connection() as conn:
+        devices = [tuple(tp) for tp in await conn.fetch(SQL1)]
+        uptime = [tuple(tp) for tp in await conn.fetch(SQL2, starts, min(starts))]
+        outages = [tuple(tp) for tp in await conn.fetch(SQL3, min(starts))]
+    return devices, uptime, outages
+
+
+async def select_report(dev_name: str) -> str:
+    """
+    :return: report of a device
+    """
+    SQL = """
+    SELECT report
+      FROM devices
+     WHERE device_name = $1;
+    """
+
+    async with pool.connection() as conn:
+        return await conn.fetchval(SQL, dev_name)
+
+
+async def select_return_message(dev_name: str) -> str:
+    """
+    :return: return_message of a device
+    """
+    SQL = """
+    SELECT return_message
+      FROM devices
+     WHERE device_name = $1;
+    """
+
+    async with pool.connection() as conn:
+        return await conn.fetchval(SQL, dev_name)
+
+
+async def select_device_reports() -> list[tuple]:
+    """
+    :return: list of (device_name, report)
+    """
+    SQL = """
+    SELECT device_name, report
+      FROM devices
+     ORDER BY device_name ASC;
+    """
+
+    async with pool.connection() as conn:
+        return [tuple(tp) for tp in await conn.fetch(SQL)]
+
+
+async def select_device_tokens() -> list[tuple[int, str, bytes]]:
+    """
+    :return: list of (device_id, device_name, api_token_hash) of devices holding a token
+    """
+    SQL = """
+    SELECT device_id, device_name, api_token_hash
+      FROM devices
+     WHERE api_token_hash IS NOT NULL;
+    """
+
+    async with pool.connection() as conn:
+        return [tuple(tp) for tp in await conn.fetch(SQL)]
+
+
+async def select_device_by_token(api_token_hash: bytes) -> Optional[tuple[int, str]]:
+    """
+    :return: (device_id, device_name) holding the token, if any
+    """
+    SQL = """
+    SELECT device_id, device_name
+      FROM devices
+     WHERE api_token_hash = $1;
+    """
+
+    async with pool.connection() as conn:
+        res: Optional[asyncpg.Record] = await conn.fetchrow(SQL, api_token_hash)
+    return tuple(res) if res is not None else None
+
+
+#################################################################################
+# Insert, Update below ...
+
+
+async def touch_heartbeat(dev_name: str, report: str|None, report_hash: bytes|None = None,
+                          resolution: float|None = HEARTBEAT_WRITE_RESOLUTION_SECONDS) -> tuple[int, str, Optional[bytes]]:
+    """
+    Update last_heartbeat/report without logging the heartbeat
+    (heartbeat_log is written in batches by heartbeat_log_writer).
+
+    The row is written only if the report changed, or last_heartbeat is
+    older than `resolution` seconds (never for `resolution` None, when
+    heartbeat_table writes last_heartbeat). `report` None keeps the stored report;
+    pass its `report_hash` anyway, and compare it with the returned one.
+
+    :return: (device_id, return_message, report_hash of the stored report)
+    """
+    return await _touch_heartbeat('device_name', dev_name, report, report_hash, resolution)
+
+
+async def touch_heartbeat_by_id(device_id: int, report: str|None, report_hash: bytes|None = None,
+                                resolution: float|None = HEARTBEAT_WRITE_RESOLUTION_SECONDS) -> tuple[int, str, Optional[bytes]]:
+    """
+    Same as touch_heartbeat(), for a device already identified by its API token.
+
+    :return: (device_id, return_message, report_hash of the stored report)
+    """
+    return await _touch_heartbeat('device_id', device_id, report, report_hash, resolution)
+
+
+async def _touch_heartbeat(key_column: str, key: str|int, report: str|None, report_hash: bytes|None,
+                           resolution: float|None) -> tuple[int, str, Optional[bytes]]:
+    SQL = """
+    WITH updated AS (
+        UPDATE devices
+           SET last_heartbeat = current_timestamp,
+               revision = txid_current(),
+               report = COALESCE($1::varchar, report),
+               report_hash = CASE WHEN $1::varchar IS NULL THEN report_hash ELSE $2::bytea END
+         WHERE %s = $3
+           AND ($1::varchar IS NOT NULL AND report_hash IS DISTINCT FROM $2::bytea
+                OR last_heartbeat IS NULL
+                OR last_heartbeat <= current_timestamp - make_interval(secs => $4::float8))
+     RETURNING device_id, return_message, report_hash
+    )
+    SELECT device_id, return_message, report_hash
+      FROM updated
+     UNION ALL
+    SELECT device_id, return_message, report_hash
+      FROM devices
+     WHERE %s = $3
+       AND NOT EXISTS (SELECT 1 FROM updated);
+    """ % (key_column, key_column)
+
+    if report is not None and report_hash is None:
+        report_hash = report_digest(report)
+
+    async with pool.connection() as conn:
+        res: Optional[asyncpg.Record] = await conn.fetchrow(SQL, report, report_hash, key, resolution)
+    if res is None:
+        raise ValueError('invalid device name')
+    return tuple(res)
+
+
+async def touch_heartbeats(entries: list[tuple[str, Optional[str], Optional[bytes]]]) -> dict[str, tuple[int, str, Optional[bytes]]]:
+    """
+    touch_heartbeat() of many devices in a single statement, writing only the rows
+    whose report changed (last_heartbeat is left to heartbeat_table).
+
+    :param entries: (device_name, report or None to keep it, report_hash), one per device
+    :return: (device_id, return_message, report_hash of the stored report) by device_name, for known devices
+    """
+    SQL = """
+    WITH input AS (
+        SELECT *
+          FROM unnest($1::varchar[], $2::varchar[], $3::bytea[]) AS i(device_name, report, report_hash)
+         ORDER BY device_name
+    ), updated AS (
+        UPDATE devices AS d
+           SET last_heartbeat = current_timestamp,
+               revision = txid_current(),
+               report = COALESCE(i.report, d.report),
+               report_hash = CASE WHEN i.report IS NULL THEN d.report_hash ELSE i.report_hash END
+          FROM input AS i
+         WHERE d.device_name = i.device_name
+           AND (i.report IS NOT NULL AND d.report_hash IS DISTINCT FROM i.report_hash
+                OR d.last_heartbeat IS NULL)
+     RETURNING d.device_name, d.device_id, d.return_message, d.report_hash
+    )
+    SELECT device_name, device_id, return_message, report_hash
+      FROM updated
+     UNION ALL
+    SELECT d.device_name, d.device_id, d.return_message, d.report_hash
+      FROM devices AS d
+      JOIN input AS i ON i.device_name = d.device_name
+     WHERE d.device_name NOT IN (SELECT device_name FROM updated);
+    """
+
+    entries = [
+        (device_name, report, report_digest(report) if report is not None and report_hash is None else report_hash)
+        for device_name, report, report_hash in entries
+    ]
+    async with pool.connection() as conn:
+        res: list[asyncpg.Record] = await conn.fetch(
+            SQL, [e[0] for e in entries], [e[1] for e in entries], [e[2] for e in entries])
+    return {tp[0]: (tp[1], tp[2], tp[3]) for tp in res}
+
+
+async def update_return_message(dev_name: str, return_message: str):
+    SQL = """
+    UPDATE devices
+       SET return_message = $1,
+           revision = txid_current()
+     WHERE device_name = $2;
+    """
+
+    async with pool.connection() as conn:
+        await conn.execute(SQL, return_message, dev_name)
+
+
+async def update_is_active(dev_name: str, is_active: bool):
+    SQL = """
+    UPDATE devices
+       SET is_active = $1,
+           revision = txid_current()
+     WHERE device_name= $2;
+    """
+
+    async with pool.connection() as conn:
+        await conn.execute(SQL, is_active, dev_name)
+
+
+async def register_device(dev_name: str, report: str|None, return_message: str|None,
+                          api_token_hash: bytes|None = None) -> int:
+    """
+    :return: device_id of the new device
+    """
+    SQL1 = """
+    INSERT INTO public.devices (device_name, report, return_message, api_token_hash) VALUES
+           ($1, $2, $3, $4)
+ RETURNING device_id;
+    """
+
+    async with pool.connection() as conn:
+        try:
+            return await conn.fetchval(
+                SQL1,
+                dev_name,
+                report if report is not None else '',
+                return_message if return_message is not None else '',
+                api_token_hash,
+            )
+        except asyncpg.UniqueViolationError:
+            raise ValueError('already registered device:', dev_name)
+
+
+async def update_device_token(dev_name: str, api_token_hash: bytes|None) -> int:
+    """
+    Issue (or revoke with None) the API token of a device.
+
+    :return: device_id
+    """
+    SQL = """
+    UPDATE devices
+       SET api_token_hash = $1
+     WHERE device_name = $2
+ RETURNING device_id;
+    """
+
+    async with pool.connection() as conn:
+        device_id: Optional[int] = await conn.fetchval(SQL, api_token_hash, dev_name)
+    if device_id is None:
+        raise ValueError('invalid device name')
+    return device_id
+
+
+async def insert_heartbeat_logs(rows: list[tuple[int, datetime.datetime]]):
+    """
+    Insert many (device_id, heartbeat_ts) at once, ignoring those already logged,
+    and count them in heartbeat_counts.
+
+    """
+    SQL = """
+    WITH logged AS (
+        INSERT INTO public.heartbeat_log (device_id, heartbeat_ts)
+        SELECT * FROM unnest($1::int4[], $2::timestamp[])
+            ON CONFLICT DO NOTHING
+     RETURNING heartbeat_ts
+    )
+    INSERT INTO public.heartbeat_counts (heartbeat_ts, online)
+    SELECT heartbeat_ts, COUNT(*)
+      FROM logged
+     GROUP BY heartbeat_ts
+        ON CONFLICT (heartbeat_ts) DO UPDATE
+       SET online = heartbeat_counts.online + EXCLUDED.online;
+    """
+
+    async with pool.connection() as conn:
+        await conn.execute(SQL, [row[0] for row in rows], [row[1] for row in rows])
+
+
+async def update_last_heartbeats(rows: list[tuple[int, datetime.datetime]]):
+    """
+    Set last_heartbeat of many (device_id, last_heartbeat) at once, never moving it backwards.
+
+    """
+    SQL = """
+    UPDATE devices AS d
+       SET last_heartbeat = v.last_heartbeat,
+           revision = txid_current()
+      FROM unnest($1::int4[], $2::timestamp[]) AS v(device_id, last_heartbeat)
+     WHERE d.device_id = v.device_id
+       AND (d.last_heartbeat IS NULL OR d.last_heartbeat < v.last_heartbeat);
+    """
+
+    async with pool.connection() as conn:
+        await conn.execute(SQL, [row[0] for row in rows], [row[1] for row in rows])
+
+
+#################################################################################
+# Maintenance below (run in the background by maintenance.py only) ...
+
+
+@asynccontextmanager
+async def advisory_lock(key: int) -> AsyncIterator[bool]:
+    """
+    Hold a session-level advisory lock while inside the block, if it is free.
+
+    :return: whether the lock was taken
+    """
+    async with pool.connection() as conn:
+        locked: bool = await conn.fetchval('SELECT pg_try_advisory_lock($1);', key)
+        try:
+            yield locked
+        finally:
+            if locked:
+                await conn.execute('SELECT pg_advisory_unlock($1);', key)
+
+
+async def claim_maintenance_run(task_name: str, period_seconds: float) -> bool:
+    """
+    Record the start of a run unless the task has run within the period.
+
+    :return: whether the caller should run the task
+    """
+    SQL = """
+    INSERT INTO public.maintenance_runs AS runs (task_name, last_run_at) VALUES
+           ($1, current_timestamp)
+        ON CONFLICT (task_name) DO UPDATE
+       SET last_run_at = current_timestamp
+     WHERE runs.last_run_at <= current_timestamp - make_interval(secs => $2)
+ RETURNING task_name;
+    """
+
+    async with pool.connection() as conn:
+        return await conn.fetchval(SQL, task_name, float(period_seconds)) is not None
+
+
+async def retry_maintenance_run(task_name: str, period_seconds: float, delay_seconds: float):
+    """
+    Let claim_maintenance_run() claim the task again `delay_seconds` from now, after a failed run.
+
+    """
+    SQL = """
+    UPDATE public.maintenance_runs
+       SET last_run_at = current_timestamp + make_interval(secs => $1)
+     WHERE task_name = $2;
+    """
+
+    async with pool.connection() as conn:
+        await conn.execute(SQL, float(delay_seconds - period_seconds), task_name)
+
+
+async def finish_maintenance_run(task_name: str, rows: int):
+    SQL = """
+    UPDATE public.maintenance_runs
+       SET last_finished_at = current_timestamp,
+           last_rows = $1
+     WHERE task_name = $2;
+    """
+
+    async with pool.connection() as conn:
+        await conn.execute(SQL, rows, task_name)
+
+
+async def delete_heartbeat_log_before(before: datetime.datetime, limit: int) -> int:
+    """
+    Delete at most `limit` rows older than `before`.
+
+    :return: number of deleted rows
+    """
+    SQL = """
+    DELETE FROM public.heartbeat_log
+     WHERE (device_id, heartbeat_ts) IN (
+           SELECT device_id, heartbeat_ts
+             FROM public.heartbeat_log
+            WHERE heartbeat_ts < $1
+            LIMIT $2
+           );
+    """
+
+    async with pool.connection() as conn:
+        status: str = await conn.execute(SQL, before, limit)
+    return int(status.split()[-1])
+
+
+def heartbeat_log_partition_name(day: datetime.date) -> str:
+    return 'heartbeat_log_p%s' % day.strftime('%Y%m%d')
+
+
+def heartbeat_log_partition_day(name: str) -> datetime.date:
+    """
+    Inverse of heartbeat_log_partition_name().
+
+    """
+    return datetime.datetime.strptime(name[-8:], '%Y%m%d').date()
+
+
+async def select_heartbeat_log_partitions() -> list[datetime.date]:
+    """
+    :return: days of the daily partitions of heartbeat_log
+    """
+    SQL = """
+    SELECT c.relname
+      FROM pg_inherits i
+      JOIN pg_class c ON c.oid = i.inhrelid
+     WHERE i.inhparent = 'public.heartbeat_log'::regclass
+       AND c.relname ~ '^heartbeat_log_p[0-9]{8}$'
+     ORDER BY c.relname ASC;
+    """
+
+    async with pool.connection() as conn:
+        names: list[str] = [tp[0] for tp in await conn.fetch(SQL)]
+    return [heartbeat_log_partition_day(name) for name in names]
+
+
+async def create_heartbeat_log_partition(day: datetime.date) -> int:
+    """
+    Create the partition of `day`, moving rows of that day out of heartbeat_log_default.
+
+    :return: number of moved rows
+    """
+    name = heartbeat_log_partition_name(day)
+    start, end = day, day + datetime.timedelta(days=1)
+
+    SQL1 = """
+    CREATE TABLE public.%s
+      (LIKE public.heartbeat_log INCLUDING DEFAULTS INCLUDING CONSTRAINTS);
+    """ % name
+    SQL2 = """
+    WITH moved AS (
+        DELETE FROM public.heartbeat_log_default
+         WHERE heartbeat_ts >= $1 AND heartbeat_ts < $2
+     RETURNING device_id, heartbeat_ts
+    )
+    INSERT INTO public.%s (device_id, heartbeat_ts)
+    SELECT device_id, heartbeat_ts
+      FROM moved;
+    """ % name
+    SQL3 = """
+    ALTER TABLE public.heartbeat_log
+      ATTACH PARTITION public.%s FOR VALUES FROM ('%s') TO ('%s');
+    """ % (name, start.isoformat(), end.isoformat())
+
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            await conn.execute(SQL1)
+            status: str = await conn.execute(SQL2, start, end)
+            await conn.execute(SQL3)
+    return int(status.split()[-1])
+
+
+async def drop_heartbeat_log_partition(day: datetime.date) -> int:
+    """
+    :return: number of dropped rows
+    """
+    name = heartbeat_log_partition_name(day)
+
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            rows: int = await conn.fetchval('SELECT COUNT(*) FROM public.%s;' % name)
+            await conn.execute('DROP TABLE public.%s;' % name)
+    return rows
+
+
+async def delete_heartbeat_counts_before(before: datetime.datetime) -> int:
+    """
+    :return: number of deleted rows
+    """
+    SQL = """
+    DELETE FROM public.heartbeat_counts WHERE heartbeat_ts < $1;
+    """
+
+    async with pool.connection() as conn:
+        status: str = await conn.execute(SQL, before)
+    return int(status.split()[-1])
+
+
+async def delete_heartbeat_rollup_hourly_before(before: datetime.datetime) -> int:
+    """
+    :return: number of deleted rows
+    """
+    SQL = """
+    DELETE FROM public.heartbeat_rollup_hourly WHERE bucket_ts < $1;
+    """
+
+    async with pool.connection() as conn:
+        status: str = await conn.execute(SQL, before)
+    return int(status.split()[-1])
+
+
+async def refresh_heartbeat_rollups(start_day: datetime.date, minute_interval: int = HEARTBEAT_LOG_INTERVAL_MINUTES) -> int:
+    """
+    Recompute hourly and daily rollups from `start_day` up to the current bucket.
+    Buckets without any heartbeat count as 0 online.
+
+    :return: number of rollup rows written
+    """
+    SQL1 = """
+    WITH buckets AS (
+        SELECT b.ts, COALESCE(c.online, 0) AS online
+          FROM generate_series($1::timestamp, $2::timestamp, make_interval(mins => $3)) AS b(ts)
+          LEFT JOIN public.heartbeat_counts c ON c.heartbeat_ts = b.ts
+    )
+    INSERT INTO public.heartbeat_rollup_hourly (bucket_ts, online_max, online_sum, samples)
+    SELECT date_trunc('hour', ts), MAX(online), SUM(online), COUNT(*)
+      FROM buckets
+     GROUP BY 1
+        ON CONFLICT (bucket_ts) DO UPDATE
+       SET online_max = EXCLUDED.online_max,
+           online_sum = EXCLUDED.online_sum,
+           samples = EXCLUDED.samples;
+    """
+    SQL2 = """
+    WITH buckets AS (
+        SELECT b.ts, COALESCE(c.online, 0) AS online
+          FROM generate_series($1::timestamp, $2::timestamp, make_interval(mins => $3)) AS b(ts)
+          LEFT JOIN public.heartbeat_counts c ON c.heartbeat_ts = b.ts
+    ), seen AS (
+        SELECT heartbeat_ts::date AS day, COUNT(DISTINCT device_id) AS devices_seen
+          FROM public.heartbeat_log
+         WHERE heartbeat_ts >= $1
+         GROUP BY 1
+    )
+    INSERT INTO public.heartbeat_rollup_daily (bucket_ts, online_max, online_sum, samples, devices_seen)
+    SELECT b.ts::date, MAX(b.online), SUM(b.online), COUNT(*), COALESCE(MAX(seen.devices_seen), 0)
+      FROM buckets b
+      LEFT JOIN seen ON seen.day = b.ts::date
+     GROUP BY 1
+        ON CONFLICT (bucket_ts) DO UPDATE
+       SET online_max = EXCLUDED.online_max,
+           online_sum = EXCLUDED.online_sum,
+           samples = EXCLUDED.samples,
+           devices_seen = EXCLUDED.devices_seen;
+    """
+
+    start = datetime.datetime.combine(start_day, datetime.time())
+    end = heartbeat_log_bucket(minute_interval)
+
+    async with pool.connection() as conn:
+        status1: str = await conn.execute(SQL1, start, end, minute_interval)
+        status2: str = await conn.execute(SQL2, start, end, minute_interval)
+    return int(status1.split()[-1]) + int(status2.split()[-1])
+
+
+async def summarize_device_availability(lookback: datetime.timedelta,
+                                       minute_interval: int = HEARTBEAT_LOG_INTERVAL_MINUTES) -> int:
+    """
+    Fold heartbeat_log into device_uptime_hourly, device_outages and device_availability.
+    The hours from `lookback` before the latest summarized row on are summarized again
+    from scratch, so rows logged late (within `lookback`) are counted too.
+
+    :return: number of summarized heartbeat_log rows
+    """
+    SQL1 = """
+    SELECT date_trunc('hour', MAX(last_logged_ts) - make_interval(secs => $1))
+      FROM public.device_availability;
+    """
+    SQL2 = """
+    DELETE FROM public.device_outages WHERE ended_at >= COALESCE($1::timestamp, '-infinity');
+    """
+    SQL3 = """
+    WITH logged AS (
+        SELECT device_id, heartbeat_ts
+          FROM public.heartbeat_log
+         WHERE heartbeat_ts >= COALESCE($2::timestamp, '-infinity')
+    ), before AS (  -- the row of each device preceding them
+        SELECT p.device_id, p.heartbeat_ts
+          FROM public.device_availability a,
+       LATERAL (SELECT device_id, heartbeat_ts
+                  FROM public.heartbeat_log l
+                 WHERE l.device_id = a.device_id AND l.heartbeat_ts < $2::timestamp
+                 ORDER BY heartbeat_ts DESC
+                 LIMIT 1) p
+    ), rows AS (
+        SELECT device_id, heartbeat_ts, LAG(heartbeat_ts) OVER w AS prev_ts
+          FROM (SELECT * FROM logged UNION ALL SELECT * FROM before) t
+        WINDOW w AS (PARTITION BY device_id ORDER BY heartbeat_ts)
+    ), new AS (
+        SELECT * FROM rows WHERE heartbeat_ts >= COALESCE($2::timestamp, '-infinity')
+    ), outages AS (
+        INSERT INTO public.device_outages (device_id, started_at, ended_at)
+        SELECT device_id, prev_ts + make_interval(mins => $1), heartbeat_ts
+          FROM new
+         WHERE heartbeat_ts > prev_ts + make_interval(mins => $1)
+            ON CONFLICT DO NOTHING
+    ), uptime AS (
+        INSERT INTO public.device_uptime_hourly (device_id, hour_ts, buckets)
+        SELECT device_id, date_trunc('hour', heartbeat_ts), COUNT(*)
+          FROM new
+         GROUP BY 1, 2
+            ON CONFLICT (device_id, hour_ts) DO UPDATE
+           SET buckets = EXCLUDED.buckets  -- hours are counted whole
+    ), latest AS (
+        INSERT INTO public.device_availability (device_id, last_logged_ts)
+        SELECT device_id, MAX(heartbeat_ts)
+          FROM new
+         GROUP BY 1
+            ON CONFLICT (device_id) DO UPDATE
+           SET last_logged_ts = GREATEST(device_availability.last_logged_ts, EXCLUDED.last_logged_ts)
+    )
+    SELECT COUNT(*) FROM new;
+    """
+
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            start: Optional[datetime.datetime] = await conn.fetchval(SQL1, lookback.total_seconds())
+            await conn.execute(SQL2, start)
+            return await conn.fetchval(SQL3, minute_interval, start)
+
+
+async def delete_device_availability_before(before: datetime.datetime) -> int:
+    """
+    :return: number of deleted rows of device_uptime_hourly and device_outages
+    """
+    SQL1 = """
+    DELETE FROM public.device_uptime_hourly WHERE hour_ts < $1;
+    """
+    SQL2 = """
+    DELETE FROM public.device_outages WHERE ended_at < $1;
+    """
+
+    async with pool.connection() as conn:
+        status1: str = await conn.execute(SQL1, before)
+        status2: str = await conn.execute(SQL2, before)
+    return int(status1.split()[-1]) + int(status2.split()[-1])
+
+
+async def replace_gpu_metrics(device_id: int, report: Optional[nvidia_smi.NvidiaSmiReport]) -> None:
+    """
+    Replace the GPUs and GPU processes of a device with those of a parsed nvidia-smi report
+    (None removes them).
+
+    """
+    SQL1 = """
+    DELETE FROM public.gpu_processes WHERE device_id = $1;
+    """
+    SQL2 = """
+    DELETE FROM public.gpu_metrics WHERE device_id = $1 AND gpu_index <> ALL($2::int2[]);
+    """
+    SQL3 = """
+    INSERT INTO public.gpu_metrics (
+           device_id, gpu_index, gpu_name, bus_id, fan_percent, temperature_c, perf_state,
+           power_draw_w, power_limit_w, memory_used_mib, memory_total_mib, utilization_percent, updated_at)
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13)
+        ON CONFLICT (device_id, gpu_index) DO UPDATE
+       SET gpu_name = EXCLUDED.gpu_name,
+           bus_id = EXCLUDED.bus_id,
+           fan_percent = EXCLUDED.fan_percent,
+           temperature_c = EXCLUDED.temperature_c,
+           perf_state = EXCLUDED.perf_state,
+           power_draw_w = EXCLUDED.power_draw_w,
+           power_limit_w = EXCLUDED.power_limit_w,
+           memory_used_mib = EXCLUDED.memory_used_mib,
+           memory_total_mib = EXCLUDED.memory_total_mib,
+           utilization_percent = EXCLUDED.utilization_percent,
+           updated_at = EXCLUDED.updated_at;
+    """
+    SQL4 = """
+    INSERT INTO public.gpu_processes (device_id, gpu_index, pid, process_type, process_name, memory_mib)
+    VALUES ($1, $2, $3, $4, $5, $6);
+    """
+
+    gpus = report.gpus if report is not None else []
+    processes = report.processes if report is not None else []
+    now = datetime.datetime.now().replace(microsecond=0)
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            await conn.execute(SQL1, device_id)
+            await conn.execute(SQL2, device_id, [gpu.index for gpu in gpus])
+            if gpus:
+                await conn.executemany(SQL3, [(
+                    device_id, gpu.index, gpu.name[:256], gpu.bus_id[:32], gpu.fan_percent, gpu.temperature_c,
+                    gpu.perf_state[:8] if gpu.perf_state else None, gpu.power_draw_w, gpu.power_limit_w,
+                    gpu.memory_used_mib, gpu.memory_total_mib, gpu.utilization_percent, now,
+                ) for gpu in gpus])
+            if processes:
+                await conn.executemany(SQL4, [(
+                    device_id, process.gpu_index, process.pid, process.type, process.name[:256], process.memory_mib,
+                ) for process in processes])
+
+
+async def select_gpus(min_free_mib: Optional[int] = None, max_utilization: Optional[int] = None,
+                      device_name: Optional[str] = None, with_processes: bool = False) -> list[dict]:
+    """
+    :param min_free_mib: only GPUs with at least this much free memory
+    :param max_utilization: only GPUs at most this busy (percent)
+    :return: GPUs as dicts, ordered by device and index
+    """
+    conditions, params = [], []
+    for condition, value in (
+        ('g.memory_free_mib >= $%d', min_free_mib),
+        ('g.utilization_percent <= $%d', max_utilization),
+        ('d.device_name = $%d', device_name),
+    ):
+        if value is not None:
+            params.append(value)
+            conditions.append(condition % len(params))
+
+    SQL1 = """
+    SELECT d.device_name, g.device_id, g.gpu_index, g.gpu_name, g.bus_id, g.fan_percent, g.temperature_c,
+           g.perf_state, g.power_draw_w, g.power_limit_w, g.memory_used_mib, g.memory_total_mib,
+           g.memory_free_mib, g.utilization_percent, g.updated_at
+      FROM public.gpu_metrics g
+      JOIN public.devices d USING (device_id)
+     WHERE %s
+     ORDER BY d.device_name ASC, g.gpu_index ASC;
+    """ % (' AND '.join(conditions) or 'TRUE')
+    SQL2 = """
+    SELECT device_id, gpu_index, pid, process_type, process_name, memory_mib
+      FROM public.gpu_processes
+     WHERE device_id = ANY($1::int4[])
+     ORDER BY device_id ASC, gpu_index ASC, pid ASC;
+    """
+
+    async with pool.connection() as conn:
+        gpus = [dict(tp) for tp in await conn.fetch(SQL1, *params)]
+        if with_processes and gpus:
+            by_gpu: dict[tuple[int, int], list[dict]] = {}
+            for gpu in gpus:
+                gpu['processes'] = by_gpu.setdefault((gpu['device_id'], gpu['gpu_index']), [])
+            for tp in await conn.fetch(SQL2, list({gpu['device_id'] for gpu in gpus})):
+                processes = by_gpu.get((tp['device_id'], tp['gpu_index']))
+                if processes is not None:
+                    processes.append({
+                        'pid': tp['pid'],
+                        'type': tp['process_type'],
+                        'name': tp['process_name'],
+                        'memory_mib': tp['memory_mib'],
+                    })
+    for gpu in gpus:
+        del gpu['device_id']
+    return gpus
+
+
+async def insert_report_history(device_id: int, recorded_at: datetime.datetime,
+                                keyframe_id: Optional[int], payload: bytes) -> int:
+    """
+    :param keyframe_id: None for a keyframe
+    :return: report_id of the new row
+    """
+    SQL = """
+    INSERT INTO public.report_history (device_id, recorded_at, keyframe_id, payload)
+    VALUES ($1, $2, $3, $4)
+    RETURNING report_id;
+    """
+
+    async with pool.connection() as conn:
+        return await conn.fetchval(SQL, device_id, recorded_at, keyframe_id, payload)
+
+
+async def select_report_history(dev_name: str, start: datetime.datetime, end: datetime.datetime) -> list[tuple]:
+    """
+    :return: list of (recorded_at, is keyframe, stored size) of a device between `start` and `end`
+    """
+    SQL = """
+    SELECT r.recorded_at, r.keyframe_id IS NULL, length(r.payload)
+      FROM public.report_history r
+      JOIN public.devices d USING (device_id)
+     WHERE d.device_name = $1
+       AND r.recorded_at >= $2 AND r.recorded_at < $3
+     ORDER BY r.recorded_at ASC, r.report_id ASC;
+    """
+
+    async with pool.connection() as conn:
+        return [tuple(tp) for tp in await conn.fetch(SQL, dev_name, start, end)]
+
+
+async def select_report_history_at(dev_name: str, at: datetime.datetime) -> Optional[tuple[datetime.datetime, bytes, Optional[bytes]]]:
+    """
+    :return: (recorded_at, payload, payload of its keyframe or None) of the last row at or before `at`
+    """
+    SQL = """
+    SELECT r.recorded_at, r.payload, k.payload
+      FROM public.report_history r
+      JOIN public.devices d USING (device_id)
+      LEFT JOIN public.report_history k ON k.report_id = r.keyframe_id
+     WHERE d.device_name = $1
+       AND r.recorded_at <= $2
+     ORDER BY r.recorded_at DESC, r.report_id DESC
+     LIMIT 1;
+    """
+
+    async with pool.connection() as conn:
+        row = await conn.fetchrow(SQL, dev_name, at)
+    return tuple(row) if row is not None else None
+
+
+async def delete_report_history_before(before: datetime.datetime, limit: int) -> int:
+    """
+    Delete at most `limit` rows older than `before`, keeping keyframes of newer deltas.
+
+    :return: number of deleted rows
+    """
+    SQL = """
+    DELETE FROM public.report_history
+     WHERE report_id = ANY(ARRAY(
+           SELECT r.report_id
+             FROM public.report_history r
+            WHERE r.recorded_at < $1
+              AND NOT EXISTS (
+                  SELECT 1
+                    FROM public.report_history d
+                   WHERE d.keyframe_id = r.report_id AND d.recorded_at >= $1)
+            LIMIT $2
+           ));
+    """
+
+    async with pool.connection() as conn:
+        status: str = await conn.execute(SQL, before, limit)
+    return int(status.split()[-1])
@@ -0,0 +1,133 @@
+import datetime
+import os
+
+import async_db
+import db
+from db import HEARTBEAT_LOG_INTERVAL_MINUTES, gmt2jst, heartbeat_log_bucket
+from heartbeat_table import heartbeat_table
+from ttl_cache import TTLCache
+
+
+"""
+Per-device availability: uptime, longest outage and time since last seen
+
+A device is up during a heartbeat_log bucket if it was logged in it.
+maintenance.py folds new heartbeat_log rows into per-device hourly counts
+(device_uptime_hourly) and outages (device_outages, runs of missing buckets)
+every DEVICE_AVAILABILITY_PERIOD_SECONDS, so reading availability costs a few
+small aggregate queries whatever the size of heartbeat_log.
+The latest bucket may lag that period behind.
+
+Results for the whole fleet are cached for AVAILABILITY_CACHE_TTL_SECONDS.
+
+"""
+WINDOWS = {
+    '24h': datetime.timedelta(hours=24),
+    '7d': datetime.timedelta(days=7),
+    '30d': datetime.timedelta(days=30),
+}
+CACHE_TTL_SECONDS = float(os.environ.get('AVAILABILITY_CACHE_TTL_SECONDS') or 60)
+
+availability_cache = TTLCache(1, CACHE_TTL_SECONDS)
+
+
+def window_starts(bucket: datetime.datetime) -> list[datetime.datetime]:
+    """
+    :return: beginning of each window, on the hour, so that the window ends with the hour of `bucket`
+    """
+    hour = bucket.replace(minute=0, second=0, microsecond=0)
+    return [hour - length + datetime.timedelta(hours=1) for length in WINDOWS.values()]
+
+
+def _outage(started_at: datetime.datetime, ended_at: datetime.datetime, seconds: float) -> dict:
+    return {'start': gmt2jst(started_at), 'end': gmt2jst(ended_at), 'seconds': int(seconds)}
+
+
+def summarize(devices: list[tuple], uptime: list[tuple], outages: list[tuple],
+              bucket: datetime.datetime, now: datetime.datetime,
+              minute_interval: int = HEARTBEAT_LOG_INTERVAL_MINUTES) -> dict[str, dict]:
+    """
+    :param devices, uptime, outages: rows of select_device_availability
+    :param bucket: current heartbeat_log bucket
+    :return: availability of each device by name
+    """
+    interval = datetime.timedelta(minutes=minute_interval)
+    starts = window_starts(bucket)
+    window_end = bucket + interval
+    expected = [(bucket - start) // interval + 1 for start in starts]
+
+    logged: dict[int, list[int]] = {}
+    for device_id, i, buckets in uptime:
+        logged.setdefault(device_id, [0] * len(starts))[i] = buckets
+    outages_of: dict[int, list[tuple]] = {}
+    for device_id, started_at, ended_at in outages:
+        outages_of.setdefault(device_id, []).append((started_at, ended_at))
+
+    result = {}
+    for device_id, device_name, last_heartbeat, last_logged_ts in devices:
+        ongoing = None
+        spans = list(outages_of.get(device_id, []))
+        if last_logged_ts is not None and last_logged_ts + interval < bucket:
+            ongoing = (last_logged_ts + interval, bucket)
+            spans.append(ongoing)
+
+        uptime_of, longest_of = {}, {}
+        for i, name in enumerate(WINDOWS):
+            uptime_of[name] = round(min(logged.get(device_id, [0] * len(starts))[i] / expected[i], 1.0), 4)
+            longest = None
+            for started_at, ended_at in spans:
+                seconds = (min(ended_at, window_end) - max(started_at, starts[i])).total_seconds()
+                if seconds > 0 and (longest is None or seconds > longest['seconds']):
+                    longest = _outage(started_at, ended_at, seconds)
+            longest_of[name] = longest
+
+        result[device_name] = {
+            'device_name': device_name,
+            'last_seen': gmt2jst(last_heartbeat),
+            'last_seen_seconds': int((now - last_heartbeat).total_seconds()) if last_heartbeat is not None else None,
+            'uptime': uptime_of,
+            'longest_outage': longest_of,
+            'current_outage': _outage(*ongoing, (bucket - ongoing[0]).total_seconds()) if ongoing else None,
+        }
+    return result
+
+
+def read_through(devices: list[tuple]) -> list[tuple]:
+    """
+    :return: rows of select_device_availability with the last heartbeats of heartbeat_table
+    """
+    result = []
+    for device_id, device_name, last_heartbeat, last_logged_ts in devices:
+        at = heartbeat_table.last_heartbeat(device_name)
+        if at is not None and (last_heartbeat is None or last_heartbeat < at):
+            last_heartbeat = at
+        result.append((device_id, device_name, last_heartbeat, last_logged_ts))
+    return result
+
+
+async def load() -> dict[str, dict]:
+    """
+    :return: availability of every device, cached
+    """
+    result = availability_cache.get('devices')
+    if result is None:
+        bucket = heartbeat_log_bucket()
+        devices, uptime, outages = await async_db.select_device_availability(window_starts(bucket))
+        result = summarize(read_through(devices), uptime, outages, bucket, datetime.datetime.now())
+        availability_cache.put('devices', result)
+    return result
+
+
+def load_sync() -> dict[str, dict]:
+    """
+    load() for synchronous code.
+
+    """
+    result = availability_cache.get('devices')
+    if result is None:
+        bucket = heartbeat_log_bucket()
+        devices, uptime, outages = db.select_device_availability(window_starts(bucket))
+        result = summarize(read_through(devices), uptime, outages, bucket, datetime.datetime.now())
+        availability_cache.put('devices', result)
+    return result
+
@@ -0,0 +1,64 @@
+import timeit
+
+from pipeline import Pipeline, Program
+
+
+"""
+Benchmark of the MHPL parser and evaluator.
+
+Time per character should stay flat while nesting depth and escape
+density grow, i.e. parsing is linear in the length of the message.
+Only pure functions (#plus) are used, so no database is needed.
+
+    python bench_pipeline.py
+
+"""
+MAX_LENGTH = 4096
+
+
+def nested_message(depth: int) -> str:
+    return '#plus(' * depth + '1' + ', 1)' * depth
+
+
+def escaped_message(density: float, length: int = MAX_LENGTH) -> str:
+    """
+    :param density: ratio of characters belonging to an escape sequence
+    """
+    n_escapes = int(length * density) // 2
+    escapes = ['\\#' if i % 2 else '\\\\' for i in range(n_escapes)]
+    return ''.join(escapes) + 'x' * (length - 2 * n_escapes)
+
+
+def measure(text: str, number: int) -> tuple[float, float]:
+    """
+    :return: seconds per parse, seconds per compile + run
+    """
+    parse = timeit.timeit(lambda: Pipeline.parse(text), number=number) / number
+    run = timeit.timeit(lambda: Program(text).run(), number=number) / number
+    return parse, run
+
+
+def report(title: str, header: str, cases: list[tuple[object, str]], number: int = 20) -> None:
+    print(title)
+    print('%10s %8s %12s %12s %14s' % (header, 'length', 'parse [ms]', 'run [ms]', 'parse [us/ch]'))
+    for label, text in cases:
+        parse, run = measure(text, number)
+        print('%10s %8d %12.3f %12.3f %14.3f' % (label, len(text), parse * 1e3, run * 1e3, parse * 1e6 / len(text)))
+    print()
+
+
+def main() -> None:
+    depths = [1, 10, 50, 100, 200, 400]  # depth 400 is a 4001-char message
+    report('Nesting depth', 'depth', [(d, nested_message(d)) for d in depths])
+
+    densities = [0.0, 0.1, 0.25, 0.5, 1.0]
+    report('Escape density (%d chars)' % MAX_LENGTH, 'density', [(d, escaped_message(d)) for d in densities])
+
+    lengths = [256, 512, 1024, 2048, 4096]
+    report('Plain text with functions', 'target', [
+        (n, 'Alive #plus(1, 2) / ' * (n // 20)) for n in lengths
+    ])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,307 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+import psycopg2
+from psycopg2.extensions import ISOLATION_LEVEL_READ_COMMITTED, TRANSACTION_STATUS_IDLE, connection
+
+
+"""
+Connection pool for PostgreSQL
+
+Connections are opened lazily, handed out LIFO (the most recently used one
+is the least likely to have been dropped by the server), checked with
+`SELECT 1` when they have been idle for a while and recycled when they get
+older than `max_lifetime`.
+
+"""
+class PoolTimeoutError(Exception):
+    pass
+
+
+class PooledConnection:
+    def __init__(self, conn: connection) -> None:
+        self.conn = conn
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+
+    def __repr__(self) -> str:
+        return '%s(conn=%s)' % (self.__class__.__name__, self.conn)
+
+    def age(self, now: float) -> float:
+        return now - self.created_at
+
+    def idle_time(self, now: float) -> float:
+        return now - self.last_used_at
+
+
+class ConnectionPool:
+    def __init__(
+        self,
+        dsn: str,
+        min_size: int = 1,
+        max_size: int = 10,
+        timeout: float = 30.0,
+        max_lifetime: float = 3600.0,
+        max_idle: float = 600.0,
+        health_check_interval: float = 30.0,
+    ) -> None:
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError('invalid pool size: min=%d, max=%d' % (min_size, max_size))
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+
+        self._cond = threading.Condition()
+        self._reset_state()
+
+    def _reset_state(self) -> None:
+        self._pid = os.getpid()
+        self._idle: list[PooledConnection] = []
+        self._size = 0  # opened + being opened
+        self._in_use = 0
+        self._waiting = 0
+        self._closed = False
+        self._counters = {
+            'acquisitions': 0,
+            'waits': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+            'timeouts': 0,
+            'connections_created': 0,
+            'connections_recycled': 0,
+            'health_check_failures': 0,
+        }
+
+    def _connect(self) -> PooledConnection:
+        conn = psycopg2.connect(self.dsn)
+        conn.isolation_level = ISOLATION_LEVEL_READ_COMMITTED
+        return PooledConnection(conn)
+
+    def _is_stale(self, entry: PooledConnection, now: float) -> bool:
+        return entry.conn.closed or entry.age(now) > self.max_lifetime
+
+    def _is_healthy(self, entry: PooledConnection) -> bool:
+        try:
+            with entry.conn.cursor() as cur:
+                cur.execute('SELECT 1;')
+            entry.conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _close_quietly(entry: PooledConnection) -> None:
+        try:
+            entry.conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _check_fork(self) -> None:
+        # Connections must not be shared with a forked worker process.
+        if self._pid != os.getpid():
+            self._reset_state()
+
+    def getconn(self) -> PooledConnection:
+        """
+        Check out a connection, waiting up to `timeout` seconds for one to be returned.
+
+        :return: PooledConnection
+        """
+        begin = time.monotonic()
+        waited = False
+        with self._cond:
+            self._check_fork()
+            if self._closed:
+                raise PoolTimeoutError('connection pool is closed')
+            while True:
+                if self._idle:
+                    entry = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    entry = None
+                    self._size += 1
+                    break
+                remaining = self.timeout - (time.monotonic() - begin)
+                if remaining <= 0:
+                    self._counters['timeouts'] += 1
+                    raise PoolTimeoutError(
+                        'no connection available within %.1f seconds (max_size=%d)'
+                        % (self.timeout, self.max_size))
+                waited = True
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._in_use += 1
+
+            wait_time = time.monotonic() - begin
+            self._counters['acquisitions'] += 1
+            if waited:
+                self._counters['waits'] += 1
+            self._counters['wait_time_total'] += wait_time
+            self._counters['wait_time_max'] = max(self._counters['wait_time_max'], wait_time)
+
+        # Connecting and health checks run without holding the lock.
+        event = None
+        try:
+            now = time.monotonic()
+            if entry is not None and self._is_stale(entry, now):
+                self._close_quietly(entry)
+                event = 'connections_recycled'
+                entry = None
+            elif entry is not None and entry.idle_time(now) > self.health_check_interval:
+                if not self._is_healthy(entry):
+                    self._close_quietly(entry)
+                    event = 'health_check_failures'
+                    entry = None
+            created = entry is None
+            if created:
+                entry = self._connect()
+        except BaseException:
+            with self._cond:
+                self._in_use -= 1
+                self._size -= 1
+                self._cond.notify()
+            raise
+        if event is not None or created:
+            with self._cond:
+                if event is not None:
+                    self._counters[event] += 1
+                if created:
+                    self._counters['connections_created'] += 1
+        return entry
+
+    def putconn(self, entry: PooledConnection, discard: bool = False) -> None:
+        """
+        Return a connection to the pool.
+
+        Connections left in a transaction are rolled back, broken ones are closed.
+        """
+        if not discard and not entry.conn.closed:
+            if entry.conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                try:
+                    entry.conn.rollback()
+                except psycopg2.Error:
+                    discard = True
+        discard = discard or bool(entry.conn.closed)
+
+        now = time.monotonic()
+        entry.last_used_at = now
+        with self._cond:
+            if self._pid != os.getpid():  # checked out before a fork; not ours
+                return
+            self._in_use -= 1
+            if discard or self._closed or self._is_stale(entry, now):
+                self._size -= 1
+                self._close_quietly(entry)
+            else:
+                self._idle.append(entry)
+            self._shrink(now)
+            self._cond.notify()
+
+    def _shrink(self, now: float) -> None:
+        # Close connections idling beyond `max_idle`, keeping `min_size` open.
+        # Oldest idle connections are at the head of the list.
+        while self._idle and self._size > self.min_size and self._idle[0].idle_time(now) > self.max_idle:
+            entry = self._idle.pop(0)
+            self._size -= 1
+            self._close_quietly(entry)
+
+    @contextmanager
+    def connection(self) -> Iterator[connection]:
+        """
+        Borrow a connection; commit on success and roll back on error.
+
+        """
+        entry = self.getconn()
+        discard = False
+        try:
+            yield entry.conn
+            entry.conn.commit()
+        except BaseException:
+            try:
+                entry.conn.rollback()
+            except psycopg2.Error:
+                discard = True
+            raise
+        finally:
+            self.putconn(entry, discard=discard)
+
+    def fill(self) -> None:
+        """
+        Open connections up to `min_size`.
+
+        """
+        entries = []
+        with self._cond:
+            self._check_fork()
+            n = max(self.min_size - self._size, 0)
+            self._size += n
+        try:
+            for _ in range(n):
+                entries.append(self._connect())
+        finally:
+            with self._cond:
+                self._counters['connections_created'] += len(entries)
+                self._size -= n - len(entries)
+                self._idle[:0] = entries
+                self._cond.notify_all()
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for entry in idle:
+            self._close_quietly(entry)
+
+    def stats(self) -> dict:
+        """
+        :return: snapshot of pool usage, for sizing `min_size` / `max_size`
+        """
+        with self._cond:
+            acquisitions = self._counters['acquisitions']
+            return {
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'waiting': self._waiting,
+                'wait_time_avg': self._counters['wait_time_total'] / acquisitions if acquisitions else 0.0,
+                **self._counters,
+            }
+
+
+def pool_settings_from_env(prefix: str = 'DB_POOL_') -> dict:
+    """
+    Read pool settings from environment variables
+    (DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, DB_POOL_MAX_LIFETIME,
+    DB_POOL_MAX_IDLE, DB_POOL_HEALTH_CHECK_INTERVAL).
+
+    """
+    def env(name: str, default: float) -> float:
+        value: Optional[str] = os.environ.get(prefix + name)
+        return float(value) if value else default
+
+    return {
+        'min_size': int(env('MIN_SIZE', 1)),
+        'max_size': int(env('MAX_SIZE', 10)),
+        'timeout': env('TIMEOUT', 30.0),
+        'max_lifetime': env('MAX_LIFETIME', 3600.0),
+        'max_idle': env('MAX_IDLE', 600.0),
+        'health_check_interval': env('HEALTH_CHECK_INTERVAL', 30.0),
+    }
+
+
+def pool_from_env(dsn: str, prefix: str = 'DB_POOL_') -> ConnectionPool:
+    return ConnectionPool(dsn, **pool_settings_from_env(prefix))
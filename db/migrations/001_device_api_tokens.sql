@@ -0,0 +1,7 @@
+--------------------
+-- Per-device API tokens
+--------------------
+
+ALTER TABLE public.devices
+  ADD COLUMN api_token_hash BYTEA NULL,  -- SHA-256 of the device's API token
+  ADD CONSTRAINT devices_api_token_un UNIQUE (api_token_hash);
@@ -0,0 +1,10 @@
+--------------------
+-- Change cursor of devices
+--------------------
+
+CREATE SEQUENCE public.devices_revision_seq;
+
+ALTER TABLE public.devices
+  ADD COLUMN revision BIGINT DEFAULT nextval('public.devices_revision_seq') NOT NULL;  -- bumped on every visible change
+
+CREATE INDEX devices_revision_idx ON public.devices (revision);
@@ -0,0 +1,13 @@
+--------------------
+-- Background maintenance
+--------------------
+
+CREATE INDEX heartbeat_log_ts_idx ON public.heartbeat_log (heartbeat_ts);
+
+CREATE TABLE public.maintenance_runs (
+       task_name VARCHAR(64) NOT NULL,
+       last_run_at TIMESTAMP(0) NOT NULL,
+       last_finished_at TIMESTAMP(0) NULL,
+       last_rows INT8 NULL,  -- rows processed by the last run
+       CONSTRAINT maintenance_runs_pk PRIMARY KEY (task_name)
+);
@@ -0,0 +1,60 @@
+--------------------
+-- Time-partitioned heartbeat_log with per-bucket counts and rollups
+--------------------
+
+BEGIN;
+
+ALTER TABLE public.heartbeat_log RENAME TO heartbeat_log_legacy;
+ALTER INDEX public.heartbeat_log_pk RENAME TO heartbeat_log_legacy_pk;
+ALTER INDEX public.heartbeat_log_ts_idx RENAME TO heartbeat_log_legacy_ts_idx;
+
+-- Daily partitions (heartbeat_log_pYYYYMMDD) are created and dropped by maintenance.py;
+-- rows without a partition land in heartbeat_log_default.
+CREATE TABLE public.heartbeat_log (
+       device_id int4 NOT NULL,
+       heartbeat_ts TIMESTAMP(0) NOT NULL,
+       CONSTRAINT heartbeat_log_pk PRIMARY KEY (device_id, heartbeat_ts),
+       CONSTRAINT heartbeat_log_fk_device_id FOREIGN KEY (device_id) REFERENCES public.devices(device_id) ON DELETE CASCADE ON UPDATE CASCADE
+) PARTITION BY RANGE (heartbeat_ts);
+
+CREATE TABLE public.heartbeat_log_default PARTITION OF public.heartbeat_log DEFAULT;
+
+CREATE INDEX heartbeat_log_ts_idx ON public.heartbeat_log (heartbeat_ts);
+
+-- Devices online per heartbeat_log bucket, counted as rows are inserted
+CREATE TABLE public.heartbeat_counts (
+       heartbeat_ts TIMESTAMP(0) NOT NULL,
+       online int4 NOT NULL,
+       CONSTRAINT heartbeat_counts_pk PRIMARY KEY (heartbeat_ts)
+);
+
+-- Rollups of heartbeat_counts; online_sum / samples is the average
+CREATE TABLE public.heartbeat_rollup_hourly (
+       bucket_ts TIMESTAMP(0) NOT NULL,
+       online_max int4 NOT NULL,
+       online_sum int8 NOT NULL,
+       samples int4 NOT NULL,
+       CONSTRAINT heartbeat_rollup_hourly_pk PRIMARY KEY (bucket_ts)
+);
+
+CREATE TABLE public.heartbeat_rollup_daily (
+       bucket_ts DATE NOT NULL,
+       online_max int4 NOT NULL,
+       online_sum int8 NOT NULL,
+       samples int4 NOT NULL,
+       devices_seen int4 NOT NULL,  -- distinct devices logged during the day
+       CONSTRAINT heartbeat_rollup_daily_pk PRIMARY KEY (bucket_ts)
+);
+
+-- Existing rows go to the default partition; maintenance.py moves them
+-- into daily partitions (or purges them) on its next run.
+INSERT INTO public.heartbeat_log SELECT device_id, heartbeat_ts FROM public.heartbeat_log_legacy;
+
+INSERT INTO public.heartbeat_counts (heartbeat_ts, online)
+SELECT heartbeat_ts, COUNT(device_id)
+  FROM public.heartbeat_log_legacy
+ GROUP BY heartbeat_ts;
+
+DROP TABLE public.heartbeat_log_legacy;
+
+COMMIT;
@@ -0,0 +1,32 @@
+--------------------
+-- Per-device availability
+--------------------
+
+-- Per-device availability, summarized incrementally from heartbeat_log by maintenance.py
+CREATE TABLE public.device_availability (
+       device_id int4 NOT NULL,
+       last_logged_ts TIMESTAMP(0) NOT NULL,  -- latest heartbeat_log bucket summarized
+       CONSTRAINT device_availability_pk PRIMARY KEY (device_id),
+       CONSTRAINT device_availability_fk_device_id FOREIGN KEY (device_id) REFERENCES public.devices(device_id) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+CREATE TABLE public.device_uptime_hourly (
+       device_id int4 NOT NULL,
+       hour_ts TIMESTAMP(0) NOT NULL,
+       buckets int4 NOT NULL,  -- heartbeat_log buckets logged during the hour
+       CONSTRAINT device_uptime_hourly_pk PRIMARY KEY (device_id, hour_ts),
+       CONSTRAINT device_uptime_hourly_fk_device_id FOREIGN KEY (device_id) REFERENCES public.devices(device_id) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+CREATE INDEX device_uptime_hourly_ts_idx ON public.device_uptime_hourly (hour_ts);
+
+-- Runs of missing heartbeat_log buckets: [started_at, ended_at)
+CREATE TABLE public.device_outages (
+       device_id int4 NOT NULL,
+       started_at TIMESTAMP(0) NOT NULL,
+       ended_at TIMESTAMP(0) NOT NULL,
+       CONSTRAINT device_outages_pk PRIMARY KEY (device_id, started_at),
+       CONSTRAINT device_outages_fk_device_id FOREIGN KEY (device_id) REFERENCES public.devices(device_id) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+CREATE INDEX device_outages_ended_at_idx ON public.device_outages (ended_at);
@@ -0,0 +1,39 @@
+--------------------
+-- Structured nvidia-smi reports
+-- (filled as devices send their next report)
+--------------------
+
+-- GPUs and GPU processes parsed from nvidia-smi reports (nvidia_smi.py), replaced as reports change
+CREATE TABLE public.gpu_metrics (
+       device_id int4 NOT NULL,
+       gpu_index int2 NOT NULL,
+       gpu_name VARCHAR(256) NOT NULL,
+       bus_id VARCHAR(32) NOT NULL,
+       fan_percent int2 NULL,
+       temperature_c int2 NULL,
+       perf_state VARCHAR(8) NULL,
+       power_draw_w REAL NULL,
+       power_limit_w REAL NULL,
+       memory_used_mib int4 NOT NULL,
+       memory_total_mib int4 NOT NULL,
+       memory_free_mib int4 GENERATED ALWAYS AS (memory_total_mib - memory_used_mib) STORED,
+       utilization_percent int2 NULL,
+       updated_at TIMESTAMP(0) NOT NULL,
+       CONSTRAINT gpu_metrics_pk PRIMARY KEY (device_id, gpu_index),
+       CONSTRAINT gpu_metrics_fk_device_id FOREIGN KEY (device_id) REFERENCES public.devices(device_id) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+CREATE INDEX gpu_metrics_memory_free_idx ON public.gpu_metrics (memory_free_mib);
+CREATE INDEX gpu_metrics_utilization_idx ON public.gpu_metrics (utilization_percent);
+
+CREATE TABLE public.gpu_processes (
+       device_id int4 NOT NULL,
+       gpu_index int2 NOT NULL,
+       pid int4 NOT NULL,
+       process_type VARCHAR(8) NOT NULL,
+       process_name VARCHAR(256) NOT NULL,
+       memory_mib int4 NULL,
+       CONSTRAINT gpu_processes_fk_device_id FOREIGN KEY (device_id) REFERENCES public.devices(device_id) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+CREATE INDEX gpu_processes_device_id_idx ON public.gpu_processes (device_id, gpu_index);
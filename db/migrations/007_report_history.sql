@@ -0,0 +1,19 @@
+--------------------
+-- Report history
+--------------------
+
+-- Reports over time (report_history.py): zlib-compressed keyframes, and line diffs against a keyframe
+CREATE TABLE public.report_history (
+       report_id BIGSERIAL NOT NULL,
+       device_id int4 NOT NULL,
+       recorded_at TIMESTAMP(0) NOT NULL,
+       keyframe_id int8 NULL,  -- NULL for keyframes
+       payload BYTEA NOT NULL,
+       CONSTRAINT report_history_pk PRIMARY KEY (report_id),
+       CONSTRAINT report_history_fk_device_id FOREIGN KEY (device_id) REFERENCES public.devices(device_id) ON DELETE CASCADE ON UPDATE CASCADE,
+       CONSTRAINT report_history_fk_keyframe_id FOREIGN KEY (keyframe_id) REFERENCES public.report_history(report_id) ON DELETE CASCADE
+);
+
+CREATE INDEX report_history_device_id_idx ON public.report_history (device_id, recorded_at);
+CREATE INDEX report_history_keyframe_id_idx ON public.report_history (keyframe_id);
+CREATE INDEX report_history_recorded_at_idx ON public.report_history (recorded_at);
@@ -0,0 +1,9 @@
+--------------------
+-- Hash of the last report
+--------------------
+
+ALTER TABLE public.devices
+  ADD COLUMN report_hash BYTEA NULL;  -- SHA-256 of report, to skip rewriting an unchanged one
+
+UPDATE public.devices
+   SET report_hash = sha256(convert_to(report, 'UTF8'));
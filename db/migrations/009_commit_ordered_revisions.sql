@@ -0,0 +1,13 @@
+--------------------
+-- Revisions are the IDs of the writing transactions
+--------------------
+
+ALTER TABLE public.devices
+  ALTER COLUMN revision SET DEFAULT txid_current();  -- writing transaction of the last visible change
+
+DROP SEQUENCE public.devices_revision_seq;
+
+-- Cursors handed out so far are sequence values; mark every device as changed after them.
+-- Those above the transaction IDs get a full response (see signals.py).
+UPDATE public.devices
+   SET revision = GREATEST(txid_current(), (SELECT MAX(revision) + 1 FROM public.devices));
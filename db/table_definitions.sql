@@ -7,12 +7,18 @@ CREATE TABLE public.devices (
        device_name VARCHAR(32) NOT NULL,
        last_heartbeat TIMESTAMP(0) NULL,
        report VARCHAR(4096) DEFAULT '' NOT NULL,
+       report_hash BYTEA NULL,  -- SHA-256 of report, to skip rewriting an unchanged one
        return_message VARCHAR(4096) DEFAULT '' NOT NULL,
        is_active BOOLEAN DEFAULT TRUE NOT NULL,
+       api_token_hash BYTEA NULL,  -- SHA-256 of the device's API token
+       revision BIGINT DEFAULT txid_current() NOT NULL,  -- writing transaction of the last visible change
        CONSTRAINT devices_pk PRIMARY KEY (device_id),
-       CONSTRAINT devices_un UNIQUE (device_name)
+       CONSTRAINT devices_un UNIQUE (device_name),
+       CONSTRAINT devices_api_token_un UNIQUE (api_token_hash)
 );
 
+CREATE INDEX devices_revision_idx ON public.devices (revision);
+
 CREATE TABLE public.jwt (
        secret CHAR(64) NOT NULL
 );
@@ -23,11 +29,130 @@ CREATE TABLE public.users (
        CONSTRAINT users_pk PRIMARY KEY (user_name)
 );
 
+-- Daily partitions (heartbeat_log_pYYYYMMDD) are created and dropped by maintenance.py;
+-- rows without a partition land in heartbeat_log_default.
 CREATE TABLE public.heartbeat_log (
        device_id int4 NOT NULL,
        heartbeat_ts TIMESTAMP(0) NOT NULL,
        CONSTRAINT heartbeat_log_pk PRIMARY KEY (device_id, heartbeat_ts),
        CONSTRAINT heartbeat_log_fk_device_id FOREIGN KEY (device_id) REFERENCES public.devices(device_id) ON DELETE CASCADE ON UPDATE CASCADE
+) PARTITION BY RANGE (heartbeat_ts);
+
+CREATE TABLE public.heartbeat_log_default PARTITION OF public.heartbeat_log DEFAULT;
+
+CREATE INDEX heartbeat_log_ts_idx ON public.heartbeat_log (heartbeat_ts);
+
+-- Devices online per heartbeat_log bucket, counted as rows are inserted
+CREATE TABLE public.heartbeat_counts (
+       heartbeat_ts TIMESTAMP(0) NOT NULL,
+       online int4 NOT NULL,
+       CONSTRAINT heartbeat_counts_pk PRIMARY KEY (heartbeat_ts)
+);
+
+-- Rollups of heartbeat_counts; online_sum / samples is the average
+CREATE TABLE public.heartbeat_rollup_hourly (
+       bucket_ts TIMESTAMP(0) NOT NULL,
+       online_max int4 NOT NULL,
+       online_sum int8 NOT NULL,
+       samples int4 NOT NULL,
+       CONSTRAINT heartbeat_rollup_hourly_pk PRIMARY KEY (bucket_ts)
+);
+
+CREATE TABLE public.heartbeat_rollup_daily (
+       bucket_ts DATE NOT NULL,
+       online_max int4 NOT NULL,
+       online_sum int8 NOT NULL,
+       samples int4 NOT NULL,
+       devices_seen int4 NOT NULL,  -- distinct devices logged during the day
+       CONSTRAINT heartbeat_rollup_daily_pk PRIMARY KEY (bucket_ts)
+);
+
+-- Per-device availability, summarized incrementally from heartbeat_log by maintenance.py
+CREATE TABLE public.device_availability (
+       device_id int4 NOT NULL,
+       last_logged_ts TIMESTAMP(0) NOT NULL,  -- latest heartbeat_log bucket summarized
+       CONSTRAINT device_availability_pk PRIMARY KEY (device_id),
+       CONSTRAINT device_availability_fk_device_id FOREIGN KEY (device_id) REFERENCES public.devices(device_id) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+CREATE TABLE public.device_uptime_hourly (
+       device_id int4 NOT NULL,
+       hour_ts TIMESTAMP(0) NOT NULL,
+       buckets int4 NOT NULL,  -- heartbeat_log buckets logged during the hour
+       CONSTRAINT device_uptime_hourly_pk PRIMARY KEY (device_id, hour_ts),
+       CONSTRAINT device_uptime_hourly_fk_device_id FOREIGN KEY (device_id) REFERENCES public.devices(device_id) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+CREATE INDEX device_uptime_hourly_ts_idx ON public.device_uptime_hourly (hour_ts);
+
+-- Runs of missing heartbeat_log buckets: [started_at, ended_at)
+CREATE TABLE public.device_outages (
+       device_id int4 NOT NULL,
+       started_at TIMESTAMP(0) NOT NULL,
+       ended_at TIMESTAMP(0) NOT NULL,
+       CONSTRAINT device_outages_pk PRIMARY KEY (device_id, started_at),
+       CONSTRAINT device_outages_fk_device_id FOREIGN KEY (device_id) REFERENCES public.devices(device_id) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+CREATE INDEX device_outages_ended_at_idx ON public.device_outages (ended_at);
+
+-- GPUs and GPU processes parsed from nvidia-smi reports (nvidia_smi.py), replaced as reports change
+CREATE TABLE public.gpu_metrics (
+       device_id int4 NOT NULL,
+       gpu_index int2 NOT NULL,
+       gpu_name VARCHAR(256) NOT NULL,
+       bus_id VARCHAR(32) NOT NULL,
+       fan_percent int2 NULL,
+       temperature_c int2 NULL,
+       perf_state VARCHAR(8) NULL,
+       power_draw_w REAL NULL,
+       power_limit_w REAL NULL,
+       memory_used_mib int4 NOT NULL,
+       memory_total_mib int4 NOT NULL,
+       memory_free_mib int4 GENERATED ALWAYS AS (memory_total_mib - memory_used_mib) STORED,
+       utilization_percent int2 NULL,
+       updated_at TIMESTAMP(0) NOT NULL,
+       CONSTRAINT gpu_metrics_pk PRIMARY KEY (device_id, gpu_index),
+       CONSTRAINT gpu_metrics_fk_device_id FOREIGN KEY (device_id) REFERENCES public.devices(device_id) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+CREATE INDEX gpu_metrics_memory_free_idx ON public.gpu_metrics (memory_free_mib);
+CREATE INDEX gpu_metrics_utilization_idx ON public.gpu_metrics (utilization_percent);
+
+CREATE TABLE public.gpu_processes (
+       device_id int4 NOT NULL,
+       gpu_index int2 NOT NULL,
+       pid int4 NOT NULL,
+       process_type VARCHAR(8) NOT NULL,
+       process_name VARCHAR(256) NOT NULL,
+       memory_mib int4 NULL,
+       CONSTRAINT gpu_processes_fk_device_id FOREIGN KEY (device_id) REFERENCES public.devices(device_id) ON DELETE CASCADE ON UPDATE CASCADE
+);
+
+CREATE INDEX gpu_processes_device_id_idx ON public.gpu_processes (device_id, gpu_index);
+
+-- Reports over time (report_history.py): zlib-compressed keyframes, and line diffs against a keyframe
+CREATE TABLE public.report_history (
+       report_id BIGSERIAL NOT NULL,
+       device_id int4 NOT NULL,
+       recorded_at TIMESTAMP(0) NOT NULL,
+       keyframe_id int8 NULL,  -- NULL for keyframes
+       payload BYTEA NOT NULL,
+       CONSTRAINT report_history_pk PRIMARY KEY (report_id),
+       CONSTRAINT report_history_fk_device_id FOREIGN KEY (device_id) REFERENCES public.devices(device_id) ON DELETE CASCADE ON UPDATE CASCADE,
+       CONSTRAINT report_history_fk_keyframe_id FOREIGN KEY (keyframe_id) REFERENCES public.report_history(report_id) ON DELETE CASCADE
+);
+
+CREATE INDEX report_history_device_id_idx ON public.report_history (device_id, recorded_at);
+CREATE INDEX report_history_keyframe_id_idx ON public.report_history (keyframe_id);
+CREATE INDEX report_history_recorded_at_idx ON public.report_history (recorded_at);
+
+CREATE TABLE public.maintenance_runs (
+       task_name VARCHAR(64) NOT NULL,
+       last_run_at TIMESTAMP(0) NOT NULL,
+       last_finished_at TIMESTAMP(0) NULL,
+       last_rows INT8 NULL,  -- rows processed by the last run
+       CONSTRAINT maintenance_runs_pk PRIMARY KEY (task_name)
 );
 
 
@@ -74,6 +199,11 @@ INSERT INTO public.heartbeat_log (device_id, heartbeat_ts) VALUES
        (3, current_timestamp),
        (4, '2021-03-12 23:30:00');
 
+INSERT INTO public.heartbeat_counts (heartbeat_ts, online)
+SELECT heartbeat_ts, COUNT(device_id)
+  FROM public.heartbeat_log
+ GROUP BY heartbeat_ts;
+
 INSERT INTO public.jwt VALUES
        ('cc125635c56e2b29e842b7c520a5304eda31c3f0d409c09a911bcc5e742dcd60');
 
@@ -0,0 +1,298 @@
+import collections
+import hashlib
+import hmac
+import ipaddress
+import os
+import secrets
+import threading
+import time
+from typing import Optional
+
+from passlib.context import CryptContext
+
+import async_db
+from ttl_cache import TTLCache
+
+
+"""
+Authentication of devices posting heartbeats
+
+Devices authenticate either with their own API token or with the shared
+password.
+
+Tokens are random, so a single SHA-256 is enough to store them; the digest
+is looked up in an in-memory index that also tells which device is calling.
+
+bcrypt is deliberately slow, so successful password verifications are
+remembered for a while, keyed by an HMAC of the submitted password under a
+per-process random key (the plain password is never kept in memory).
+Failed attempts always pay the full bcrypt cost and are rate-limited per client.
+
+The client is the address of the peer. X-Forwarded-For is honoured only when
+the peer is one of DEVICE_AUTH_TRUSTED_PROXIES (comma-separated addresses or
+networks; `*` trusts any peer for a single hop, as behind the Heroku router),
+otherwise anyone could pick a new address for every attempt.
+
+"""
+hashed_api_password = b'$2b$12$3jMfq3IMzFOzJ.LqXiaelOBKbU4A7n.LyBKNAR39lTyKF44WcPscK'
+pw_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+CACHE_TTL_SECONDS = float(os.environ.get('DEVICE_AUTH_CACHE_TTL_SECONDS') or 600)
+CACHE_MAX_SIZE = int(os.environ.get('DEVICE_AUTH_CACHE_MAX_SIZE') or 1024)
+MAX_FAILURES = int(os.environ.get('DEVICE_AUTH_MAX_FAILURES') or 10)
+FAILURE_WINDOW_SECONDS = float(os.environ.get('DEVICE_AUTH_FAILURE_WINDOW_SECONDS') or 60)
+MAX_CLIENTS = int(os.environ.get('DEVICE_AUTH_MAX_CLIENTS') or 10000)
+
+
+def parse_trusted_proxies(text: str) -> list:
+    """
+    :return: networks, or ['*']
+    """
+    proxies = [item.strip() for item in text.split(',') if item.strip()]
+    if '*' in proxies:
+        return ['*']
+    return [ipaddress.ip_network(item, strict=False) for item in proxies]
+
+
+TRUSTED_PROXIES = parse_trusted_proxies(os.environ.get('DEVICE_AUTH_TRUSTED_PROXIES') or '')
+
+
+class RateLimitedError(Exception):
+    pass
+
+
+class VerificationCache(TTLCache):
+    """
+    Bounded LRU of successfully verified password digests, each valid for `ttl` seconds.
+
+    """
+    def __init__(self, max_size: int = CACHE_MAX_SIZE, ttl: float = CACHE_TTL_SECONDS) -> None:
+        super().__init__(max_size, ttl)
+        self._key = secrets.token_bytes(32)
+
+    def digest(self, password: str) -> bytes:
+        return hmac.new(self._key, password.encode(), hashlib.sha256).digest()
+
+    def contains(self, digest: bytes) -> bool:
+        return self.get(digest) is not None
+
+    def add(self, digest: bytes) -> None:
+        self.put(digest, True)
+
+
+class FailureRateLimiter:
+    """
+    Sliding-window count of failed attempts per client.
+
+    At most `max_clients` clients with failures in the window are tracked.
+    When all of them are, further clients are rejected until some windows
+    expire (fail closed): evicting offenders would give them a clean slate.
+
+    """
+    def __init__(self, max_failures: int = MAX_FAILURES, window: float = FAILURE_WINDOW_SECONDS,
+                 max_clients: int = MAX_CLIENTS) -> None:
+        self.max_failures = max_failures
+        self.window = window
+        self.max_clients = max_clients
+        self._failures: collections.OrderedDict[str, collections.deque] = collections.OrderedDict()  # by last failure
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.rejected = 0
+
+    def _prune(self, now: float) -> None:
+        while self._failures:
+            client, attempts = next(iter(self._failures.items()))
+            if attempts[-1] >= now - self.window:
+                break
+            del self._failures[client]
+
+    def _recent(self, client: str, now: float) -> collections.deque:
+        attempts = self._failures.get(client)
+        if attempts is None:
+            return collections.deque()
+        while attempts and attempts[0] < now - self.window:
+            attempts.popleft()
+        if not attempts:
+            del self._failures[client]
+        return attempts
+
+    def _is_full(self, client: str) -> bool:
+        return client not in self._failures and len(self._failures) >= self.max_clients
+
+    def is_limited(self, client: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            limited = len(self._recent(client, now)) >= self.max_failures or self._is_full(client)
+            if limited:
+                self.rejected += 1
+            return limited
+
+    def record_failure(self, client: str) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self.failures += 1
+            self._prune(now)
+            if self._is_full(client):
+                return
+            attempts = self._recent(client, now)
+            attempts.append(now)
+            self._failures[client] = attempts
+            self._failures.move_to_end(client)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'clients': len(self._failures),
+                'max_clients': self.max_clients,
+                'max_failures': self.max_failures,
+                'window': self.window,
+                'failures': self.failures,
+                'rejected': self.rejected,
+            }
+
+
+class DeviceTokenIndex:
+    """
+    Token digest -> (device_id, device_name) of every device holding a token.
+
+    """
+    def __init__(self) -> None:
+        self._devices: dict[bytes, tuple[int, str]] = {}
+        self._digests: dict[int, bytes] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, rows: list[tuple[int, str, bytes]]) -> None:
+        """
+        Replace the index with rows of (device_id, device_name, api_token_hash).
+
+        """
+        self._devices = {bytes(digest): (device_id, name) for device_id, name, digest in rows}
+        self._digests = {device_id: digest for digest, (device_id, _) in self._devices.items()}
+
+    def get(self, digest: bytes) -> Optional[tuple[int, str]]:
+        device = self._devices.get(digest)
+        if device is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return device
+
+    def add(self, digest: bytes, device_id: int, device_name: str) -> None:
+        self.remove(device_id)
+        self._devices[digest] = (device_id, device_name)
+        self._digests[device_id] = digest
+
+    def remove(self, device_id: int) -> None:
+        digest = self._digests.pop(device_id, None)
+        if digest is not None:
+            self._devices.pop(digest, None)
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._devices),
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+verification_cache = VerificationCache()
+rate_limiter = FailureRateLimiter()
+token_index = DeviceTokenIndex()
+
+
+def token_digest(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+
+def issue_token() -> tuple[str, bytes]:
+    """
+    :return: new API token and the digest to store
+    """
+    token = secrets.token_urlsafe(32)
+    return token, token_digest(token)
+
+
+def _is_trusted(address: str, trusted: list) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in trusted)
+
+
+def client_address(peer: str, forwarded_for: Optional[str], trusted: Optional[list] = None) -> str:
+    """
+    :param peer: address of the TCP peer
+    :param forwarded_for: X-Forwarded-For header, if any
+    :param trusted: TRUSTED_PROXIES by default
+    :return: address the client is rate-limited by
+    """
+    trusted = TRUSTED_PROXIES if trusted is None else trusted
+    if not forwarded_for or not trusted:
+        return peer
+    hops = [hop.strip() for hop in forwarded_for.split(',') if hop.strip()]
+    if trusted == ['*']:
+        return hops[-1] if hops else peer
+    if not _is_trusted(peer, trusted):
+        return peer
+    # Walk back through our own proxies; the first other hop is the client
+    while len(hops) > 1 and _is_trusted(hops[-1], trusted):
+        hops.pop()
+    return hops[-1] if hops else peer
+
+
+def is_verified(password: str, client: str) -> bool:
+    """
+    Cheap check answered from the cache; never runs bcrypt.
+
+    :return: True if the password has been verified recently.
+    """
+    check_rate_limit(client)
+    return verification_cache.contains(verification_cache.digest(password))
+
+
+def verify_api_password(password: str, client: str) -> bool:
+    """
+    Full bcrypt verification (blocking, ~0.2 s); the result is cached on success.
+
+    """
+    if pw_context.verify(password, hashed_api_password):
+        verification_cache.add(verification_cache.digest(password))
+        return True
+    rate_limiter.record_failure(client)
+    return False
+
+
+def check_rate_limit(client: str) -> None:
+    if rate_limiter.is_limited(client):
+        raise RateLimitedError('too many failed attempts from %s' % client)
+
+
+def stats() -> dict:
+    return {
+        'cache': verification_cache.stats(),
+        'rate_limiter': rate_limiter.stats(),
+        'token_index': token_index.stats(),
+    }
+
+
+async def find_device_by_token(token: str, client: str) -> Optional[tuple[int, str]]:
+    """
+    Identify a device by its API token without touching bcrypt.
+    The database is consulted only for tokens missing from the index
+    (e.g. issued by another worker).
+
+    :return: (device_id, device_name), or None if the token is invalid.
+    """
+    check_rate_limit(client)
+    digest = token_digest(token)
+    device = token_index.get(digest)
+    if device is None:
+        device = await async_db.select_device_by_token(digest)
+        if device is None:
+            rate_limiter.record_failure(client)
+            return None
+        token_index.add(digest, *device)
+    return device
@@ -0,0 +1,229 @@
+import heapq
+import os
+import random
+import threading
+import time
+from typing import Optional
+
+from db import Device, report_digest
+
+
+"""
+Fleet aggregates maintained incrementally
+
+Counts of devices, available (is_active) devices and alive devices
+(heartbeat within the last 24 hours) are updated as heartbeats and
+is_active changes arrive, so reading them is O(1).
+
+Every alive device has a deadline (last heartbeat + 24 hours) in a min-heap.
+When the clock passes a deadline the device stops being alive.
+A heartbeat pushes a new deadline and leaves the old entry in the heap,
+where it is recognised as stale when popped (lazy deletion).
+The heap is rebuilt when stale entries outnumber live ones.
+
+The database stays the source of truth: the counters are loaded from
+`devices` and reloaded every FLEET_STATS_RESYNC_SECONDS to pick up
+changes made outside this process.
+
+"""
+ALIVE_SECONDS = 24 * 60 * 60
+RESYNC_SECONDS = float(os.environ.get('FLEET_STATS_RESYNC_SECONDS') or 300)
+SAME_REPORT_MARKER = '#same'  # sent instead of a report identical to the previous one
+
+
+class UnknownReportError(Exception):
+    pass
+
+
+class _DeviceState:
+    __slots__ = ('last_heartbeat', 'deadline', 'is_active', 'report', 'report_hash')
+
+    def __init__(self, last_heartbeat: Optional[float], is_active: bool, report: str) -> None:
+        self.last_heartbeat = last_heartbeat
+        self.deadline: Optional[float] = None  # set while the device is counted as alive
+        self.is_active = is_active
+        self.report = report
+        self.report_hash: Optional[bytes] = None  # digest of report, computed on first use
+
+
+class FleetStats:
+    def __init__(self) -> None:
+        self._devices: dict[str, _DeviceState] = {}
+        self._deadlines: list[tuple[float, str]] = []
+        self._alive = 0
+        self._available = 0
+        self._lock = threading.Lock()
+        self.loaded_at: Optional[float] = None
+        self.expired = 0
+        self.compactions = 0
+
+    @classmethod
+    def from_devices(cls, devices: list[Device], now: Optional[float] = None) -> "FleetStats":
+        fleet = cls()
+        fleet.load(devices, now)
+        return fleet
+
+    @property
+    def loaded(self) -> bool:
+        return self.loaded_at is not None
+
+    def needs_resync(self, max_age: float = RESYNC_SECONDS) -> bool:
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > max_age
+
+    def load(self, devices: list[Device], now: Optional[float] = None) -> None:
+        """
+        Replace every counter with the state of `devices`.
+
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._devices = {}
+            self._deadlines = []
+            self._alive = 0
+            self._available = 0
+            for device in devices:
+                last_heartbeat = device.last_heartbeat_timestamp
+                state = _DeviceState(
+                    last_heartbeat.timestamp() if last_heartbeat is not None else None,
+                    device.is_active,
+                    device.report,
+                )
+                self._devices[device.device_name] = state
+                self._available += state.is_active
+                self._revive(device.device_name, state, now)
+            heapq.heapify(self._deadlines)
+            self.loaded_at = time.monotonic()
+
+    def register(self, device_name: str, is_active: bool = True) -> None:
+        with self._lock:
+            if device_name not in self._devices:
+                self._devices[device_name] = _DeviceState(None, is_active, '')
+                self._available += is_active
+
+    def heartbeat(self, device_name: str, report: Optional[str], at: Optional[float] = None) -> None:
+        at = time.time() if at is None else at
+        with self._lock:
+            state = self._devices.get(device_name)
+            if state is None:  # registered elsewhere
+                state = self._devices[device_name] = _DeviceState(None, True, '')
+                self._available += 1
+            report = report if report is not None else ''
+            if report != state.report:
+                state.report, state.report_hash = report, None
+            if state.last_heartbeat is not None and at <= state.last_heartbeat:
+                return
+            state.last_heartbeat = at
+            self._expire(at)
+            self._revive(device_name, state, at, push=True)
+
+    def set_active(self, device_name: str, is_active: bool) -> None:
+        with self._lock:
+            state = self._devices.get(device_name)
+            if state is not None and state.is_active != is_active:
+                state.is_active = is_active
+                self._available += 1 if is_active else -1
+
+    def _revive(self, device_name: str, state: _DeviceState, now: float, push: bool = False) -> None:
+        if state.last_heartbeat is None:
+            return
+        deadline = state.last_heartbeat + ALIVE_SECONDS
+        if deadline <= now:
+            return
+        if state.deadline is None:
+            self._alive += 1
+        state.deadline = deadline
+        if push:
+            heapq.heappush(self._deadlines, (deadline, device_name))
+            if len(self._deadlines) > 2 * len(self._devices) + 64:
+                self._compact()
+        else:
+            self._deadlines.append((deadline, device_name))
+
+    def _expire(self, now: float) -> None:
+        while self._deadlines and self._deadlines[0][0] <= now:
+            deadline, device_name = heapq.heappop(self._deadlines)
+            state = self._devices.get(device_name)
+            if state is not None and state.deadline == deadline:  # otherwise superseded
+                state.deadline = None
+                self._alive -= 1
+                self.expired += 1
+
+    def _compact(self) -> None:
+        self._deadlines = [
+            (state.deadline, device_name)
+            for device_name, state in self._devices.items()
+            if state.deadline is not None
+        ]
+        heapq.heapify(self._deadlines)
+        self.compactions += 1
+
+    def alive_n(self, now: Optional[float] = None) -> int:
+        with self._lock:
+            self._expire(time.time() if now is None else now)
+            return self._alive
+
+    def available_n(self) -> int:
+        return self._available
+
+    def device_n(self) -> int:
+        return len(self._devices)
+
+    def report(self, device_name: str) -> Optional[str]:
+        state = self._devices.get(device_name)
+        return state.report if state is not None else None
+
+    def report_hash(self, device_name: str) -> Optional[bytes]:
+        """
+        :return: report_digest() of the last report of the device
+        """
+        state = self._devices.get(device_name)
+        if state is None:
+            return None
+        if state.report_hash is None:
+            state.report_hash = report_digest(state.report)
+        return state.report_hash
+
+    def resolve_report(self, device_name: str, report: Optional[str]) -> tuple[str, Optional[str], Optional[bytes]]:
+        """
+        :param report: report, or SAME_REPORT_MARKER when it is the same as the previous one
+        :return: (report, report to write or None if known to be unchanged, its hash or None if not sent)
+        :raise UnknownReportError: SAME_REPORT_MARKER, but no heartbeat of the device is known;
+            the client has to send the full report
+        """
+        if report == SAME_REPORT_MARKER:
+            state = self._devices.get(device_name)
+            if state is None or state.last_heartbeat is None:
+                raise UnknownReportError(device_name)
+            return state.report, None, None
+        report = report if report is not None else ''
+        digest = report_digest(report)
+        return report, report if digest != self.report_hash(device_name) else None, digest
+
+    def random_device_name(self) -> str:
+        with self._lock:
+            if not self._devices:
+                return ''
+            return random.choice(list(self._devices))
+
+    def summary(self, now: Optional[float] = None) -> dict:
+        alives = self.alive_n(now)
+        devices = self.device_n()
+        return {
+            'devices': devices,
+            'alives': alives,
+            'deads': devices - alives,
+            'available_devices': self.available_n(),
+        }
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'devices': len(self._devices),
+                'heap_size': len(self._deadlines),
+                'expired': self.expired,
+                'compactions': self.compactions,
+                'age': time.monotonic() - self.loaded_at if self.loaded_at is not None else None,
+            }
+
+
+fleet_stats = FleetStats()
@@ -0,0 +1,62 @@
+import json
+import os
+from typing import Optional
+
+
+"""
+Body of /api/v2/heartbeats, heartbeats relayed by a gateway for many devices
+
+Either application/json:
+
+    {"heartbeats": [{"device_name": "SMC101", "report": "..."}, ...]}
+
+or application/x-ndjson, one heartbeat per line:
+
+    {"device_name": "SMC101", "report": "..."}
+    {"device_name": "GPU480", "report": "#same"}
+
+`report` may be omitted or null. "#same" stands for the previous report of the
+device; when that is not known, the heartbeat gets status 409 and has to be
+sent again with its report. The response has one
+{"device_name", "status", "content"} per heartbeat, in the same order and
+format. A batch holds at most HEARTBEAT_BATCH_MAX_SIZE heartbeats.
+
+"""
+MAX_SIZE = int(os.environ.get('HEARTBEAT_BATCH_MAX_SIZE') or 1000)
+NDJSON = 'application/x-ndjson'
+
+
+def _entry(i: int, item) -> tuple[str, Optional[str]]:
+    if not isinstance(item, dict):
+        raise ValueError('heartbeat %d: must be an object' % i)
+    device_name, report = item.get('device_name'), item.get('report')
+    if not isinstance(device_name, str) or not device_name:
+        raise ValueError('heartbeat %d: device_name must be a string' % i)
+    if report is not None and not isinstance(report, str):
+        raise ValueError('heartbeat %d: report must be a string or null' % i)
+    return device_name, report
+
+
+def parse(body: bytes, ndjson: bool, max_size: int = MAX_SIZE) -> list[tuple[str, Optional[str]]]:
+    """
+    :return: list of (device_name, report)
+    """
+    try:
+        if ndjson:
+            items = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            document = json.loads(body)
+            items = document.get('heartbeats') if isinstance(document, dict) else None
+            if not isinstance(items, list):
+                raise ValueError('heartbeats must be a list')
+    except json.JSONDecodeError as e:
+        raise ValueError('invalid JSON: %s' % e)
+    if len(items) > max_size:
+        raise ValueError('too many heartbeats; at most %d per request' % max_size)
+    return [_entry(i, item) for i, item in enumerate(items)]
+
+
+def encode(results: list[dict], ndjson: bool) -> bytes:
+    if ndjson:
+        return b''.join(json.dumps(result, ensure_ascii=False).encode() + b'\n' for result in results)
+    return json.dumps({'results': results}, ensure_ascii=False).encode()
@@ -0,0 +1,115 @@
+import asyncio
+import datetime
+import logging
+import os
+from typing import Awaitable, Callable, Optional
+
+import async_db
+from db import heartbeat_log_bucket
+
+
+"""
+Write-behind of heartbeat_log
+
+A device heartbeats many times per bucket but is logged once per bucket.
+The set of devices already logged in the current bucket answers the
+repeated heartbeats without touching the database; the first heartbeat of
+each device is buffered and written in batches by a multi-row
+INSERT ... ON CONFLICT DO NOTHING.
+
+The buffer is flushed every HEARTBEAT_LOG_FLUSH_SECONDS, as soon as it
+holds HEARTBEAT_LOG_BATCH_SIZE rows, and on shutdown. A crash loses at most
+one flush interval of log rows (last_heartbeat of devices is written
+behind the same way by heartbeat_table).
+
+"""
+FLUSH_SECONDS = float(os.environ.get('HEARTBEAT_LOG_FLUSH_SECONDS') or 5)
+BATCH_SIZE = int(os.environ.get('HEARTBEAT_LOG_BATCH_SIZE') or 500)
+MAX_PENDING = 100000  # rows kept while the database is unreachable
+
+logger = logging.getLogger(__name__)
+
+
+class HeartbeatLogWriter:
+    def __init__(self,
+                 insert: Callable[[list[tuple[int, datetime.datetime]]], Awaitable[None]] = async_db.insert_heartbeat_logs,
+                 flush_seconds: float = FLUSH_SECONDS, batch_size: int = BATCH_SIZE) -> None:
+        self.insert = insert
+        self.flush_seconds = flush_seconds
+        self.batch_size = batch_size
+        self.bucket: Optional[datetime.datetime] = None
+        self._logged: set[int] = set()
+        self._pending: list[tuple[int, datetime.datetime]] = []
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.deduplicated = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.failures = 0
+        self.dropped = 0
+
+    def add(self, device_id: int, bucket: Optional[datetime.datetime] = None) -> bool:
+        """
+        Log a heartbeat of the device in `bucket` (the current one by default).
+
+        :return: False if the device has already been logged in the bucket
+        """
+        bucket = heartbeat_log_bucket() if bucket is None else bucket
+        if bucket != self.bucket:
+            self.bucket = bucket
+            self._logged = set()
+        if device_id in self._logged:
+            self.deduplicated += 1
+            return False
+        self._logged.add(device_id)
+        self._pending.append((device_id, bucket))
+        if len(self._pending) >= self.batch_size and not self._flush_lock.locked():
+            asyncio.get_event_loop().create_task(self.flush())
+        return True
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            while self._pending:
+                rows, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+                try:
+                    await self.insert(rows)
+                except Exception:
+                    self.failures += 1
+                    logger.exception('failed to write %d heartbeat_log rows; retrying later', len(rows))
+                    self._pending = rows + self._pending
+                    if len(self._pending) > MAX_PENDING:
+                        self.dropped += len(self._pending) - MAX_PENDING
+                        self._pending = self._pending[-MAX_PENDING:]
+                    return
+                self.flushed += len(rows)
+                self.flushes += 1
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            await self.flush()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            'bucket': str(self.bucket) if self.bucket is not None else None,
+            'logged': len(self._logged),
+            'pending': len(self._pending),
+            'deduplicated': self.deduplicated,
+            'flushed': self.flushed,
+            'flushes': self.flushes,
+            'failures': self.failures,
+            'dropped': self.dropped,
+        }
+
+
+heartbeat_log_writer = HeartbeatLogWriter()
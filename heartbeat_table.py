@@ -0,0 +1,134 @@
+import asyncio
+import datetime
+import logging
+import os
+from typing import Awaitable, Callable, Optional
+
+import async_db
+from db import HEARTBEAT_WRITE_RESOLUTION_SECONDS, Device, gmt2jst
+
+
+"""
+Write-behind of devices.last_heartbeat
+
+Heartbeats only record their time here: the latest heartbeat of each device
+by name, and the ones not written yet by device_id. Pending ones are written
+every HEARTBEAT_TABLE_FLUSH_SECONDS (HEARTBEAT_WRITE_RESOLUTION_SECONDS by
+default), as soon as HEARTBEAT_TABLE_BATCH_SIZE devices are pending, and on
+shutdown, by a single UPDATE ... FROM unnest(...) per batch.
+A crash loses at most one flush interval of last_heartbeat.
+
+Readers of devices go through read_through(), which puts back the newer
+times known here, including heartbeats of other workers seen as events.
+Timestamps are naive local time, as stored in devices.
+
+"""
+FLUSH_SECONDS = float(os.environ.get('HEARTBEAT_TABLE_FLUSH_SECONDS') or HEARTBEAT_WRITE_RESOLUTION_SECONDS)
+BATCH_SIZE = int(os.environ.get('HEARTBEAT_TABLE_BATCH_SIZE') or 1000)
+
+logger = logging.getLogger(__name__)
+
+
+class HeartbeatTable:
+    def __init__(self,
+                 update: Callable[[list[tuple[int, datetime.datetime]]], Awaitable[None]] = async_db.update_last_heartbeats,
+                 flush_seconds: float = FLUSH_SECONDS, batch_size: int = BATCH_SIZE) -> None:
+        self.update = update
+        self.flush_seconds = flush_seconds
+        self.batch_size = batch_size
+        self._latest: dict[str, datetime.datetime] = {}
+        self._pending: dict[int, datetime.datetime] = {}
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self.touched = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.failures = 0
+
+    def touch(self, device_id: int, device_name: str, at: Optional[datetime.datetime] = None) -> datetime.datetime:
+        """
+        Record a heartbeat of the device, to be written later.
+
+        :return: time of the heartbeat
+        """
+        at = datetime.datetime.now().replace(microsecond=0) if at is None else at
+        self.observe(device_name, at)
+        if at > self._pending.get(device_id, datetime.datetime.min):
+            self._pending[device_id] = at
+        self.touched += 1
+        if len(self._pending) >= self.batch_size and not self._flush_lock.locked():
+            asyncio.get_event_loop().create_task(self.flush())
+        return at
+
+    def observe(self, device_name: str, at: datetime.datetime) -> None:
+        """
+        Record a heartbeat written by someone else (another worker).
+
+        """
+        if at > self._latest.get(device_name, datetime.datetime.min):
+            self._latest[device_name] = at
+
+    def last_heartbeat(self, device_name: str) -> Optional[datetime.datetime]:
+        return self._latest.get(device_name)
+
+    def read_through(self, devices: list[Device]) -> list[Device]:
+        """
+        Replace last_heartbeat_timestamp of `devices` (read from the database) by newer heartbeats known here.
+
+        :return: `devices`
+        """
+        for device in devices:
+            at = self._latest.get(device.device_name)
+            if at is None:
+                continue
+            at = gmt2jst(at)
+            if device.last_heartbeat_timestamp is None or device.last_heartbeat_timestamp < at:
+                device.last_heartbeat_timestamp = at
+        return devices
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            rows = sorted(pending.items())  # same lock order as other workers
+            for i in range(0, len(rows), self.batch_size):
+                try:
+                    await self.update(rows[i:i + self.batch_size])
+                except Exception:
+                    self.failures += 1
+                    logger.exception('failed to write last_heartbeat of %d devices; retrying later', len(rows) - i)
+                    for device_id, at in rows[i:]:
+                        if at > self._pending.get(device_id, datetime.datetime.min):
+                            self._pending[device_id] = at
+                    return
+                self.flushed += len(rows[i:i + self.batch_size])
+                self.flushes += 1
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_seconds)
+            await self.flush()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            'devices': len(self._latest),
+            'pending': len(self._pending),
+            'touched': self.touched,
+            'flushed': self.flushed,
+            'flushes': self.flushes,
+            'failures': self.failures,
+        }
+
+
+heartbeat_table = HeartbeatTable()
@@ -0,0 +1,114 @@
+import datetime
+import os
+import re
+from typing import Optional
+
+from db import HEARTBEAT_LOG_INTERVAL_MINUTES
+from maintenance import HEARTBEAT_COUNTS_RETENTION_DAYS, HEARTBEAT_ROLLUP_HOURLY_RETENTION_DAYS
+from ttl_cache import TTLCache
+
+
+"""
+Online device counts over an arbitrary range, resampled on the server
+
+The range [start, end) is cut into bins of `resolution` minutes (aligned on
+midnight when they divide a day). Each bin holds the maximum and the average number of devices online
+among its heartbeat_log buckets; buckets nobody logged count as 0, so the
+series has no gaps.
+
+The finest source that still covers `start` is read:
+heartbeat_counts (per bucket), then heartbeat_rollup_hourly, then
+heartbeat_rollup_daily. Ranges reaching back into the rollups need a
+resolution of whole hours (or days); finer bins are rejected, as they would
+all be empty. Rollups are refreshed by maintenance.py, so their latest bins
+may lag a few minutes behind.
+
+"""
+MAX_POINTS = int(os.environ.get('HISTORY_MAX_POINTS') or 2000)
+CACHE_TTL_SECONDS = float(os.environ.get('HISTORY_CACHE_TTL_SECONDS') or 60)
+DEFAULT_RANGE = datetime.timedelta(hours=24)
+
+_UNITS = {'m': 1, 'h': 60, 'd': 24 * 60}
+
+history_cache = TTLCache(64, CACHE_TTL_SECONDS)
+
+
+def parse_resolution(text: str, minute_interval: int = HEARTBEAT_LOG_INTERVAL_MINUTES) -> int:
+    """
+    :param text: minutes, or a number with a unit m/h/d such as '15m', '6h' or '1d'
+    :return: resolution in minutes
+    """
+    match = re.fullmatch(r'\s*(\d+)\s*([mhd]?)\s*', text)
+    if match is None:
+        raise ValueError('resolution must look like 60, 15m, 6h or 1d')
+    minutes = int(match.group(1)) * _UNITS.get(match.group(2) or 'm')
+    if minutes < minute_interval or minutes % minute_interval != 0:
+        raise ValueError('resolution must be a multiple of %d minutes' % minute_interval)
+    return minutes
+
+
+def to_local(dt: datetime.datetime) -> datetime.datetime:
+    """
+    :return: naive local time, as stored in heartbeat_log
+    """
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+    return dt
+
+
+def floor_time(dt: datetime.datetime, minutes: int) -> datetime.datetime:
+    """
+    :return: beginning of the bin of `minutes` minutes containing `dt`
+             (bins dividing a day are aligned on midnight)
+    """
+    step = datetime.timedelta(minutes=minutes)
+    return datetime.datetime.min + (dt - datetime.datetime.min) // step * step
+
+
+def choose_source(start: datetime.datetime, resolution: int, now: datetime.datetime) -> str:
+    """
+    :return: 'counts', 'hourly' or 'daily'
+    :raise ValueError: the source covering `start` has coarser bins than `resolution` fits in
+    """
+    if start >= now - datetime.timedelta(days=HEARTBEAT_COUNTS_RETENTION_DAYS):
+        return 'counts'
+    if resolution % 60 != 0:
+        raise ValueError('resolution must be a multiple of 60 minutes before %g days ago'
+                         % HEARTBEAT_COUNTS_RETENTION_DAYS)
+    if start >= now - datetime.timedelta(days=HEARTBEAT_ROLLUP_HOURLY_RETENTION_DAYS):
+        return 'hourly'
+    if resolution % (24 * 60) != 0:
+        raise ValueError('resolution must be a multiple of 1 day before %g days ago'
+                         % HEARTBEAT_ROLLUP_HOURLY_RETENTION_DAYS)
+    return 'daily'
+
+
+def plan(start: Optional[datetime.datetime], end: Optional[datetime.datetime], resolution: int,
+         now: Optional[datetime.datetime] = None) -> tuple[datetime.datetime, datetime.datetime, str]:
+    """
+    :return: (first bin, last bin, source) covering [start, end)
+    """
+    now = datetime.datetime.now() if now is None else now
+    end = now if end is None else to_local(end)
+    start = end - DEFAULT_RANGE if start is None else to_local(start)
+    if start >= end:
+        raise ValueError('start must be before end')
+
+    first = floor_time(start, resolution)
+    last = floor_time(end - datetime.timedelta(microseconds=1), resolution)
+    if (last - first) // datetime.timedelta(minutes=resolution) + 1 > MAX_POINTS:
+        raise ValueError('too many points; use a coarser resolution or a shorter range')
+    return first, last, choose_source(start, resolution, now)
+
+
+def to_columns(rows: list[tuple], resolution: int, minute_interval: int = HEARTBEAT_LOG_INTERVAL_MINUTES) -> dict:
+    """
+    :param rows: (bin, max online, sum of online over the buckets) from select_heartbeat_history
+    :return: parallel arrays of bins and counts
+    """
+    buckets_per_bin = resolution // minute_interval
+    return {
+        'ts': [row[0] for row in rows],
+        'online': [row[1] for row in rows],
+        'online_avg': [round(row[2] / buckets_per_bin, 2) for row in rows],
+    }
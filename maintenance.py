@@ -0,0 +1,281 @@
+import asyncio
+import datetime
+import logging
+import os
+import random
+import time
+from typing import Awaitable, Callable, Iterable, Optional
+
+import async_db
+from db import HEARTBEAT_LOG_INTERVAL_MINUTES
+import heartbeat_log_writer
+import report_history
+
+
+"""
+Background maintenance started with the app
+
+Every worker wakes up every MAINTENANCE_CHECK_SECONDS, but tasks run
+at most once per period across all workers and hosts:
+- a PostgreSQL advisory lock lets a single worker check and run tasks
+  at a time, and
+- maintenance_runs records when each task last ran, so a task that is
+  not due yet is skipped by whoever holds the lock.
+A failed run is retried after MAINTENANCE_RETRY_SECONDS, doubled after
+each further failure in a row, but never later than its next regular run.
+
+heartbeat_log is partitioned by day: partitions are created
+HEARTBEAT_LOG_PARTITIONS_AHEAD_DAYS in advance, and retention drops whole
+partitions. Rows left in the default partition (or in the partition of the
+cutoff day) are deleted in batches of MAINTENANCE_BATCH_SIZE rows with a pause
+in between, so retention never holds long locks or saturates the database.
+
+Hourly and daily rollups of heartbeat_counts are recomputed for the last
+HEARTBEAT_ROLLUP_LOOKBACK_DAYS days every HEARTBEAT_ROLLUP_PERIOD_SECONDS.
+heartbeat_counts and hourly rollups have retentions of their own; daily
+rollups are kept forever.
+
+report_history rows past their retention are deleted in batches too.
+
+New heartbeat_log rows are folded into the per-device availability tables
+every DEVICE_AVAILABILITY_PERIOD_SECONDS (see availability.py). The last
+bucket and HEARTBEAT_LOG_FLUSH_SECONDS before the latest folded row are
+folded again, for rows the write-behind of other workers logs late.
+
+"""
+CHECK_SECONDS = float(os.environ.get('MAINTENANCE_CHECK_SECONDS') or 60)
+RETRY_SECONDS = float(os.environ.get('MAINTENANCE_RETRY_SECONDS') or 60)
+BATCH_SIZE = int(os.environ.get('MAINTENANCE_BATCH_SIZE') or 5000)
+BATCH_PAUSE_SECONDS = float(os.environ.get('MAINTENANCE_BATCH_PAUSE_SECONDS') or 0.1)
+HEARTBEAT_LOG_RETENTION_DAYS = float(os.environ.get('HEARTBEAT_LOG_RETENTION_DAYS') or 7)
+HEARTBEAT_LOG_RETENTION_PERIOD_SECONDS = float(os.environ.get('HEARTBEAT_LOG_RETENTION_PERIOD_SECONDS') or 24 * 60 * 60)
+HEARTBEAT_LOG_PARTITIONS_AHEAD_DAYS = int(os.environ.get('HEARTBEAT_LOG_PARTITIONS_AHEAD_DAYS') or 3)
+HEARTBEAT_LOG_PARTITIONS_PERIOD_SECONDS = float(os.environ.get('HEARTBEAT_LOG_PARTITIONS_PERIOD_SECONDS') or 60 * 60)
+HEARTBEAT_COUNTS_RETENTION_DAYS = float(os.environ.get('HEARTBEAT_COUNTS_RETENTION_DAYS') or 90)
+HEARTBEAT_ROLLUP_HOURLY_RETENTION_DAYS = float(os.environ.get('HEARTBEAT_ROLLUP_HOURLY_RETENTION_DAYS') or 400)
+HEARTBEAT_ROLLUP_PERIOD_SECONDS = float(os.environ.get('HEARTBEAT_ROLLUP_PERIOD_SECONDS') or 15 * 60)
+HEARTBEAT_ROLLUP_LOOKBACK_DAYS = int(os.environ.get('HEARTBEAT_ROLLUP_LOOKBACK_DAYS') or 1)
+DEVICE_AVAILABILITY_PERIOD_SECONDS = float(os.environ.get('DEVICE_AVAILABILITY_PERIOD_SECONDS') or 5 * 60)
+DEVICE_AVAILABILITY_RETENTION_DAYS = float(os.environ.get('DEVICE_AVAILABILITY_RETENTION_DAYS') or 31)  # >= the longest window
+LOCK_KEY = 0x73746174  # arbitrary, shared by every worker
+
+logger = logging.getLogger(__name__)
+
+
+class MaintenanceTask:
+    def __init__(self, name: str, period: float, run: Callable[[], Awaitable[int]]) -> None:
+        """
+        :param period: seconds between runs
+        :param run: coroutine function returning the number of rows processed
+        """
+        self.name = name
+        self.period = period
+        self.run = run
+        self.runs = 0
+        self.errors = 0
+        self.failures_in_row = 0
+        self.rows = 0
+        self.last_rows: Optional[int] = None
+        self.last_duration: Optional[float] = None
+
+    def stats(self) -> dict:
+        return {
+            'period': self.period,
+            'runs': self.runs,
+            'errors': self.errors,
+            'failures_in_row': self.failures_in_row,
+            'rows': self.rows,
+            'last_rows': self.last_rows,
+            'last_duration': self.last_duration,
+        }
+
+
+class MaintenanceScheduler:
+    def __init__(self, tasks: list[MaintenanceTask], check_seconds: float = CHECK_SECONDS,
+                 retry_seconds: float = RETRY_SECONDS) -> None:
+        self.tasks = tasks
+        self.check_seconds = check_seconds
+        self.retry_seconds = retry_seconds
+        self._task: Optional[asyncio.Task] = None
+        self.checks = 0
+        self.lock_busy = 0
+
+    async def run_due(self) -> None:
+        """
+        Run the tasks due, unless another worker is already doing so.
+
+        """
+        self.checks += 1
+        async with async_db.advisory_lock(LOCK_KEY) as locked:
+            if not locked:
+                self.lock_busy += 1
+                return
+            for task in self.tasks:
+                if not await async_db.claim_maintenance_run(task.name, task.period):
+                    continue
+                begin = time.monotonic()
+                try:
+                    rows = await task.run()
+                except Exception:
+                    task.errors += 1
+                    task.failures_in_row += 1
+                    logger.exception('maintenance task %s failed', task.name)
+                    await async_db.retry_maintenance_run(task.name, task.period, self.retry_delay(task))
+                    continue
+                task.runs += 1
+                task.failures_in_row = 0
+                task.rows += rows
+                task.last_rows = rows
+                task.last_duration = time.monotonic() - begin
+                await async_db.finish_maintenance_run(task.name, rows)
+                logger.info('maintenance task %s processed %d rows in %.1f s', task.name, rows, task.last_duration)
+
+    def retry_delay(self, task: MaintenanceTask) -> float:
+        """
+        :return: seconds from a failed run of `task` to its next attempt
+        """
+        return min(self.retry_seconds * 2 ** (task.failures_in_row - 1), task.period)
+
+    async def _run(self) -> None:
+        await asyncio.sleep(random.uniform(0, min(self.check_seconds, 10)))  # spread workers started together
+        while True:
+            try:
+                await self.run_due()
+            except Exception:
+                logger.exception('maintenance check failed')
+            await asyncio.sleep(self.check_seconds)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            'checks': self.checks,
+            'lock_busy': self.lock_busy,
+            'tasks': {task.name: task.stats() for task in self.tasks},
+        }
+
+
+async def delete_in_batches(delete: Callable[[datetime.datetime, int], Awaitable[int]], before: datetime.datetime,
+                            batch_size: int = BATCH_SIZE, pause: float = BATCH_PAUSE_SECONDS) -> int:
+    """
+    :param delete: deletes at most the given number of rows older than `before`, returning how many it deleted
+    :return: number of deleted rows
+    """
+    total = 0
+    while True:
+        deleted = await delete(before, batch_size)
+        total += deleted
+        if deleted < batch_size:
+            return total
+        await asyncio.sleep(pause)
+
+
+def heartbeat_log_partitions_to_create(existing: Iterable[datetime.date], now: datetime.datetime,
+                                       retention_days: float, ahead_days: int) -> list[datetime.date]:
+    """
+    :return: days from the retention cutoff to `ahead_days` days ahead that have no partition yet
+    """
+    first = (now - datetime.timedelta(days=retention_days)).date()
+    existing = set(existing)
+    days = (first + datetime.timedelta(days=offset) for offset in range((now.date() - first).days + ahead_days + 1))
+    return [day for day in days if day not in existing]
+
+
+def heartbeat_log_partitions_to_drop(existing: Iterable[datetime.date], before: datetime.datetime) -> list[datetime.date]:
+    """
+    :return: days of the partitions entirely older than `before`
+    """
+    return [day for day in existing if day < before.date()]
+
+
+async def ensure_heartbeat_log_partitions(retention_days: float = HEARTBEAT_LOG_RETENTION_DAYS,
+                                          ahead_days: int = HEARTBEAT_LOG_PARTITIONS_AHEAD_DAYS) -> int:
+    """
+    Create the missing daily partitions from the retention cutoff to `ahead_days` days ahead.
+
+    :return: number of rows moved out of the default partition
+    """
+    existing = await async_db.select_heartbeat_log_partitions()
+    total = 0
+    for day in heartbeat_log_partitions_to_create(existing, datetime.datetime.now(), retention_days, ahead_days):
+        total += await async_db.create_heartbeat_log_partition(day)
+    return total
+
+
+async def purge_heartbeat_log(retention_days: float = HEARTBEAT_LOG_RETENTION_DAYS,
+                              batch_size: int = BATCH_SIZE, pause: float = BATCH_PAUSE_SECONDS) -> int:
+    """
+    Drop the partitions entirely older than the retention, then delete
+    the remaining old rows `batch_size` rows at a time.
+
+    :return: number of deleted rows
+    """
+    before = datetime.datetime.now() - datetime.timedelta(days=retention_days)
+    total = 0
+    for day in heartbeat_log_partitions_to_drop(await async_db.select_heartbeat_log_partitions(), before):
+        total += await async_db.drop_heartbeat_log_partition(day)
+    return total + await delete_in_batches(async_db.delete_heartbeat_log_before, before, batch_size, pause)
+
+
+async def purge_heartbeat_counts(counts_retention_days: float = HEARTBEAT_COUNTS_RETENTION_DAYS,
+                                 hourly_retention_days: float = HEARTBEAT_ROLLUP_HOURLY_RETENTION_DAYS) -> int:
+    """
+    :return: number of deleted rows of heartbeat_counts and heartbeat_rollup_hourly
+    """
+    now = datetime.datetime.now()
+    return (
+        await async_db.delete_heartbeat_counts_before(now - datetime.timedelta(days=counts_retention_days))
+        + await async_db.delete_heartbeat_rollup_hourly_before(now - datetime.timedelta(days=hourly_retention_days))
+    )
+
+
+async def refresh_heartbeat_rollups(lookback_days: int = HEARTBEAT_ROLLUP_LOOKBACK_DAYS) -> int:
+    """
+    :return: number of rollup rows written
+    """
+    start_day = datetime.date.today() - datetime.timedelta(days=lookback_days)
+    return await async_db.refresh_heartbeat_rollups(start_day)
+
+
+async def summarize_device_availability(flush_seconds: float = heartbeat_log_writer.FLUSH_SECONDS,
+                                       minute_interval: int = HEARTBEAT_LOG_INTERVAL_MINUTES) -> int:
+    """
+    :return: number of summarized heartbeat_log rows
+    """
+    lookback = datetime.timedelta(minutes=minute_interval, seconds=flush_seconds)
+    return await async_db.summarize_device_availability(lookback, minute_interval)
+
+
+async def purge_device_availability(retention_days: float = DEVICE_AVAILABILITY_RETENTION_DAYS) -> int:
+    """
+    :return: number of deleted rows of device_uptime_hourly and device_outages
+    """
+    before = datetime.datetime.now() - datetime.timedelta(days=retention_days)
+    return await async_db.delete_device_availability_before(before)
+
+
+async def purge_report_history(retention_days: float = report_history.RETENTION_DAYS,
+                               batch_size: int = BATCH_SIZE, pause: float = BATCH_PAUSE_SECONDS) -> int:
+    """
+    :return: number of deleted rows
+    """
+    before = datetime.datetime.now() - datetime.timedelta(days=retention_days)
+    return await delete_in_batches(async_db.delete_report_history_before, before, batch_size, pause)
+
+
+scheduler = MaintenanceScheduler([
+    MaintenanceTask('heartbeat_log_partitions', HEARTBEAT_LOG_PARTITIONS_PERIOD_SECONDS, ensure_heartbeat_log_partitions),
+    MaintenanceTask('heartbeat_log_retention', HEARTBEAT_LOG_RETENTION_PERIOD_SECONDS, purge_heartbeat_log),
+    MaintenanceTask('heartbeat_counts_retention', HEARTBEAT_LOG_RETENTION_PERIOD_SECONDS, purge_heartbeat_counts),
+    MaintenanceTask('heartbeat_rollups', HEARTBEAT_ROLLUP_PERIOD_SECONDS, refresh_heartbeat_rollups),
+    MaintenanceTask('device_availability', DEVICE_AVAILABILITY_PERIOD_SECONDS, summarize_device_availability),
+    MaintenanceTask('device_availability_retention', HEARTBEAT_LOG_RETENTION_PERIOD_SECONDS, purge_device_availability),
+    MaintenanceTask('report_history_retention', HEARTBEAT_LOG_RETENTION_PERIOD_SECONDS, purge_report_history),
+])
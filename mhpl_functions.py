@@ -1,7 +1,12 @@
-import datetime as dt
-import random
+import os
+from typing import Callable, Optional
 
+import async_db
+import availability
 import db
+from fleet_stats import FleetStats, fleet_stats
+from heartbeat_table import heartbeat_table
+from ttl_cache import TTLCache
 
 
 """
@@ -16,43 +21,166 @@ Pipeline fuction must satisfy below:
     Receive str payloads.
     Return exactly one str object .
 
+Functions reading the fleet are marked with @uses_context and receive
+an EvalContext as their first argument. In the app the context serves
+counters of fleet_stats in O(1); elsewhere it loads the device list
+once per evaluation, so #divide(#alives(), #devices()) reads the table once.
+Snapshots are also shared between evaluations for
+MHPL_FLEET_SNAPSHOT_TTL_SECONDS (0 disables sharing).
+Functions marked with @uses_availability also read per-device
+availability (see availability.py), loaded once per evaluation.
+
 """
-def get_alive_device_n() -> str:
-    devices: list[db.Device] = db.select_devices()
-    return str(
-        sum(
-            dt.datetime.now(tz=dt.timezone(offset=dt.timedelta(hours=9)))
-            - device.last_heartbeat_timestamp
-            < dt.timedelta(hours=24)
-            for device in devices
-        )
-    )
+FLEET_SNAPSHOT_TTL_SECONDS = float(os.environ.get('MHPL_FLEET_SNAPSHOT_TTL_SECONDS') or 2)
+
+fleet_cache = TTLCache(1, FLEET_SNAPSHOT_TTL_SECONDS)
+
+
+def share_fleet(devices: list[db.Device]) -> None:
+    if FLEET_SNAPSHOT_TTL_SECONDS > 0:
+        fleet_cache.put('devices', devices)
+
+
+def invalidate_fleet() -> None:
+    """
+    Drop the shared snapshot, e.g. after devices are registered or (de)activated.
+
+    """
+    fleet_cache.clear()
+
+
+async def resync_fleet_stats() -> None:
+    """
+    Reload fleet_stats from the devices table once it is FLEET_STATS_RESYNC_SECONDS old,
+    to pick up changes whose notifications this worker missed.
+
+    """
+    if fleet_stats.needs_resync():
+        fleet_stats.load(heartbeat_table.read_through(await async_db.select_devices()))
+
+
+class EvalContext:
+    """
+    Fleet state seen by the functions of one evaluation:
+    the incrementally maintained fleet_stats once it is loaded,
+    otherwise aggregates of a snapshot of the devices table.
+
+    """
+    def __init__(self, devices: Optional[list[db.Device]] = None, fleet: Optional[FleetStats] = None,
+                 availability: Optional[dict[str, dict]] = None) -> None:
+        self._devices = devices
+        self._fleet = fleet
+        self._availability = availability
+
+    @classmethod
+    async def load(cls, with_availability: bool = False) -> "EvalContext":
+        """
+        (Re)load fleet_stats (and availability if asked) if needed without blocking the event loop,
+        so that the evaluation itself needs no I/O.
+
+        """
+        await resync_fleet_stats()
+        return cls(fleet=fleet_stats, availability=await availability.load() if with_availability else None)
+
+    @property
+    def devices(self) -> list[db.Device]:
+        if self._devices is None:
+            self._devices = fleet_cache.get('devices')
+            if self._devices is None:
+                self._devices = heartbeat_table.read_through(db.select_devices())
+                share_fleet(self._devices)
+        return self._devices
 
+    @property
+    def fleet(self) -> FleetStats:
+        if self._fleet is None:
+            if self._devices is None and fleet_stats.loaded:
+                self._fleet = fleet_stats
+            else:
+                self._fleet = FleetStats.from_devices(self.devices)
+        return self._fleet
 
-def get_available_device_n() -> str:
-    devices: list[db.Device] = db.select_devices()
-    return str(
-        sum(device.is_active for device in devices)
-    )
+    @property
+    def availability(self) -> dict[str, dict]:
+        if self._availability is None:
+            self._availability = availability.load_sync()
+        return self._availability
 
 
-def get_device_n() -> str:
-    return str(len(db.select_devices()))
+def uses_context(func: Callable) -> Callable:
+    func.uses_context = True
+    return func
 
 
-def get_dead_device_n() -> str:
-    return str(int(get_device_n()) - int(get_alive_device_n()))
+def uses_availability(func: Callable) -> Callable:
+    func.uses_availability = True
+    return uses_context(func)
 
 
-def get_device_name_randomly() -> str:
-    devices = db.select_devices()
-    if len(devices) == 0:
+@uses_context
+def get_alive_device_n(ctx: EvalContext) -> str:
+    return str(ctx.fleet.alive_n())
+
+
+@uses_context
+def get_available_device_n(ctx: EvalContext) -> str:
+    return str(ctx.fleet.available_n())
+
+
+@uses_context
+def get_device_n(ctx: EvalContext) -> str:
+    return str(ctx.fleet.device_n())
+
+
+@uses_context
+def get_dead_device_n(ctx: EvalContext) -> str:
+    return str(int(get_device_n(ctx)) - int(get_alive_device_n(ctx)))
+
+
+@uses_context
+def get_device_name_randomly(ctx: EvalContext) -> str:
+    return ctx.fleet.random_device_name()
+
+
+@uses_context
+def get_report(ctx: EvalContext, device_name: str) -> str:
+    report = ctx.fleet.report(device_name)
+    return report if report is not None else ''
+
+
+@uses_availability
+def get_uptime(ctx: EvalContext, device_name: str, window: str = '24h') -> str:
+    """
+    :param window: 24h, 7d or 30d
+    :return: percentage of heartbeat_log buckets the device was logged in
+    """
+    device = ctx.availability.get(device_name)
+    if device is None or window not in device['uptime']:
         return ''
-    return random.choice(devices).device_name
+    return str(round(device['uptime'][window] * 100, 1))
 
 
-def get_report(device_name: str) -> str:
-    return db.select_report(device_name)
+@uses_availability
+def get_longest_outage(ctx: EvalContext, device_name: str, window: str = '24h') -> str:
+    """
+    :return: seconds of the longest outage in the window
+    """
+    device = ctx.availability.get(device_name)
+    if device is None or window not in device['longest_outage']:
+        return ''
+    outage = device['longest_outage'][window]
+    return str(outage['seconds'] if outage is not None else 0)
+
+
+@uses_availability
+def get_last_seen(ctx: EvalContext, device_name: str) -> str:
+    """
+    :return: seconds since the last heartbeat of the device
+    """
+    device = ctx.availability.get(device_name)
+    if device is None or device['last_seen_seconds'] is None:
+        return ''
+    return str(device['last_seen_seconds'])
 
 
 def culc_plus(a: str, b: str) -> str:
@@ -109,6 +237,9 @@ available_functions = {
     'devices': get_device_n,
     'deads': get_dead_device_n,
     'report': get_report,
+    'uptime': get_uptime,
+    'longest_outage': get_longest_outage,
+    'last_seen': get_last_seen,
     'plus': culc_plus,
     'minus': culc_minus,
     'times': culc_times,
@@ -0,0 +1,228 @@
+import asyncio
+import json
+import logging
+import os
+import secrets
+import socket
+from typing import Awaitable, Callable, Optional
+
+import asyncpg
+
+import async_db
+import db
+
+
+"""
+Invalidation bus between workers (and hosts) over PostgreSQL LISTEN/NOTIFY
+
+Every process keeps in-memory state (fleet counters, /json/signals
+snapshots, token index, user cache, SSE viewers). A process that changes
+the database publishes an event on the `status_board` channel;
+every other process applies the same event to its own state.
+Events from the process itself are skipped by WORKER_ID.
+
+If the listening connection is lost, events may have been missed,
+so `on_reconnect` is called to drop or reload everything.
+
+Frequent events that only repeat the latest state of a key (heartbeats
+that change nothing but the time) go through a Coalescer: the last one of
+each key is sent every NOTIFY_COALESCE_SECONDS by a single notify_many().
+
+"""
+CHANNEL = os.environ.get('NOTIFY_CHANNEL') or 'status_board'
+WORKER_ID = '%s:%d:%s' % (socket.gethostname(), os.getpid(), secrets.token_hex(4))
+MAX_PAYLOAD_BYTES = 7900  # NOTIFY payloads must be shorter than 8000 bytes
+RECONNECT_SECONDS = 5.0
+COALESCE_SECONDS = float(os.environ.get('NOTIFY_COALESCE_SECONDS') or 1)
+
+logger = logging.getLogger(__name__)
+
+
+def encode(event: str, data: dict) -> str:
+    """
+    :return: NOTIFY payload; a report too long for NOTIFY is replaced with a flag
+    """
+    payload = json.dumps({'worker': WORKER_ID, 'event': event, 'data': data}, ensure_ascii=False)
+    if len(payload.encode()) > MAX_PAYLOAD_BYTES and 'report' in data:
+        data = {key: value for key, value in data.items() if key != 'report'}
+        data['report_truncated'] = True
+        payload = json.dumps({'worker': WORKER_ID, 'event': event, 'data': data}, ensure_ascii=False)
+    return payload
+
+
+def decode(payload: str) -> Optional[tuple[str, dict]]:
+    """
+    :return: (event, data), or None for events of this worker
+    """
+    message = json.loads(payload)
+    if message['worker'] == WORKER_ID:
+        return None
+    return message['event'], message['data']
+
+
+async def notify(event: str, data: dict) -> None:
+    async with async_db.pool.connection() as conn:
+        await conn.execute('SELECT pg_notify($1, $2);', CHANNEL, encode(event, data))
+
+
+async def notify_many(event: str, datas: list[dict]) -> None:
+    """
+    notify() of many events of the same kind, in a single statement.
+
+    """
+    if not datas:
+        return
+    async with async_db.pool.connection() as conn:
+        await conn.execute('SELECT pg_notify($1, payload) FROM unnest($2::text[]) AS payload;',
+                           CHANNEL, [encode(event, data) for data in datas])
+
+
+def notify_sync(event: str, data: dict) -> None:
+    """
+    notify() for synchronous code (and other processes such as scripts).
+
+    """
+    with db.pool.connection() as sess:
+        with sess.cursor() as cur:
+            cur.execute('SELECT pg_notify(%s, %s);', (CHANNEL, encode(event, data)))
+
+
+class Coalescer:
+    def __init__(self, event: str, key: str, interval: float = COALESCE_SECONDS,
+                 send: Callable[[str, list[dict]], Awaitable[None]] = notify_many) -> None:
+        """
+        :param key: field of the event data; only the last event of each value is sent
+        :param send: notify_many() or a stand-in
+        """
+        self.event = event
+        self.key = key
+        self.interval = interval
+        self.send = send
+        self._pending: dict[object, dict] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.added = 0
+        self.sent = 0
+        self.flushes = 0
+        self.failures = 0
+
+    def add(self, data: dict) -> None:
+        self._pending[data[self.key]] = data
+        self.added += 1
+
+    def discard(self, value: object) -> None:
+        """
+        Drop the pending event of `value`, superseded by one sent right away.
+
+        """
+        self._pending.pop(value, None)
+
+    async def flush(self) -> None:
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            await self.send(self.event, list(pending.values()))
+        except Exception:
+            self.failures += 1
+            logger.exception('failed to notify %d %s events', len(pending), self.event)
+            return  # not retried: the next events of the same keys supersede them
+        self.sent += len(pending)
+        self.flushes += 1
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._run())
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self._pending),
+            'added': self.added,
+            'sent': self.sent,
+            'flushes': self.flushes,
+            'failures': self.failures,
+        }
+
+
+class Listener:
+    def __init__(self, handler: Callable[[str, dict], None], on_reconnect: Callable[[], None],
+                 dsn: str = db.DATABASE) -> None:
+        """
+        :param handler: called with (event, data) of every event from other workers
+        :param on_reconnect: called after the connection is re-established
+        """
+        self.handler = handler
+        self.on_reconnect = on_reconnect
+        self.dsn = dsn
+        self._conn: Optional[asyncpg.Connection] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self.received = 0
+        self.skipped = 0
+        self.errors = 0
+        self.reconnects = 0
+
+    async def start(self) -> None:
+        self._closing = False
+        await self._connect()
+
+    async def close(self) -> None:
+        self._closing = True
+        if self._task is not None:
+            self._task.cancel()
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            await conn.close()
+
+    async def _connect(self) -> None:
+        self._conn = await asyncpg.connect(self.dsn)
+        self._conn.add_termination_listener(self._on_terminated)
+        await self._conn.add_listener(CHANNEL, self._on_notification)
+
+    def _on_notification(self, conn: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+        try:
+            message = decode(payload)
+            if message is None:
+                self.skipped += 1
+                return
+            self.received += 1
+            self.handler(*message)
+        except Exception:
+            self.errors += 1
+            logger.exception('failed to apply notification %r', payload[:200])
+
+    def _on_terminated(self, conn: asyncpg.Connection) -> None:
+        if not self._closing:
+            self._task = asyncio.get_event_loop().create_task(self._reconnect())
+
+    async def _reconnect(self) -> None:
+        while not self._closing:
+            await asyncio.sleep(RECONNECT_SECONDS)
+            try:
+                await self._connect()
+            except (OSError, asyncpg.PostgresError):
+                logger.warning('notification listener could not reconnect; retrying')
+                continue
+            self.reconnects += 1
+            self.on_reconnect()
+            return
+
+    def stats(self) -> dict:
+        return {
+            'worker': WORKER_ID,
+            'connected': self._conn is not None and not self._conn.is_closed(),
+            'received': self.received,
+            'skipped': self.skipped,
+            'errors': self.errors,
+            'reconnects': self.reconnects,
+        }
@@ -0,0 +1,154 @@
+import functools
+import os
+import re
+from typing import Optional
+
+from pydantic import BaseModel
+
+
+"""
+Parser of the table printed by `nvidia-smi`
+
+    Mon Mar  8 21:37:43 2021
+    +-----------------------------------------------------------------------------+
+    | NVIDIA-SMI 450.102.04   Driver Version: 450.102.04   CUDA Version: 11.0     |
+    |-------------------------------+----------------------+----------------------+
+    | GPU  Name        Persistence-M| Bus-Id        Disp.A | Volatile Uncorr. ECC |
+    | Fan  Temp  Perf  Pwr:Usage/Cap|         Memory-Usage | GPU-Util  Compute M. |
+    |===============================+======================+======================|
+    |   0  GeForce RTX 208...  Off  | 00000000:01:00.0 Off |                  N/A |
+    | 30%   38C    P8    20W / 250W |      1MiB / 11019MiB |      0%      Default |
+    +-------------------------------+----------------------+----------------------+
+    | Processes:                                                                  |
+    |  GPU   GI   CI        PID   Type   Process name                  GPU Memory |
+    |=============================================================================|
+    |    0   N/A  N/A      1234      C   python                          9MiB     |
+    +-----------------------------------------------------------------------------+
+
+Devices report it every heartbeat, usually unchanged but for the clock on
+the first line, so the table below the clock is parsed through an LRU
+cache of NVIDIA_SMI_PARSE_CACHE_SIZE entries.
+Fields shown as N/A are None.
+
+"""
+PARSE_CACHE_SIZE = int(os.environ.get('NVIDIA_SMI_PARSE_CACHE_SIZE') or 256)
+
+_HEADER = re.compile(r'NVIDIA-SMI\s+(\S+)\s+Driver Version:\s+(\S+)(?:\s+CUDA Version:\s+(\S+))?')
+_GPU_LINE1 = re.compile(r'^\|\s*(\d+)\s+(.+?)\s+(?:On|Off)\s*\|\s*(\S+)\s+(?:On|Off)\s*\|')
+_GPU_LINE2 = re.compile(
+    r'^\|\s*(\d+%|N/A)\s+(\d+C|N/A)\s+(\S+)\s+(\S+)\s*/\s*(\S+)\s*\|'
+    r'\s*(\d+)MiB\s*/\s*(\d+)MiB\s*\|\s*(\d+%|N/A)\s'
+)
+_PROCESS = re.compile(
+    r'^\|\s*(\d+)\s+(?:\S+\s+\S+\s+)?(\d+)\s+(C\+G|C|G|M\+C|M)\s+(.*?)\s+(\d+MiB|N/A)\s*\|'
+)
+
+
+class GPU(BaseModel):
+    index: int
+    name: str
+    bus_id: str
+    fan_percent: Optional[int]
+    temperature_c: Optional[int]
+    perf_state: Optional[str]
+    power_draw_w: Optional[float]
+    power_limit_w: Optional[float]
+    memory_used_mib: int
+    memory_total_mib: int
+    utilization_percent: Optional[int]
+
+
+class GPUProcess(BaseModel):
+    gpu_index: int
+    pid: int
+    type: str
+    name: str
+    memory_mib: Optional[int]
+
+
+class NvidiaSmiReport(BaseModel):
+    driver_version: Optional[str]
+    cuda_version: Optional[str]
+    gpus: list[GPU]
+    processes: list[GPUProcess]
+
+
+def _number(text: str, unit: str = '') -> Optional[float]:
+    if text == 'N/A' or not text.endswith(unit):
+        return None
+    try:
+        return float(text[:len(text) - len(unit)])
+    except ValueError:
+        return None
+
+
+def _int(text: str, unit: str = '') -> Optional[int]:
+    value = _number(text, unit)
+    return int(value) if value is not None else None
+
+
+def parse(text: Optional[str]) -> Optional[NvidiaSmiReport]:
+    """
+    :return: GPUs and processes of an nvidia-smi report, or None if `text` is not one
+             (the result is shared between calls; do not modify it)
+    """
+    if not text or 'NVIDIA-SMI' not in text:
+        return None
+    return _parse_table(text[text.index('NVIDIA-SMI'):])  # without the clock
+
+
+@functools.lru_cache(maxsize=PARSE_CACHE_SIZE)
+def _parse_table(text: str) -> Optional[NvidiaSmiReport]:
+    header = _HEADER.search(text)
+    gpus: list[GPU] = []
+    processes: list[GPUProcess] = []
+    lines = text.splitlines()
+    for i, line in enumerate(lines):
+        match = _GPU_LINE1.match(line)
+        if match is not None and i + 1 < len(lines):
+            stats = _GPU_LINE2.match(lines[i + 1])
+            if stats is None:
+                continue
+            fan, temp, perf, power_draw, power_limit, used, total, util = stats.groups()
+            gpus.append(GPU(
+                index=int(match.group(1)),
+                name=match.group(2),
+                bus_id=match.group(3),
+                fan_percent=_int(fan, '%'),
+                temperature_c=_int(temp, 'C'),
+                perf_state=perf if perf != 'N/A' else None,
+                power_draw_w=_number(power_draw, 'W'),
+                power_limit_w=_number(power_limit, 'W'),
+                memory_used_mib=int(used),
+                memory_total_mib=int(total),
+                utilization_percent=_int(util, '%'),
+            ))
+            continue
+        match = _PROCESS.match(line)
+        if match is not None:
+            gpu_index, pid, process_type, name, memory = match.groups()
+            processes.append(GPUProcess(
+                gpu_index=int(gpu_index),
+                pid=int(pid),
+                type=process_type,
+                name=name,
+                memory_mib=_int(memory, 'MiB'),
+            ))
+    if not gpus:
+        return None
+    return NvidiaSmiReport(
+        driver_version=header.group(2) if header else None,
+        cuda_version=header.group(3) if header else None,
+        gpus=gpus,
+        processes=processes,
+    )
+
+
+def cache_stats() -> dict:
+    info = _parse_table.cache_info()
+    return {
+        'size': info.currsize,
+        'max_size': info.maxsize,
+        'hits': info.hits,
+        'misses': info.misses,
+    }
@@ -1,6 +1,9 @@
-from typing import Final
+import os
+import re
+from typing import Final, Optional
 
-from mhpl_functions import available_functions
+from mhpl_functions import EvalContext, available_functions
+from ttl_cache import TTLCache
 
 
 """
@@ -79,19 +82,33 @@ class Function(Token):
     def exec(self):
         if self.name not in self.valid_functions:
             raise FunctionNotFoundError('invalid function: %s' % self.name)
-        func = self.func_map[self.name]
-        params = list(map(str, self.messages))
+        return Function.call(self.name, list(map(str, self.messages)))
+
+    @classmethod
+    def uses_context(cls, name: str) -> bool:
+        return getattr(cls.func_map.get(name), 'uses_context', False)
+
+    @classmethod
+    def uses_availability(cls, name: str) -> bool:
+        return getattr(cls.func_map.get(name), 'uses_availability', False)
+
+    @classmethod
+    def call(cls, name: str, params: list[str], ctx: Optional[EvalContext] = None) -> str:
+        if name not in cls.valid_functions:
+            raise FunctionNotFoundError('invalid function: %s' % name)
+        func = cls.func_map[name]
+        args = [ctx if ctx is not None else EvalContext()] if cls.uses_context(name) else []
         if params == ['']:  # with no params
             try:
-                return func()
+                return func(*args)
             except TypeError:
-                raise FunctionParamUnmatchError('function %s got extra param %s' % (self.name, params))
+                raise FunctionParamUnmatchError('function %s got extra param %s' % (name, params))
         try:
-            return func(*params)
+            return func(*args, *params)
         except TypeError:
             raise FunctionParamUnmatchError(
                 'function %s called with params %s (it\'s too many or too few).'
-                % (self.name, params)
+                % (name, params)
             )
 
 
@@ -103,51 +120,217 @@ class PlainText(Token):
 """
 Pileline Parser
 
-"""
-def replace_escape(text: str) -> str:
-    d_bksl_idx = text.find('\\\\')  # means \\
-    hash_idx = text.find('\\#')  # means \#
+Single pass over the text with an explicit stack of open functions,
+so parsing is O(n) and nesting depth is not limited by recursion.
+Escapes: "\\\\" means "\\" and "\\#" means "#"; any other backslash is kept as is.
+Inside function parameters, parentheses must be balanced and only
+top-level commas separate parameters (spaces around parameters are dropped).
 
-    if -1 < d_bksl_idx < hash_idx:
-        return text[: d_bksl_idx] + '\\' + replace_escape(text[d_bksl_idx + 2:])
-    if -1 < hash_idx:
-        return text[: hash_idx] + '#' + replace_escape(text[hash_idx + 2:])
-    return text
+"""
+SPECIAL_CHARS_TOP: Final = re.compile(r'[\\#]')
+SPECIAL_CHARS_IN_FUNCTION: Final = re.compile(r'[\\#(),]')
+ESCAPE: Final = re.compile(r'\\([\\#])')
 
 
-def find_closing_parenthesis_idx(text: str, start_left_paren: int) -> int:
+class _Frame:
     """
-    Find end of parentheses
+    A function whose parameters are being parsed (or the whole message).
 
     """
-    opened_paren_num = 1
-    for right_paren_idx, right_c in enumerate(text[start_left_paren + 1:], start=start_left_paren + 1):
-        if right_c == '(':
-            opened_paren_num += 1
-            continue
-        if right_c == ')':
-            opened_paren_num -= 1
-            if opened_paren_num == 0:
-                return right_paren_idx
-    # Parentheses have not been closed.
-    raise ParseError('Unclosed parentheses:', text)
-
-
-def build_function(text: str, begin_idx: int) -> tuple[Function, int]:
-    for left_paren_idx, left_c in enumerate(text[begin_idx + 1:], start=begin_idx + 1):
-        if left_c == '(':
-            right_paren_idx = find_closing_parenthesis_idx(text, left_paren_idx)
-            name = replace_escape(text[begin_idx + 1: left_paren_idx])
-            param = replace_escape(text[left_paren_idx + 1: right_paren_idx])
-            if ',' in param:
-                messages = [Pipeline.parse(p) for p in param.replace(' ', '').split(',')]
+    __slots__ = ('name', 'params', 'tokens', 'buffer', 'paren_depth')
+
+    def __init__(self, name: Optional[str]) -> None:
+        self.name = name
+        self.params: list[Message] = []
+        self.tokens: list[Token] = []
+        self.buffer: list[str] = []  # pending plain text
+        self.paren_depth = 0
+
+    def flush(self) -> None:
+        if self.buffer:
+            self.tokens.append(PlainText(''.join(self.buffer)))
+            self.buffer = []
+
+    def end_param(self, strip: bool) -> None:
+        self.flush()
+        tokens = self.tokens
+        if strip and tokens and isinstance(tokens[-1], PlainText):
+            tokens[-1] = PlainText(tokens[-1].name.rstrip(' '))
+            if not tokens[-1].name:
+                tokens.pop()
+        if strip and tokens and isinstance(tokens[0], PlainText):
+            tokens[0] = PlainText(tokens[0].name.lstrip(' '))
+            if not tokens[0].name:
+                tokens.pop(0)
+        self.params.append(Message(tokens=tokens))
+        self.tokens = []
+
+
+def parse(text: str) -> Message:
+    stack = [_Frame(None)]
+    frame = stack[0]
+    idx = 0
+    n = len(text)
+    while idx < n:
+        pattern = SPECIAL_CHARS_TOP if frame.name is None else SPECIAL_CHARS_IN_FUNCTION
+        m = pattern.search(text, idx)
+        end = m.start() if m else n
+        if end > idx:
+            frame.buffer.append(text[idx: end])
+        if m is None:
+            break
+        c = text[end]
+        idx = end + 1
+
+        if c == '\\':
+            if idx < n and text[idx] in '\\#':
+                frame.buffer.append(text[idx])
+                idx += 1
             else:
-                messages = [Pipeline.parse(param)]
-            res = Function(name=name, messages=messages)
-            next_idx = right_paren_idx + 1
-            return res, next_idx
-    # Parentheses have not been opened.
-    raise ParseError('Function without left parentheses:', text)
+                frame.buffer.append(c)
+        elif c == '#':  # Begining of Function
+            left_paren_idx = text.find('(', idx)
+            if left_paren_idx == -1:
+                raise ParseError('Function without left parentheses:', text)
+            raw_name = text[idx: left_paren_idx]
+            if frame.name is not None and (')' in raw_name or ',' in raw_name):
+                raise ParseError('Function without left parentheses:', text)
+            frame.flush()
+            name = ESCAPE.sub(r'\1', raw_name)
+            frame = _Frame(name)
+            stack.append(frame)
+            idx = left_paren_idx + 1
+        elif c == '(':
+            frame.paren_depth += 1
+            frame.buffer.append(c)
+        elif c == ')' and frame.paren_depth > 0:
+            frame.paren_depth -= 1
+            frame.buffer.append(c)
+        elif c == ')':  # End of Function
+            frame.end_param(strip=len(frame.params) > 0)
+            stack.pop()
+            function = Function(name=frame.name, messages=frame.params)
+            frame = stack[-1]
+            frame.flush()
+            frame.tokens.append(function)
+        elif c == ',' and frame.paren_depth > 0:
+            frame.buffer.append(c)
+        else:  # ',' between parameters
+            frame.end_param(strip=True)
+
+    if len(stack) > 1:
+        # Parentheses have not been closed.
+        raise ParseError('Unclosed parentheses:', text)
+    frame.flush()
+    return Message(tokens=frame.tokens)
+
+
+"""
+Compiler
+
+A message is flattened into postfix instructions evaluated with a value stack:
+    (PUSH, text)           push plain text
+    (CONCAT, n)            join the top n values
+    (CALL, name, n)        call function with the top n values as parameters
+
+"""
+PUSH: Final = 0
+CONCAT: Final = 1
+CALL: Final = 2
+
+
+def compile_message(message: Message) -> list[tuple]:
+    code = []
+    todo: list = [message]  # symbols to visit, or instructions to emit after their operands
+    while todo:
+        item = todo.pop()
+        if isinstance(item, tuple):
+            code.append(item)
+        elif isinstance(item, PlainText):
+            code.append((PUSH, item.name))
+        elif isinstance(item, Function):
+            todo.append((CALL, item.name, len(item.messages)))
+            todo.extend(reversed(item.messages))
+        elif len(item.tokens) == 0:
+            code.append((PUSH, ''))
+        else:
+            if len(item.tokens) > 1:
+                todo.append((CONCAT, len(item.tokens)))
+            todo.extend(reversed(item.tokens))
+    return code
+
+
+def execute(code: list[tuple], ctx: EvalContext) -> str:
+    stack: list[str] = []
+    for instruction in code:
+        op = instruction[0]
+        if op == PUSH:
+            stack.append(instruction[1])
+        elif op == CONCAT:
+            n = instruction[1]
+            joined = ''.join(stack[-n:])
+            del stack[-n:]
+            stack.append(joined)
+        else:
+            _, name, n = instruction
+            params = stack[-n:]
+            del stack[-n:]
+            stack.append(Function.call(name, params, ctx))
+    return stack[0]
+
+
+class Program:
+    """
+    A return message parsed once and evaluated on every heartbeat.
+    Messages made of plain text only are evaluated at compile time.
+
+    """
+    def __init__(self, source: str) -> None:
+        self.source: Final[str] = source
+        self.message: Optional[Message] = None
+        self.error: Optional[ParseError] = None
+        self.static_text: Optional[str] = None
+        self.code: list[tuple] = []
+        self.uses_context = False  # whether evaluation reads the fleet snapshot
+        self.uses_availability = False  # whether evaluation reads per-device availability
+        try:
+            self.message = Pipeline.parse(source)
+        except ParseError as e:
+            self.error = e
+            return
+        if all(isinstance(token, PlainText) for token in self.message):
+            self.static_text = str(self.message)
+        else:
+            self.code = compile_message(self.message)
+            self.uses_context = any(
+                instruction[0] == CALL and Function.uses_context(instruction[1])
+                for instruction in self.code
+            )
+            self.uses_availability = any(
+                instruction[0] == CALL and Function.uses_availability(instruction[1])
+                for instruction in self.code
+            )
+
+    def __repr__(self) -> str:
+        return '%s(source="%s")' % (self.__class__.__name__, self.source)
+
+    @property
+    def is_static(self) -> bool:
+        return self.static_text is not None
+
+    def run(self, ctx: Optional[EvalContext] = None) -> str:
+        """
+        :param ctx: preloaded fleet snapshot; loaded on first use if omitted
+        """
+        if self.error is not None:
+            raise self.error
+        if self.static_text is not None:
+            return self.static_text
+        return execute(self.code, ctx if ctx is not None else EvalContext())
+
+
+# Keyed by message text, so entries never go stale; old messages just age out.
+program_cache = TTLCache(int(os.environ.get('MHPL_PROGRAM_CACHE_SIZE') or 1024), ttl=None)
 
 
 class Pipeline:
@@ -157,37 +340,32 @@ class Pipeline:
         Parse text written in MHPL
 
         """
-        res = []
-        buffer_begin = None
-        escaped = False
-        idx = 0
-        while idx < len(text):
-            c = text[idx]
-            if c == '\\':
-                escaped = not escaped
-            elif c == '#' and not escaped:  # Begining of Function
-                if buffer_begin is not None:
-                    res.append(PlainText(replace_escape(text[buffer_begin: idx])))
-                function, next_idx = build_function(text, idx)
-                res.append(function)
-                idx = next_idx
-                buffer_begin = None
-                continue
-            else:
-                escaped = False
+        return parse(text)
+
+    @staticmethod
+    def compile(text: str) -> Program:
+        """
+        Get compiled program of text, from cache if possible.
+
+        """
+        program: Optional[Program] = program_cache.get(text)
+        if program is None:
+            program = Program(text)
+            program_cache.put(text, program)
+        return program
 
-            if buffer_begin is None:
-                buffer_begin = idx
-            idx += 1
-        
-        if buffer_begin is not None:
-            res.append(PlainText(replace_escape(text[buffer_begin:])))
-        return Message(tokens=res)
+    @staticmethod
+    def precompile(text: str) -> None:
+        """
+        Compile text ahead of the heartbeats that will need it.
+
+        """
+        program_cache.put(text, Program(text))
 
     @staticmethod
-    def feed(return_message: str):
+    def feed(return_message: str, ctx: Optional[EvalContext] = None):
         """
         Feed text written in MHPL and get result string.
 
         """
-        return str(Pipeline.parse(return_message))
+        return Pipeline.compile(return_message).run(ctx)
@@ -0,0 +1,206 @@
+import argparse
+import asyncio
+import collections
+import json
+import sys
+import time
+from typing import Iterator, Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+
+"""
+Replay of captured API traffic against app.app, for capacity measurements
+
+The capture is JSONL, one request per line, read as a stream:
+
+    {"method": "POST", "path": "/api/v2/heartbeat", "form": {"password": "...", "device_name": "SMC101", "report": "..."}}
+    {"method": "POST", "path": "/api/v2/heartbeats", "headers": {"X-Device-Password": "..."}, "json": {"heartbeats": [...]}}
+    {"method": "GET", "path": "/json/signals?summary=true"}
+
+`method` defaults to POST when the line has a body (form, json or content),
+GET otherwise. Lines without a path are skipped.
+
+Requests go through an in-process ASGI client, so no server is needed;
+the app itself connects to DATABASE_URL (e.g. the database of db/init_db.sh).
+At most --concurrency requests are in flight, started at most --rate per
+second if given. Throughput and latency percentiles are printed per endpoint
+(method and path without the query).
+
+httpx is a development dependency only:
+
+    pip install -r requirements-dev.txt
+    python replay.py capture.jsonl --concurrency 16 --rate 200
+
+"""
+PERCENTILES = (50, 90, 99)
+
+
+def read_capture(path: str, skipped: Optional[list[int]] = None) -> Iterator[dict]:
+    """
+    :param path: JSONL file, or - for stdin
+    :param skipped: its only element counts the lines that are not requests
+    """
+    file = sys.stdin if path == '-' else open(path, encoding='utf-8')
+    try:
+        for line in file:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except json.JSONDecodeError:
+                request = None
+            if isinstance(request, dict) and isinstance(request.get('path'), str):
+                yield request
+            elif skipped is not None:
+                skipped[0] += 1
+    finally:
+        if file is not sys.stdin:
+            file.close()
+
+
+def endpoint_of(request: dict) -> str:
+    return '%s %s' % (method_of(request), urlsplit(request['path']).path)
+
+
+def method_of(request: dict) -> str:
+    if 'method' in request:
+        return request['method'].upper()
+    return 'POST' if any(key in request for key in ('form', 'json', 'content')) else 'GET'
+
+
+def percentile(values: list[float], p: float) -> float:
+    """
+    :param values: sorted, not empty
+    :return: nearest-rank percentile
+    """
+    rank = max(1, -(-len(values) * p // 100))  # ceil
+    return values[int(rank) - 1]
+
+
+class EndpointStats:
+    def __init__(self) -> None:
+        self.latencies: list[float] = []
+        self.statuses: collections.Counter = collections.Counter()
+
+    def add(self, status: int|str, seconds: float) -> None:
+        self.latencies.append(seconds)
+        self.statuses[status] += 1
+
+    def summary(self, elapsed: float) -> dict:
+        latencies = sorted(self.latencies)
+        result = {
+            'requests': len(latencies),
+            'errors': sum(n for status, n in self.statuses.items() if not (isinstance(status, int) and status < 400)),
+            'rps': len(latencies) / elapsed if elapsed > 0 else 0.0,
+        }
+        for p in PERCENTILES:
+            result['p%d_ms' % p] = percentile(latencies, p) * 1e3 if latencies else 0.0
+        result['max_ms'] = latencies[-1] * 1e3 if latencies else 0.0
+        result['statuses'] = dict(sorted(self.statuses.items(), key=str))
+        return result
+
+
+class Replay:
+    def __init__(self, client: httpx.AsyncClient, concurrency: int = 8, rate: Optional[float] = None) -> None:
+        """
+        :param rate: requests started per second at most, unlimited if None
+        """
+        self.client = client
+        self.concurrency = concurrency
+        self.interval = 1 / rate if rate else 0.0
+        self.endpoints: dict[str, EndpointStats] = collections.defaultdict(EndpointStats)
+        self.elapsed = 0.0
+        self._next_at = 0.0
+
+    async def run(self, requests: Iterator[dict]) -> None:
+        started = time.perf_counter()
+        self._next_at = started
+        await asyncio.gather(*(self._worker(requests) for _ in range(self.concurrency)))
+        self.elapsed = time.perf_counter() - started
+
+    async def _worker(self, requests: Iterator[dict]) -> None:
+        for request in requests:  # shared by the workers; next() never awaits
+            if self.interval:
+                at = max(self._next_at, time.perf_counter())
+                self._next_at = at + self.interval
+                await asyncio.sleep(at - time.perf_counter())
+            await self._send(request)
+
+    async def _send(self, request: dict) -> None:
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(
+                method_of(request),
+                request['path'],
+                headers=request.get('headers'),
+                data=request.get('form'),
+                json=request.get('json'),
+                content=request.get('content'),
+            )
+            status = response.status_code
+        except Exception as e:
+            status = type(e).__name__
+        self.endpoints[endpoint_of(request)].add(status, time.perf_counter() - started)
+
+    def summary(self) -> dict:
+        return {endpoint: stats.summary(self.elapsed) for endpoint, stats in sorted(self.endpoints.items())}
+
+    def report(self) -> str:
+        lines = ['%-32s %8s %7s %9s %9s %9s %9s %9s' % (
+            'endpoint', 'requests', 'errors', 'req/s', 'p50 [ms]', 'p90 [ms]', 'p99 [ms]', 'max [ms]')]
+        for endpoint, s in self.summary().items():
+            lines.append('%-32s %8d %7d %9.1f %9.2f %9.2f %9.2f %9.2f' % (
+                endpoint, s['requests'], s['errors'], s['rps'], s['p50_ms'], s['p90_ms'], s['p99_ms'], s['max_ms']))
+        total = sum(len(stats.latencies) for stats in self.endpoints.values())
+        lines.append('%d requests in %.2f s, %.1f req/s' % (
+            total, self.elapsed, total / self.elapsed if self.elapsed > 0 else 0.0))
+        return '\n'.join(lines)
+
+
+async def replay(path: str, concurrency: int, rate: Optional[float], repeat: int = 1,
+                 limit: Optional[int] = None) -> Replay:
+    from app import app  # connects to DATABASE_URL
+
+    skipped = [0]
+
+    def requests() -> Iterator[dict]:
+        n = 0
+        for _ in range(repeat):
+            for request in read_capture(path, skipped):
+                if limit is not None and n >= limit:
+                    return
+                n += 1
+                yield request
+
+    await app.router.startup()
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://replay') as client:
+            result = Replay(client, concurrency, rate)
+            await result.run(requests())
+    finally:
+        await app.router.shutdown()
+    if skipped[0]:
+        print('skipped %d lines that are not requests' % skipped[0], file=sys.stderr)
+    return result
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Replay captured requests against app.app')
+    parser.add_argument('capture', help='JSONL file of requests, or - for stdin')
+    parser.add_argument('--concurrency', type=int, default=8, help='requests in flight at most')
+    parser.add_argument('--rate', type=float, default=None, help='requests per second at most')
+    parser.add_argument('--repeat', type=int, default=1, help='times to replay the capture')
+    parser.add_argument('--limit', type=int, default=None, help='requests to send at most')
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+    args = parser.parse_args()
+    if args.capture == '-' and args.repeat != 1:
+        parser.error('--repeat needs a file')
+
+    result = asyncio.run(replay(args.capture, args.concurrency, args.rate, args.repeat, args.limit))
+    print(json.dumps(result.summary(), indent=2) if args.json else result.report())
+
+
+if __name__ == '__main__':
+    main()
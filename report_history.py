@@ -0,0 +1,170 @@
+import asyncio
+import collections
+import datetime
+import difflib
+import json
+import os
+import zlib
+from typing import Awaitable, Callable, Optional
+
+import async_db
+
+
+"""
+History of device reports, delta-compressed
+
+Every REPORT_HISTORY_KEYFRAME_INTERVAL-th stored report of a device is a
+keyframe: the whole text, zlib-compressed. The others are line-level diffs
+against their keyframe (not against the previous report), also compressed,
+so rebuilding any past report takes one keyframe and at most one delta.
+A delta that would not be smaller than half of its keyframe is stored as a
+new keyframe instead.
+
+Unchanged reports are not stored, and a device's reports are sampled at most
+once every REPORT_HISTORY_MIN_INTERVAL_SECONDS (nvidia-smi reports change
+on every heartbeat because of their clock).
+Rows older than REPORT_HISTORY_RETENTION_DAYS are deleted by maintenance.py,
+except keyframes still referenced by newer deltas.
+
+"""
+KEYFRAME_INTERVAL = int(os.environ.get('REPORT_HISTORY_KEYFRAME_INTERVAL') or 32)
+MIN_INTERVAL_SECONDS = float(os.environ.get('REPORT_HISTORY_MIN_INTERVAL_SECONDS') or 60)
+RETENTION_DAYS = float(os.environ.get('REPORT_HISTORY_RETENTION_DAYS') or 30)
+
+
+def encode_keyframe(text: str) -> bytes:
+    return zlib.compress(text.encode())
+
+
+def encode_delta(keyframe: list[str], text: str) -> bytes:
+    """
+    :param keyframe: lines of the keyframe, with line ends
+    :return: compressed list of [start, end] ranges of keyframe lines and literal texts
+    """
+    lines = text.splitlines(keepends=True)
+    ops: list = []
+    matcher = difflib.SequenceMatcher(None, keyframe, lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j1 < j2:  # insert or replace
+            ops.append(''.join(lines[j1:j2]))
+    return zlib.compress(json.dumps(ops, ensure_ascii=False, separators=(',', ':')).encode())
+
+
+def decode(payload: bytes, keyframe_payload: Optional[bytes] = None) -> str:
+    """
+    :param payload: a keyframe, or a delta along with its keyframe
+    :return: the report
+    """
+    if keyframe_payload is None:
+        return zlib.decompress(payload).decode()
+    keyframe = zlib.decompress(keyframe_payload).decode().splitlines(keepends=True)
+    return ''.join(
+        ''.join(keyframe[op[0]:op[1]]) if isinstance(op, list) else op
+        for op in json.loads(zlib.decompress(payload))
+    )
+
+
+class _DeviceHistory:
+    __slots__ = ('report', 'recorded_at', 'keyframe_id', 'keyframe', 'keyframe_size', 'deltas')
+
+    def __init__(self, report: str, recorded_at: datetime.datetime,
+                 keyframe_id: int, keyframe: list[str], keyframe_size: int) -> None:
+        self.report = report
+        self.recorded_at = recorded_at
+        self.keyframe_id = keyframe_id
+        self.keyframe = keyframe
+        self.keyframe_size = keyframe_size
+        self.deltas = 0
+
+
+class ReportHistory:
+    """
+    Writer of report_history. Each worker starts a new keyframe per device,
+    so deltas written by different workers stay decodable on their own.
+    Reports of the same device are recorded one at a time, so each one sees
+    the keyframe written before it.
+
+    """
+    def __init__(self,
+                 insert: Callable[[int, datetime.datetime, Optional[int], bytes], Awaitable[int]] = async_db.insert_report_history,
+                 keyframe_interval: int = KEYFRAME_INTERVAL, min_interval: float = MIN_INTERVAL_SECONDS) -> None:
+        self.insert = insert
+        self.keyframe_interval = keyframe_interval
+        self.min_interval = datetime.timedelta(seconds=min_interval)
+        self._devices: dict[int, _DeviceHistory] = {}
+        self._locks: collections.defaultdict[int, asyncio.Lock] = collections.defaultdict(asyncio.Lock)
+        self.keyframes = 0
+        self.deltas = 0
+        self.unchanged = 0
+        self.throttled = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+
+    async def record(self, device_id: int, report: Optional[str],
+                     at: Optional[datetime.datetime] = None) -> bool:
+        """
+        :return: whether the report was stored
+        """
+        if report is None:
+            return False
+        at = datetime.datetime.now().replace(microsecond=0) if at is None else at
+        async with self._locks[device_id]:
+            return await self._record(device_id, report, at)
+
+    async def _record(self, device_id: int, report: str, at: datetime.datetime) -> bool:
+        state = self._devices.get(device_id)
+        if state is not None:
+            if report == state.report:
+                self.unchanged += 1
+                return False
+            if at - state.recorded_at < self.min_interval:
+                self.throttled += 1
+                return False
+
+        payload = None
+        if state is not None and state.deltas + 1 < self.keyframe_interval:
+            payload = encode_delta(state.keyframe, report)
+            if len(payload) * 2 >= state.keyframe_size:  # drifted too far from the keyframe
+                payload = None
+
+        if payload is None:
+            payload = encode_keyframe(report)
+            report_id = await self.insert(device_id, at, None, payload)
+            self._devices[device_id] = _DeviceHistory(
+                report, at, report_id, report.splitlines(keepends=True), len(payload))
+            self.keyframes += 1
+        else:
+            await self.insert(device_id, at, state.keyframe_id, payload)
+            state.report, state.recorded_at = report, at
+            state.deltas += 1
+            self.deltas += 1
+        self.raw_bytes += len(report.encode())
+        self.stored_bytes += len(payload)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            'devices': len(self._devices),
+            'keyframes': self.keyframes,
+            'deltas': self.deltas,
+            'unchanged': self.unchanged,
+            'throttled': self.throttled,
+            'raw_bytes': self.raw_bytes,
+            'stored_bytes': self.stored_bytes,
+        }
+
+
+async def report_at(device_name: str, at: datetime.datetime) -> Optional[tuple[datetime.datetime, str]]:
+    """
+    :return: (recorded_at, report) of the last report stored at or before `at`
+    """
+    row = await async_db.select_report_history_at(device_name, at)
+    if row is None:
+        return None
+    recorded_at, payload, keyframe_payload = row
+    return recorded_at, decode(payload, keyframe_payload)
+
+
+report_history = ReportHistory()
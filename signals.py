@@ -0,0 +1,50 @@
+from db import Device
+
+
+"""
+Bodies of /json/signals responses
+
+A full response lists every device; a delta (`?since=<version>`) only the
+devices changed since that version, and `delta` tells the two apart.
+`version` is the cursor of async_db.select_devices_revision(), the oldest
+transaction still running, so it never goes backwards. A `since` above the
+current version therefore was not handed out by this database: a cursor of
+the revision sequence that preceded transaction IDs, or of another database.
+Such a client gets a full response and a fresh cursor instead of deltas that
+would leave out everything below its cursor.
+
+"""
+
+
+def device_to_json(device: Device, summary: bool = False) -> dict:
+    """
+    :param summary: leave out the report body
+    """
+    device = device.dict()
+    if device['last_heartbeat_timestamp'] is not None:
+        device['last_heartbeat_timestamp'] = str(device['last_heartbeat_timestamp'])
+    if summary:
+        del device['report']
+    return device
+
+
+def is_stale_cursor(since: int, version: int) -> bool:
+    """
+    :param since: cursor sent by the client
+    :param version: current cursor
+    """
+    return since > version
+
+
+def signals_body(version: int, devices: list[Device], heartbeat_log: list, summary: bool = False,
+                 delta: bool = False) -> dict:
+    """
+    :param summary: leave out report bodies
+    :param delta: `devices` are only those changed since the client's cursor
+    """
+    return {
+        'version': version,
+        'delta': delta,
+        'devices': [device_to_json(device, summary) for device in devices],
+        'heartbeat_log': heartbeat_log,
+    }
@@ -0,0 +1,105 @@
+import asyncio
+import email.utils
+import hashlib
+import os
+import time
+from typing import Awaitable, Callable, Optional
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
+
+
+"""
+Pre-serialized JSON shared by every client polling the same endpoint
+
+The body is rebuilt only after `invalidate()` (device state changed) or
+once it is older than `max_age` (for data derived from the clock, e.g. the
+hourly heartbeat log). Concurrent requests for a stale snapshot wait for a
+single rebuild.
+
+Responses carry an ETag (hash of the body) and Last-Modified (when the body
+last changed), so unchanged polls are answered with 304 Not Modified.
+
+"""
+SIGNALS_MAX_AGE_SECONDS = float(os.environ.get('SIGNALS_SNAPSHOT_MAX_AGE_SECONDS') or 60)
+
+
+class JSONSnapshot:
+    def __init__(self, build: Callable[[], Awaitable[object]], max_age: float = SIGNALS_MAX_AGE_SECONDS) -> None:
+        """
+        :param build: coroutine function returning the content to serialize
+        """
+        self.build = build
+        self.max_age = max_age
+        self.version = 0
+        self.body: Optional[bytes] = None
+        self.etag: Optional[str] = None
+        self.last_modified: Optional[float] = None  # unix time
+        self._built_version = -1
+        self._built_at = 0.0
+        self._lock = asyncio.Lock()
+        self.builds = 0
+        self.hits = 0
+        self.not_modified = 0
+
+    def invalidate(self) -> None:
+        self.version += 1
+
+    @property
+    def is_fresh(self) -> bool:
+        return (
+            self.body is not None
+            and self._built_version == self.version
+            and time.monotonic() - self._built_at < self.max_age
+        )
+
+    async def refresh(self) -> None:
+        if self.is_fresh:
+            self.hits += 1
+            return
+        async with self._lock:
+            if self.is_fresh:  # rebuilt while waiting for the lock
+                self.hits += 1
+                return
+            version = self.version
+            body = JSONResponse(jsonable_encoder(await self.build())).body
+            etag = '"%s"' % hashlib.sha256(body).hexdigest()[:32]
+            if etag != self.etag:
+                self.body, self.etag, self.last_modified = body, etag, time.time()
+            self._built_version = version
+            self._built_at = time.monotonic()
+            self.builds += 1
+
+    def is_not_modified(self, if_none_match: Optional[str], if_modified_since: Optional[str]) -> bool:
+        if if_none_match is not None:
+            return self.etag in (tag.strip() for tag in if_none_match.split(',')) or if_none_match.strip() == '*'
+        if if_modified_since is not None:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+            return int(self.last_modified) <= since.timestamp()
+        return False
+
+    async def response(self, if_none_match: Optional[str] = None,
+                       if_modified_since: Optional[str] = None) -> Response:
+        await self.refresh()
+        headers = {
+            'ETag': self.etag,
+            'Last-Modified': email.utils.formatdate(self.last_modified, usegmt=True),
+            'Cache-Control': 'no-cache',
+        }
+        try:
+            not_modified = self.is_not_modified(if_none_match, if_modified_since)
+        except (TypeError, ValueError):  # malformed date
+            not_modified = False
+        if not_modified:
+            self.not_modified += 1
+            return Response(status_code=304, headers=headers)
+        return Response(content=self.body, media_type='application/json', headers=headers)
+
+    def stats(self) -> dict:
+        return {
+            'version': self.version,
+            'size': len(self.body) if self.body is not None else 0,
+            'builds': self.builds,
+            'hits': self.hits,
+            'not_modified': self.not_modified,
+        }
@@ -5,17 +5,18 @@ const secondsFromNow = (date) => Math.trunc((Date.now() - date) / 1000);
 
 // d3.js
 d3.select("#tooltip").style("opacity", 0);
-function barChart(dataset, device_n, svg) {
+function barChart(history, device_n, svg) {  // history: { ts: [...], online: [...] }
   const width = 840;
   const height = 320;
-  
+  const n = history.ts.length;
+
   const xScale = d3.scaleBand()
-    .domain(d3.range(dataset.length))
+    .domain(d3.range(n))
     .rangeRound([0, width])
     .paddingInner(0.05);
 
   const yScale = d3.scaleLinear()
-    .domain([0, device_n])
+    .domain([0, Math.max(device_n, d3.max(history.online) || 0)])
     .range([0, height]);
 
   const datetime2Color = function(datetime) {
@@ -29,120 +30,86 @@ function barChart(dataset, device_n, svg) {
 
   const datetime2Readable = (datetime) => `${datetime.substr(0, 10)} ${datetime.substr(11, 5)} JST`;
 
-  if (svg === null) {  // First time
+  const first_time = (svg === null);
+  if (first_time) {
     svg = d3.select("#barchart")
       .attr("width", width)
       .attr("height", height);
-      
-    svg.selectAll("rect")
-      .data(dataset)
-      .enter()
-      .append("rect")
-      .attr("x", (_, i) => xScale(i))
-      .attr("y", (d) => height - yScale(d[1]))
-      .attr("width", xScale.bandwidth())
-      .attr("height", (d) => yScale(d[1]))
-      .attr("fill", (d) => datetime2Color(d[0]))
-      .on("mouseover", function(event, d) {
-        // Bar Color
-        d3.select(this).attr("fill", "rgb(238, 232, 170)");
-        // Tooltip
-        const tooltip = d3.select("#tooltip")
-          .style("left", event.pageX + "px")
-          .style("top", event.pageY + "px");
-        tooltip
-          .select("#tooltip_datetime")
-          .text(datetime2Readable(d[0]))
-        tooltip
-          .select("#tooltip_value")
-          .text(`${d[1]} device(s) was online.`);
-        d3.select("#tooltip").style("opacity", 1);
-      })
-      .on("mouseout", function(_) {
-        d3.select(this).transition().duration(250).attr("fill", (d) => datetime2Color(d[0]));
-        d3.select("#tooltip").style("opacity", 0);
-      });
-
-    svg.selectAll("text")
-      .data(dataset)
-      .enter()
-      .append("text")
-      .text((d) => d[1])
-      .attr("text-anchor", "middle")
-      .attr("x", (_, i) => xScale(i) + xScale.bandwidth() / 2)
-      .attr("y", (d) => height - yScale(d[1]) + 14)
-      .attr("font-family", "sans-serif")
-      .attr("font-size", "11px")
-      .attr("fill", "white")
-      .attr("pointer-events", "none");
-    return ;
   }
 
-  // on Update
-  svg.selectAll("rect")
-    .data(dataset)
-    .transition()
-    .delay((_, i) => i / dataset.length * 1000)
-    .duration(500)
-    .attr("x", (_, i) => xScale(i))
-    .attr("y", (d) => height - yScale(d[1]))
-    .attr("width", xScale.bandwidth())
-    .attr("height", (d) => yScale(d[1]))
-    .attr("fill", (d) => datetime2Color(d[0]))
-    .on("mouseover", function(event, d) {
+  // データは列ごとの配列なので、棒には添字だけを結びつける
+  const rects = svg.selectAll("rect")
+    .data(d3.range(n))
+    .join("rect")
+    .on("mouseover", function(event, i) {
       // Bar Color
       d3.select(this).attr("fill", "rgb(238, 232, 170)");
       // Tooltip
-      console.log(d[1]);
       const tooltip = d3.select("#tooltip")
         .style("left", event.pageX + "px")
         .style("top", event.pageY + "px");
       tooltip
         .select("#tooltip_datetime")
-        .text(datetime2Readable(d[0]))
+        .text(datetime2Readable(history.ts[i]))
       tooltip
         .select("#tooltip_value")
-        .text(`${d[1]} device(s) was online.`);
+        .text(`${history.online[i]} device(s) was online.`);
       d3.select("#tooltip").style("opacity", 1);
     })
-    .on("mouseout", function(_) {
-        d3.select(this).transition().duration(250).attr("fill", (d) => datetime2Color(d[0]));
+    .on("mouseout", function(_, i) {
+      d3.select(this).transition().duration(250).attr("fill", datetime2Color(history.ts[i]));
       d3.select("#tooltip").style("opacity", 0);
     });
 
-  svg.selectAll("text")
-    .data(dataset)
-    .text((d) => d)
+  const texts = svg.selectAll("text")
+    .data(n <= 48 ? d3.range(n) : [])  // 棒が細いときはラベルを出さない
+    .join("text")
+    .text((i) => history.online[i])
     .attr("text-anchor", "middle")
-    .attr("x", (d, i) => xScale(i) + xScale.bandwidth() / 2)
-    .attr("y", (d) => height - yScale(d) + 14)
     .attr("font-family", "sans-serif")
     .attr("font-size", "11px")
     .attr("fill", "white")
     .attr("pointer-events", "none");
+
+  (first_time ? rects : rects.transition().delay((i) => i / n * 1000).duration(500))
+    .attr("x", (i) => xScale(i))
+    .attr("y", (i) => height - yScale(history.online[i]))
+    .attr("width", xScale.bandwidth())
+    .attr("height", (i) => yScale(history.online[i]))
+    .attr("fill", (i) => datetime2Color(history.ts[i]));
+
+  texts
+    .attr("x", (i) => xScale(i) + xScale.bandwidth() / 2)
+    .attr("y", (i) => height - yScale(history.online[i]) + 14);
+
+  return svg;
 }
 
-function getSignals(use_barchart) {  // signal 記録を Ajax で更新
+function getHistory() {  // 稼働台数の推移を Ajax で取得
   axios
-    .get('/json/signals')
+    .get('/json/history', { params: this.history_range })
     .then(response => {
-      // 加工
-      this.last_signal_ts = response.data.devices;
-      this.last_signal_ts.forEach((item, i) => {
-        item.timestamp = str2Date(item.last_heartbeat_timestamp);
-        item.past_seconds = secondsFromNow(item.timestamp);
-      });
-
-      // 直近の Online 集計データを可視化
-      if (use_barchart) {
-        barChart(
-          // response.data.heartbeat_log.map((item, i) => item[1]),
-          response.data.heartbeat_log,
-          this.last_signal_ts.length,
-          this.svg,
-        );
-      }
+      const device_n = this.last_signal_ts === null ? 0 : this.last_signal_ts.length;
+      this.svg = barChart(response.data, device_n, this.svg);
     })
+    .catch(error => {
+      console.error(error);
+    });
+};
+
+function applySignals(data) {  // signal 記録の全体を反映
+  // 加工
+  this.last_signal_ts = data.devices;
+  this.last_signal_ts.forEach((item, i) => {
+    item.timestamp = str2Date(item.last_heartbeat_timestamp);
+    item.past_seconds = secondsFromNow(item.timestamp);
+  });
+};
+
+function getSignals() {  // signal 記録を Ajax で更新
+  axios
+    .get('/json/signals')
+    .then(response => applySignals.call(this, response.data))
     .catch(error => {
       console.error(error);
       this.errored = true;
@@ -150,6 +117,40 @@ function getSignals(use_barchart) {  // signal 記録を Ajax で更新
     .finally(() => this.loading = false);
 };
 
+function applyDeviceEvent(data) {  // 1台分の差分を反映
+  if (this.last_signal_ts === null) {
+    return;
+  }
+  let item = this.last_signal_ts.find(device => device.device_name === data.device_name);
+  if (item === undefined) {  // 新しく登録されたデバイス
+    item = {...data};
+    this.last_signal_ts.push(item);
+  } else {
+    Object.assign(item, data);
+  }
+  if ('last_heartbeat_timestamp' in data) {
+    item.timestamp = str2Date(item.last_heartbeat_timestamp);
+    item.past_seconds = secondsFromNow(item.timestamp);
+  }
+  this.$set(this.last_signal_ts, this.last_signal_ts.indexOf(item), item);  // Vue に変更を検知させるため
+};
+
+function subscribeSignals() {  // Server-Sent Events で差分を受け取る
+  if (!window.EventSource) {
+    return null;  // polling にフォールバック
+  }
+  const source = new EventSource('/events/signals');
+  source.addEventListener('snapshot', event => {
+    applySignals.call(this, JSON.parse(event.data));
+    this.errored = false;
+    this.loading = false;
+  });
+  ['heartbeat', 'is_active', 'return_message', 'registered'].forEach(name => {
+    source.addEventListener(name, event => applyDeviceEvent.call(this, JSON.parse(event.data)));
+  });
+  return source;  // 切断時は EventSource が自動で再接続し、snapshot から始め直す
+};
+
 function updateReturnMessage(device_name, return_message, access_token) {
   const params = new URLSearchParams();
   params.append('name', device_name);
@@ -170,10 +171,18 @@ const hbSignalsComponent = {
   data: () => ({
     last_signal_ts: null,
     svg: null,  // for d3.js
+    history_range: { resolution: '1h' },  // 省略した start / end はサーバ側で直近24時間になる
+    history_ranges: [
+      { label: '24 hours', resolution: '1h', days: 1 },
+      { label: '7 days', resolution: '6h', days: 7 },
+      { label: '30 days', resolution: '1d', days: 30 },
+    ],
     loading: true,
     errored: false,
     update_interval: null,
     ajax_interval: null,
+    history_interval: null,
+    event_source: null,
   }),
 
   filters: {
@@ -212,11 +221,21 @@ const hbSignalsComponent = {
 
   methods: {
     isOver1Day: (seconds) => (seconds > 86400) ? 'warn' : '',
+    selectHistoryRange: function(range) {
+      const start = new Date(Date.now() - range.days * 86400 * 1000);
+      this.history_range = { start: start.toISOString(), resolution: range.resolution };
+      getHistory.call(this);
+    },
   },
 
   mounted() {
-    setTimeout(getSignals.bind(this), 0, true);
-    this.ajax_interval = setInterval(getSignals.bind(this), 60000, true);  // 1 minutes
+    this.event_source = subscribeSignals.call(this);
+    if (this.event_source === null) {
+      setTimeout(getSignals.bind(this), 0);
+      this.ajax_interval = setInterval(getSignals.bind(this), 60000);  // 1 minutes
+    }
+    setTimeout(getHistory.bind(this), 0);
+    this.history_interval = setInterval(getHistory.bind(this), 600000);  // 10 minutes
 
     this.update_interval = setInterval((function() {  // 経過時間を1秒ごとに更新
       this.last_signal_ts.forEach((item, i) => {
@@ -231,6 +250,10 @@ const hbSignalsComponent = {
   destroyed() {
     clearInterval(this.update_interval);
     clearInterval(this.ajax_interval);
+    clearInterval(this.history_interval);
+    if (this.event_source !== null) {
+      this.event_source.close();
+    }
   },
 };
 
@@ -240,17 +263,24 @@ const reportComponent = {
   data: () => ({
     last_signal_ts: null,
     ajax_interval: null,
+    event_source: null,
     loading: true,
     errored: false,
   }),
 
   mounted() {
-    setTimeout(getSignals.bind(this), 0, false);
-    this.ajax_interval = setInterval(getSignals.bind(this), 300000, false);  // 5 minutes
+    this.event_source = subscribeSignals.call(this);
+    if (this.event_source === null) {
+      setTimeout(getSignals.bind(this), 0);
+      this.ajax_interval = setInterval(getSignals.bind(this), 300000);  // 5 minutes
+    }
   },
 
   destroyed() {
     clearInterval(this.ajax_interval);
+    if (this.event_source !== null) {
+      this.event_source.close();
+    }
   },
 };
 
@@ -297,7 +327,7 @@ const returnMessageComponent = {
   },
 
   mounted() {
-    setTimeout(getSignals.bind(this), 0, false);
+    setTimeout(getSignals.bind(this), 0);
   }
 };
 
@@ -306,6 +336,7 @@ const deviceRegisterComponent = {
 
   data: () => ({
     new_device_name: null,
+    issued_token: null,
     error: null,
     loading: false,
     tried: false,
@@ -320,12 +351,16 @@ const deviceRegisterComponent = {
 
       this.loading = true;
       this.error = null;
+      this.issued_token = null;
       const params = new URLSearchParams();
       params.append('device_name', this.new_device_name);
       axios
         .post('/api/v2/register/device', params, {
           'headers': { 'Authorization': 'Bearer ' + vm.token.access_token }
         })
+        .then(response => {
+          this.issued_token = response.data.token;  // 一度しか表示されない
+        })
         .catch(error => {
           console.error(error);
           this.error = error;
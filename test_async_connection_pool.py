@@ -0,0 +1,127 @@
+import asyncio
+import itertools
+import unittest
+from unittest import mock
+
+import asyncpg
+
+from async_db import AsyncConnectionPool
+
+
+class FakeConnection:
+    pids = itertools.count(100)
+
+    def __init__(self) -> None:
+        self.pid = next(self.pids)
+        self.broken = False
+        self.terminated = False
+        self.listeners = []
+
+    def get_server_pid(self) -> int:
+        return self.pid
+
+    def add_termination_listener(self, callback) -> None:
+        self.listeners.append(callback)
+
+    async def execute(self, sql: str) -> None:
+        if self.broken:
+            raise asyncpg.InterfaceError('connection is closed')
+
+    def is_closed(self) -> bool:
+        return self.terminated
+
+    def terminate(self) -> None:
+        self.terminated = True
+        for callback in self.listeners:
+            callback(self)
+
+
+class FakePool:
+    """
+    Hands out the idle connections in order, opening new ones through the init callback.
+
+    """
+    def __init__(self, init) -> None:
+        self.init = init
+        self.idle: list[FakeConnection] = []
+
+    async def acquire(self, timeout: float) -> FakeConnection:
+        while self.idle:
+            conn = self.idle.pop(0)
+            if not conn.terminated:
+                return conn
+        conn = FakeConnection()
+        await self.init(conn)
+        return conn
+
+    async def release(self, conn: FakeConnection) -> None:
+        if not conn.terminated:
+            self.idle.append(conn)
+
+    def get_size(self) -> int:
+        return len(self.idle)
+
+    def get_idle_size(self) -> int:
+        return len(self.idle)
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestAsyncConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('async_db.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = AsyncConnectionPool('postgresql://stub', max_lifetime=60.0, health_check_interval=30.0)
+        self.pool._pool = FakePool(self.pool._init)
+
+    def borrow(self) -> FakeConnection:
+        async def run():
+            async with self.pool.connection() as conn:
+                return conn
+        return asyncio.run(run())
+
+    def test_reuse(self):
+        first = self.borrow()
+        self.clock.now += 10
+        self.assertIs(self.borrow(), first)
+        self.assertEqual(self.pool.stats()['connections_created'], 1)
+
+    def test_recycle_after_max_lifetime(self):
+        first = self.borrow()
+        self.clock.now += 61
+        renewed = self.borrow()
+        self.assertIsNot(renewed, first)
+        self.assertTrue(first.terminated)
+        self.assertEqual(self.pool.stats()['connections_recycled'], 1)
+        self.assertNotIn(first.pid, self.pool._created_at)
+
+    def test_failed_health_check_is_discarded(self):
+        first = self.borrow()
+        first.broken = True
+        self.clock.now += 31
+        renewed = self.borrow()
+        self.assertIsNot(renewed, first)
+        self.assertTrue(first.terminated)
+        self.assertEqual(self.pool.stats()['health_check_failures'], 1)
+
+    def test_healthy_idle_connection_is_kept(self):
+        first = self.borrow()
+        self.clock.now += 31
+        self.assertIs(self.borrow(), first)
+        self.assertEqual(self.pool.stats()['health_check_failures'], 0)
+
+    def test_settings_are_checked(self):
+        with self.assertRaises(TypeError):
+            AsyncConnectionPool('postgresql://stub', max_lifetim=60.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import datetime
+import unittest
+
+import availability
+
+
+class TestAvailability(unittest.TestCase):
+    bucket = datetime.datetime(2021, 6, 10, 12)
+    now = datetime.datetime(2021, 6, 10, 12, 30)
+
+    def summarize(self, devices, uptime=(), outages=()):
+        return availability.summarize(list(devices), list(uptime), list(outages), self.bucket, self.now, minute_interval=60)
+
+    def test_window_starts(self):
+        self.assertEqual(availability.window_starts(datetime.datetime(2021, 6, 10, 12, 30)), [
+            datetime.datetime(2021, 6, 9, 13),
+            datetime.datetime(2021, 6, 3, 13),
+            datetime.datetime(2021, 5, 11, 13),
+        ])
+
+    def test_uptime(self):
+        result = self.summarize(
+            [(1, 'GPU480', datetime.datetime(2021, 6, 10, 12, 29), self.bucket)],
+            uptime=[(1, 0, 18), (1, 1, 84), (1, 2, 84)],
+        )['GPU480']
+        self.assertEqual(result['uptime'], {'24h': 0.75, '7d': 0.5, '30d': round(84 / 720, 4)})
+        self.assertEqual(result['last_seen_seconds'], 60)
+        self.assertIsNone(result['current_outage'])
+
+    def test_outages(self):
+        outages = [
+            (1, datetime.datetime(2021, 6, 1, 0), datetime.datetime(2021, 6, 3, 0)),  # 48h, only in 30d
+            (1, datetime.datetime(2021, 6, 9, 10), datetime.datetime(2021, 6, 9, 16)),  # 6h, 3h of it in 24h
+        ]
+        result = self.summarize([(1, 'GPU480', None, datetime.datetime(2021, 6, 10, 9))], outages=outages)['GPU480']
+        self.assertEqual(result['current_outage']['seconds'], 2 * 3600)  # 10:00 and 11:00 missed
+        self.assertEqual(result['longest_outage']['24h']['seconds'], 3 * 3600)
+        self.assertEqual(result['longest_outage']['7d']['seconds'], 6 * 3600)
+        self.assertEqual(result['longest_outage']['30d']['seconds'], 48 * 3600)
+        self.assertIsNone(result['last_seen_seconds'])
+
+    def test_never_logged(self):
+        result = self.summarize([(2, 'NEW001', None, None)])['NEW001']
+        self.assertEqual(result['uptime'], {'24h': 0.0, '7d': 0.0, '30d': 0.0})
+        self.assertEqual(result['longest_outage'], {'24h': None, '7d': None, '30d': None})
+        self.assertIsNone(result['current_outage'])
+
+
+if __name__ == '__main__':
+    unittest.main()
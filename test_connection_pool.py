@@ -0,0 +1,159 @@
+import unittest
+from unittest import mock
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+from connection_pool import ConnectionPool, PooledConnection, PoolTimeoutError
+
+
+class FakeCursor:
+    def __init__(self, conn: "FakeConnection") -> None:
+        self.conn = conn
+
+    def __enter__(self) -> "FakeCursor":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        pass
+
+    def execute(self, sql: str) -> None:
+        if self.conn.broken:
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+
+
+class FakeConnection:
+    def __init__(self) -> None:
+        self.closed = 0
+        self.broken = False
+
+    def cursor(self) -> FakeCursor:
+        return FakeCursor(self)
+
+    def get_transaction_status(self) -> int:
+        return TRANSACTION_STATUS_IDLE
+
+    def commit(self) -> None:
+        pass
+
+    def rollback(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = 1
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class StubPool(ConnectionPool):
+    def _connect(self) -> PooledConnection:
+        return PooledConnection(FakeConnection())
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch('connection_pool.time.monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def pool(self, **kwargs) -> StubPool:
+        settings = {'min_size': 0, 'max_size': 2, 'timeout': 0.0, 'max_lifetime': 3600.0,
+                    'max_idle': 600.0, 'health_check_interval': 30.0}
+        settings.update(kwargs)
+        return StubPool('postgresql://stub', **settings)
+
+    def test_lifo_reuse(self):
+        pool = self.pool()
+        first, second = pool.getconn(), pool.getconn()
+        pool.putconn(first)
+        pool.putconn(second)
+        self.assertIs(pool.getconn(), second)
+        self.assertEqual(pool.stats()['connections_created'], 2)
+
+    def test_exhaustion_and_timeout(self):
+        pool = self.pool(max_size=1)
+        entry = pool.getconn()
+        with self.assertRaises(PoolTimeoutError):
+            pool.getconn()
+        self.assertEqual(pool.stats()['timeouts'], 1)
+        pool.putconn(entry)
+        self.assertIs(pool.getconn(), entry)
+
+    def test_recycle_after_max_lifetime(self):
+        pool = self.pool(max_lifetime=60.0)
+        entry = pool.getconn()
+        pool.putconn(entry)
+        self.clock.now += 61
+        renewed = pool.getconn()
+        self.assertIsNot(renewed, entry)
+        self.assertTrue(entry.conn.closed)
+        self.assertEqual(pool.stats()['connections_recycled'], 1)
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_failed_health_check_is_discarded(self):
+        pool = self.pool(health_check_interval=30.0)
+        entry = pool.getconn()
+        pool.putconn(entry)
+        entry.conn.broken = True
+        self.clock.now += 31
+        renewed = pool.getconn()
+        self.assertIsNot(renewed, entry)
+        self.assertTrue(entry.conn.closed)
+        self.assertEqual(pool.stats()['health_check_failures'], 1)
+
+    def test_healthy_idle_connection_is_kept(self):
+        pool = self.pool(health_check_interval=30.0)
+        entry = pool.getconn()
+        pool.putconn(entry)
+        self.clock.now += 31
+        self.assertIs(pool.getconn(), entry)
+
+    def test_shrink_after_max_idle(self):
+        pool = self.pool(min_size=1, max_idle=600.0)
+        first, second = pool.getconn(), pool.getconn()
+        pool.putconn(first)
+        self.clock.now += 601
+        pool.putconn(second)  # first has idled too long; min_size keeps second
+        self.assertTrue(first.conn.closed)
+        self.assertFalse(second.conn.closed)
+        self.assertEqual(pool.stats()['size'], 1)
+
+    def test_broken_connection_is_not_returned(self):
+        pool = self.pool()
+        entry = pool.getconn()
+        entry.conn.close()
+        pool.putconn(entry)
+        self.assertEqual(pool.stats()['idle'], 0)
+        self.assertEqual(pool.stats()['size'], 0)
+
+    def test_reset_after_fork(self):
+        pool = self.pool(max_size=1)
+        idle = pool.getconn()
+        pool.putconn(idle)
+        checked_out = pool.getconn()
+        with mock.patch('connection_pool.os.getpid', return_value=-1):  # now in a forked child
+            pool.putconn(checked_out)  # the parent's connection is not taken back
+            self.assertEqual(pool.stats()['idle'], 0)
+            child_entry = pool.getconn()  # nor reused: the child opens its own
+            self.assertIsNot(child_entry, idle)
+            self.assertEqual(pool.stats()['size'], 1)
+            self.assertEqual(pool.stats()['in_use'], 1)
+
+    def test_closed_pool(self):
+        pool = self.pool()
+        pool.putconn(pool.getconn())
+        pool.close()
+        with self.assertRaises(PoolTimeoutError):
+            pool.getconn()
+        self.assertEqual(pool.stats()['size'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import time
+import unittest
+
+from device_auth import (DeviceTokenIndex, FailureRateLimiter, VerificationCache, client_address, issue_token,
+                         parse_trusted_proxies, token_digest)
+
+
+class TestVerificationCache(unittest.TestCase):
+    def test_hit_after_add(self):
+        cache = VerificationCache(max_size=4, ttl=60)
+        digest = cache.digest('password')
+        self.assertFalse(cache.contains(digest))
+        cache.add(digest)
+        self.assertTrue(cache.contains(digest))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_digest_is_keyed(self):
+        self.assertNotEqual(
+            VerificationCache().digest('password'),
+            VerificationCache().digest('password')
+        )
+
+    def test_expired(self):
+        cache = VerificationCache(max_size=4, ttl=0.01)
+        digest = cache.digest('password')
+        cache.add(digest)
+        time.sleep(0.02)
+        self.assertFalse(cache.contains(digest))
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_lru_eviction(self):
+        cache = VerificationCache(max_size=2, ttl=60)
+        a, b, c = (cache.digest(p) for p in 'abc')
+        cache.add(a)
+        cache.add(b)
+        self.assertTrue(cache.contains(a))  # b is now the least recently used
+        cache.add(c)
+        self.assertTrue(cache.contains(a))
+        self.assertFalse(cache.contains(b))
+        self.assertTrue(cache.contains(c))
+
+
+class TestFailureRateLimiter(unittest.TestCase):
+    def test_limited_after_max_failures(self):
+        limiter = FailureRateLimiter(max_failures=3, window=60)
+        for _ in range(3):
+            self.assertFalse(limiter.is_limited('10.0.0.1'))
+            limiter.record_failure('10.0.0.1')
+        self.assertTrue(limiter.is_limited('10.0.0.1'))
+        self.assertFalse(limiter.is_limited('10.0.0.2'))
+
+    def test_window_expires(self):
+        limiter = FailureRateLimiter(max_failures=1, window=0.01)
+        limiter.record_failure('10.0.0.1')
+        self.assertTrue(limiter.is_limited('10.0.0.1'))
+        time.sleep(0.02)
+        self.assertFalse(limiter.is_limited('10.0.0.1'))
+
+    def test_bounded_clients_fail_closed(self):
+        limiter = FailureRateLimiter(max_failures=2, window=60, max_clients=2)
+        for client in ('a', 'b', 'c'):
+            limiter.record_failure(client)
+        self.assertEqual(limiter.stats()['clients'], 2)
+        limiter.record_failure('a')
+        self.assertTrue(limiter.is_limited('a'))  # not evicted by the flood
+        self.assertFalse(limiter.is_limited('b'))
+        self.assertTrue(limiter.is_limited('c'))  # table full: rejected
+
+    def test_full_table_frees_expired_clients(self):
+        limiter = FailureRateLimiter(max_failures=2, window=0.01, max_clients=1)
+        limiter.record_failure('a')
+        self.assertTrue(limiter.is_limited('b'))
+        time.sleep(0.02)
+        self.assertFalse(limiter.is_limited('b'))
+
+    def test_rotating_forwarded_for(self):
+        limiter = FailureRateLimiter(max_failures=3, window=60)
+        for i in range(5):
+            limiter.record_failure(client_address('203.0.113.7', '10.0.0.%d' % i, trusted=[]))
+        self.assertTrue(limiter.is_limited(client_address('203.0.113.7', '10.0.0.99', trusted=[])))
+
+
+class TestClientAddress(unittest.TestCase):
+    trusted = parse_trusted_proxies('10.1.0.0/16, 192.0.2.1')
+
+    def test_untrusted_peer(self):
+        self.assertEqual(client_address('203.0.113.7', '198.51.100.1', trusted=self.trusted), '203.0.113.7')
+        self.assertEqual(client_address('203.0.113.7', None, trusted=self.trusted), '203.0.113.7')
+
+    def test_trusted_proxies(self):
+        self.assertEqual(client_address('192.0.2.1', 'forged, 198.51.100.1', trusted=self.trusted), '198.51.100.1')
+        self.assertEqual(client_address('192.0.2.1', 'forged, 198.51.100.1, 10.1.2.3', trusted=self.trusted),
+                         '198.51.100.1')
+
+    def test_any_peer_single_hop(self):
+        trusted = parse_trusted_proxies('*')
+        self.assertEqual(client_address('10.9.9.9', 'forged, 198.51.100.1', trusted=trusted), '198.51.100.1')
+
+
+class TestDeviceTokenIndex(unittest.TestCase):
+    def test_issue_token(self):
+        token, digest = issue_token()
+        self.assertEqual(token_digest(token), digest)
+        self.assertNotEqual(issue_token()[0], token)
+
+    def test_load_and_get(self):
+        index = DeviceTokenIndex()
+        index.load([(1, 'GPU480', token_digest('a')), (2, 'SMC101', token_digest('b'))])
+        self.assertEqual(index.get(token_digest('b')), (2, 'SMC101'))
+        self.assertIsNone(index.get(token_digest('c')))
+
+    def test_reissue_replaces_token(self):
+        index = DeviceTokenIndex()
+        index.add(token_digest('a'), 1, 'GPU480')
+        index.add(token_digest('b'), 1, 'GPU480')
+        self.assertIsNone(index.get(token_digest('a')))
+        self.assertEqual(index.get(token_digest('b')), (1, 'GPU480'))
+
+    def test_revoke(self):
+        index = DeviceTokenIndex()
+        index.add(token_digest('a'), 1, 'GPU480')
+        index.remove(1)
+        self.assertIsNone(index.get(token_digest('a')))
+        self.assertEqual(index.stats()['size'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import asyncio
+import json
+import unittest
+
+from events import Broadcaster, format_event
+
+
+class TestBroadcaster(unittest.TestCase):
+    def test_format_event(self):
+        self.assertEqual(
+            format_event('heartbeat', {'device_name': 'GPU480'}, 3),
+            b'id: 3\nevent: heartbeat\ndata: {"device_name": "GPU480"}\n\n'
+        )
+
+    def test_format_event_line_breaks(self):
+        report = 'line 1\nline 2\u2028line 3\u2029\r\x85\u3042'
+        message = format_event('heartbeat', {'report': report})
+        self.assertEqual(message.count(b'\n'), 3)  # event, data and the blank line
+        self.assertTrue(message.isascii())
+        data = message.decode().splitlines()[1]
+        self.assertEqual(json.loads(data[len('data: '):]), {'report': report})
+
+    def test_publish(self):
+        async def run():
+            broadcaster = Broadcaster()
+            with broadcaster.subscribe() as a, broadcaster.subscribe() as b:
+                broadcaster.publish('is_active', {'is_active': False})
+                self.assertEqual(a.get_nowait(), b.get_nowait())
+            broadcaster.publish('is_active', {'is_active': True})  # nobody listening
+            self.assertEqual(broadcaster.stats()['subscribers'], 0)
+
+        asyncio.run(run())
+
+    def test_drop_slow_subscriber(self):
+        async def run():
+            broadcaster = Broadcaster(queue_size=2)
+            with broadcaster.subscribe() as slow:
+                for i in range(3):
+                    broadcaster.publish('heartbeat', {'i': i})
+                self.assertEqual(broadcaster.stats()['subscribers'], 0)
+                self.assertEqual(broadcaster.stats()['dropped'], 1)
+                messages = [slow.get_nowait(), slow.get_nowait()]
+                self.assertIn(b'"i": 1', messages[0])  # the oldest made room for the end mark
+                self.assertIsNone(messages[1])
+
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import asyncio
+import datetime as dt
+import unittest
+from unittest import mock
+
+from db import Device, report_digest
+from fleet_stats import ALIVE_SECONDS, SAME_REPORT_MARKER, FleetStats, UnknownReportError
+import fleet_stats
+import mhpl_functions
+
+
+NOW = 1_700_000_000.0
+
+
+def device(name: str, seconds_ago: float|None, is_active: bool = True) -> Device:
+    last_heartbeat = None
+    if seconds_ago is not None:
+        last_heartbeat = dt.datetime.fromtimestamp(NOW - seconds_ago, tz=dt.timezone.utc)
+    return Device(device_name=name, last_heartbeat_timestamp=last_heartbeat,
+                  report='report of %s' % name, return_message='', is_active=is_active)
+
+
+class TestFleetStats(unittest.TestCase):
+    def setUp(self):
+        self.fleet = FleetStats.from_devices([
+            device('A', 60),
+            device('B', 2 * ALIVE_SECONDS),
+            device('C', None, is_active=False),
+            device('D', ALIVE_SECONDS - 60),
+        ], now=NOW)
+
+    def test_load(self):
+        self.assertTrue(self.fleet.loaded)
+        self.assertEqual(self.fleet.summary(now=NOW), {
+            'devices': 4,
+            'alives': 2,
+            'deads': 2,
+            'available_devices': 3,
+        })
+        self.assertEqual(self.fleet.report('A'), 'report of A')
+        self.assertIsNone(self.fleet.report('Z'))
+
+    def test_resolve_report(self):
+        self.assertEqual(self.fleet.resolve_report('A', SAME_REPORT_MARKER), ('report of A', None, None))
+        self.assertEqual(self.fleet.resolve_report('A', 'report of A'), ('report of A', None, report_digest('report of A')))
+        self.assertEqual(self.fleet.resolve_report('A', None), ('', '', report_digest('')))
+
+    def test_resolve_unknown_report(self):
+        for name in ('C', 'Z'):  # no heartbeat yet, unknown device
+            with self.assertRaises(UnknownReportError):
+                self.fleet.resolve_report(name, SAME_REPORT_MARKER)
+        self.fleet.register('E')
+        with self.assertRaises(UnknownReportError):
+            self.fleet.resolve_report('E', SAME_REPORT_MARKER)
+        self.fleet.heartbeat('E', 'report of E', at=NOW)
+        self.assertEqual(self.fleet.resolve_report('E', SAME_REPORT_MARKER), ('report of E', None, None))
+
+    def test_expire(self):
+        self.assertEqual(self.fleet.alive_n(now=NOW + 60), 1)  # D passed 24 hours
+        self.assertEqual(self.fleet.alive_n(now=NOW + ALIVE_SECONDS), 0)
+        self.assertEqual(self.fleet.stats()['expired'], 2)
+
+    def test_heartbeat(self):
+        self.fleet.heartbeat('B', 'new report', at=NOW)
+        self.fleet.heartbeat('D', None, at=NOW)  # already alive: no double count
+        self.assertEqual(self.fleet.alive_n(now=NOW), 3)
+        self.assertEqual(self.fleet.report('B'), 'new report')
+        # the superseded deadline of D must not expire it
+        self.assertEqual(self.fleet.alive_n(now=NOW + 60), 3)
+        self.assertEqual(self.fleet.alive_n(now=NOW + ALIVE_SECONDS), 0)
+
+    def test_report_hash(self):
+        self.assertEqual(self.fleet.report_hash('A'), report_digest('report of A'))
+        self.fleet.heartbeat('A', None, at=NOW)
+        self.assertEqual(self.fleet.report_hash('A'), report_digest(''))
+        self.assertIsNone(self.fleet.report_hash('Z'))
+
+    def test_heartbeat_unknown_device(self):
+        self.fleet.heartbeat('E', 'hello', at=NOW)
+        self.assertEqual(self.fleet.device_n(), 5)
+        self.assertEqual(self.fleet.available_n(), 4)
+        self.assertEqual(self.fleet.alive_n(now=NOW), 3)
+
+    def test_register_and_set_active(self):
+        self.fleet.register('E')
+        self.fleet.register('E')
+        self.fleet.set_active('A', False)
+        self.fleet.set_active('A', False)
+        self.fleet.set_active('C', True)
+        self.assertEqual(self.fleet.device_n(), 5)
+        self.assertEqual(self.fleet.available_n(), 4)
+        self.assertEqual(self.fleet.alive_n(now=NOW), 2)
+
+    def test_compaction(self):
+        for i in range(1000):
+            self.fleet.heartbeat('A', None, at=NOW + i)
+        self.assertGreater(self.fleet.stats()['compactions'], 0)
+        self.assertLessEqual(self.fleet.stats()['heap_size'], 2 * self.fleet.device_n() + 64)
+        self.assertEqual(self.fleet.alive_n(now=NOW + 999), 1)  # A only; D expired
+
+
+class TestResync(unittest.TestCase):
+    def test_resync_after_max_age(self):
+        fleet = FleetStats()
+        devices = [device('A', 60)]
+        with mock.patch('mhpl_functions.fleet_stats', fleet), \
+             mock.patch('async_db.select_devices', mock.AsyncMock(return_value=devices)) as select, \
+             mock.patch('fleet_stats.time.monotonic', return_value=1000.0) as monotonic:
+            asyncio.run(mhpl_functions.resync_fleet_stats())  # not loaded yet
+            self.assertEqual(fleet.device_n(), 1)
+            devices.append(device('B', 60))
+            monotonic.return_value += fleet_stats.RESYNC_SECONDS
+            asyncio.run(mhpl_functions.resync_fleet_stats())
+            self.assertEqual(fleet.device_n(), 1)
+            monotonic.return_value += 1
+            asyncio.run(mhpl_functions.resync_fleet_stats())
+            self.assertEqual(fleet.device_n(), 2)
+        self.assertEqual(select.await_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import json
+import unittest
+
+import heartbeat_batch
+
+
+class TestHeartbeatBatch(unittest.TestCase):
+    def test_parse_json(self):
+        body = json.dumps({'heartbeats': [
+            {'device_name': 'A', 'report': 'hello'},
+            {'device_name': 'B'},
+        ]}).encode()
+        self.assertEqual(heartbeat_batch.parse(body, ndjson=False), [('A', 'hello'), ('B', None)])
+
+    def test_parse_ndjson(self):
+        body = b'{"device_name": "A", "report": "#same"}\n\n{"device_name": "B", "report": null}\n'
+        self.assertEqual(heartbeat_batch.parse(body, ndjson=True), [('A', '#same'), ('B', None)])
+
+    def test_parse_rejects(self):
+        for body in (b'{', b'[]', b'{"heartbeats": {}}', b'{"heartbeats": [1]}',
+                     b'{"heartbeats": [{"report": "x"}]}', b'{"heartbeats": [{"device_name": "A", "report": 1}]}'):
+            with self.assertRaises(ValueError):
+                heartbeat_batch.parse(body, ndjson=False)
+        with self.assertRaises(ValueError):
+            heartbeat_batch.parse(b'{"device_name": "A"}\n' * 3, ndjson=True, max_size=2)
+
+    def test_encode(self):
+        results = [{'device_name': 'A', 'status': 200, 'content': 'ok'}]
+        self.assertEqual(json.loads(heartbeat_batch.encode(results, ndjson=False)), {'results': results})
+        self.assertEqual(heartbeat_batch.encode(results * 2, ndjson=True).splitlines(),
+                         [json.dumps(results[0]).encode()] * 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
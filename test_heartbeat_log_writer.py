@@ -0,0 +1,60 @@
+import asyncio
+import datetime
+import unittest
+
+from heartbeat_log_writer import HeartbeatLogWriter
+
+
+BUCKET = datetime.datetime(2022, 1, 1, 9, 0)
+NEXT_BUCKET = datetime.datetime(2022, 1, 1, 10, 0)
+
+
+class TestHeartbeatLogWriter(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.fail = False
+
+        async def insert(rows):
+            if self.fail:
+                raise ConnectionError('database is down')
+            self.batches.append(rows)
+
+        self.writer = HeartbeatLogWriter(insert, batch_size=2)
+
+    def test_once_per_bucket(self):
+        async def run():
+            self.assertTrue(self.writer.add(1, BUCKET))
+            self.assertFalse(self.writer.add(1, BUCKET))
+            self.assertTrue(self.writer.add(1, NEXT_BUCKET))
+            self.assertEqual(self.writer.stats()['deduplicated'], 1)
+            await self.writer.close()
+
+        asyncio.run(run())
+        self.assertEqual(self.batches, [[(1, BUCKET), (1, NEXT_BUCKET)]])
+
+    def test_flush_in_batches(self):
+        async def run():
+            for device_id in range(3):
+                self.writer.add(device_id, BUCKET)
+            await self.writer.close()
+
+        asyncio.run(run())
+        self.assertEqual(self.batches, [[(0, BUCKET), (1, BUCKET)], [(2, BUCKET)]])
+        self.assertEqual(self.writer.stats()['pending'], 0)
+
+    def test_retry_after_failure(self):
+        async def run():
+            self.writer.add(1, BUCKET)
+            self.fail = True
+            await self.writer.flush()
+            self.assertEqual(self.writer.stats()['pending'], 1)
+            self.fail = False
+            await self.writer.flush()
+
+        asyncio.run(run())
+        self.assertEqual(self.batches, [[(1, BUCKET)]])
+        self.assertEqual(self.writer.stats()['failures'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
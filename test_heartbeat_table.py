@@ -0,0 +1,73 @@
+import asyncio
+import datetime
+import unittest
+
+from db import Device, gmt2jst
+from heartbeat_table import HeartbeatTable
+
+
+AT = datetime.datetime(2022, 1, 1, 9, 0, 0)
+LATER = datetime.datetime(2022, 1, 1, 9, 0, 30)
+
+
+class TestHeartbeatTable(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.fail = False
+
+        async def update(rows):
+            if self.fail:
+                raise ConnectionError('database is down')
+            self.batches.append(rows)
+
+        self.table = HeartbeatTable(update, batch_size=2)
+
+    def test_latest_per_device(self):
+        async def run():
+            self.table.touch(2, 'B', AT)
+            self.table.touch(1, 'A', LATER)
+            self.table.touch(1, 'A', AT)  # late arrival does not move it back
+            self.assertEqual(self.table.last_heartbeat('A'), LATER)
+            await self.table.close()
+
+        asyncio.run(run())
+        self.assertEqual(self.batches, [[(1, LATER), (2, AT)]])
+        self.assertEqual(self.table.stats()['pending'], 0)
+
+    def test_flush_in_batches(self):
+        async def run():
+            for device_id in range(3):
+                self.table.touch(device_id, str(device_id), AT)
+            await self.table.close()
+
+        asyncio.run(run())
+        self.assertEqual(self.batches, [[(0, AT), (1, AT)], [(2, AT)]])
+
+    def test_retry_after_failure(self):
+        async def run():
+            self.table.touch(1, 'A', AT)
+            self.fail = True
+            await self.table.flush()
+            self.table.touch(1, 'A', LATER)
+            self.fail = False
+            await self.table.flush()
+
+        asyncio.run(run())
+        self.assertEqual(self.batches, [[(1, LATER)]])
+        self.assertEqual(self.table.stats()['failures'], 1)
+
+    def test_read_through(self):
+        self.table.observe('A', LATER)
+        self.table.observe('B', AT)
+        devices = [
+            Device(device_name=name, last_heartbeat_timestamp=gmt2jst(last_heartbeat),
+                   report='', return_message='', is_active=True)
+            for name, last_heartbeat in (('A', AT), ('B', LATER), ('C', None))
+        ]
+        self.table.read_through(devices)
+        self.assertEqual([device.last_heartbeat_timestamp for device in devices],
+                         [gmt2jst(LATER), gmt2jst(LATER), None])
+
+
+if __name__ == '__main__':
+    unittest.main()
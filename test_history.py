@@ -0,0 +1,73 @@
+import datetime
+import unittest
+
+import history
+
+
+class TestHistory(unittest.TestCase):
+    now = datetime.datetime(2021, 6, 10, 13, 25, 0)
+
+    def test_parse_resolution(self):
+        self.assertEqual(history.parse_resolution('60'), 60)
+        self.assertEqual(history.parse_resolution('6h'), 360)
+        self.assertEqual(history.parse_resolution('1d'), 1440)
+        self.assertEqual(history.parse_resolution('15m', minute_interval=15), 15)
+        for text in ('15m', '90', '', '1w', '-1h'):
+            with self.assertRaises(ValueError):
+                history.parse_resolution(text)
+
+    def test_floor_time(self):
+        self.assertEqual(history.floor_time(self.now, 60), datetime.datetime(2021, 6, 10, 13))
+        self.assertEqual(history.floor_time(self.now, 360), datetime.datetime(2021, 6, 10, 12))
+        self.assertEqual(history.floor_time(self.now, 1440), datetime.datetime(2021, 6, 10))
+
+    def test_plan_default_range(self):
+        first, last, source = history.plan(None, None, 60, now=self.now)
+        self.assertEqual(first, datetime.datetime(2021, 6, 9, 13))
+        self.assertEqual(last, datetime.datetime(2021, 6, 10, 13))
+        self.assertEqual(source, 'counts')
+
+    def test_plan_end_is_exclusive(self):
+        start = datetime.datetime(2021, 6, 3)
+        first, last, _ = history.plan(start, datetime.datetime(2021, 6, 10), 360, now=self.now)
+        self.assertEqual(first, start)
+        self.assertEqual(last, datetime.datetime(2021, 6, 9, 18))
+
+    def test_plan_aware_datetimes(self):
+        start = datetime.datetime(2021, 6, 10, 3, tzinfo=datetime.timezone.utc)
+        end = datetime.datetime(2021, 6, 11, 3, tzinfo=datetime.timezone.utc)
+        first, last, _ = history.plan(start, end, 60, now=self.now)
+        self.assertEqual(first, start.astimezone().replace(tzinfo=None))
+        self.assertEqual(last - first, datetime.timedelta(hours=23))
+
+    def test_plan_rejects(self):
+        with self.assertRaises(ValueError):
+            history.plan(self.now, self.now - datetime.timedelta(hours=1), 60, now=self.now)
+        with self.assertRaises(ValueError):
+            history.plan(self.now - datetime.timedelta(days=3650), None, 60, now=self.now)
+
+    def test_choose_source(self):
+        year_ago = self.now - datetime.timedelta(days=365)
+        self.assertEqual(history.choose_source(self.now - datetime.timedelta(days=7), 360, self.now), 'counts')
+        self.assertEqual(history.choose_source(year_ago, 360, self.now), 'hourly')
+        self.assertEqual(history.choose_source(year_ago - datetime.timedelta(days=365), 1440, self.now), 'daily')
+
+    def test_choose_source_rejects_finer_resolution(self):
+        year_ago = self.now - datetime.timedelta(days=365)
+        self.assertEqual(history.choose_source(self.now - datetime.timedelta(days=7), 30, self.now), 'counts')
+        with self.assertRaises(ValueError):
+            history.choose_source(year_ago, 30, self.now)  # older than heartbeat_counts
+        with self.assertRaises(ValueError):
+            history.choose_source(year_ago - datetime.timedelta(days=365), 360, self.now)  # older than hourly rollups
+
+    def test_to_columns(self):
+        rows = [(datetime.datetime(2021, 6, 10, 0), 3, 12), (datetime.datetime(2021, 6, 10, 6), 0, 0)]
+        self.assertEqual(history.to_columns(rows, 360), {
+            'ts': [datetime.datetime(2021, 6, 10, 0), datetime.datetime(2021, 6, 10, 6)],
+            'online': [3, 0],
+            'online_avg': [2.0, 0.0],
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,262 @@
+import asyncio
+import datetime
+import unittest
+from contextlib import asynccontextmanager
+from unittest import mock
+
+import async_db
+import maintenance
+from maintenance import MaintenanceScheduler, MaintenanceTask
+
+
+class FakeMaintenanceDB:
+    """
+    advisory_lock and maintenance_runs of async_db, shared by the workers of a test.
+
+    """
+    def __init__(self) -> None:
+        self.now = 1000.0
+        self.lock_holder = None
+        self.last_run_at: dict[str, float] = {}
+        self.finished: dict[str, int] = {}
+
+    @asynccontextmanager
+    async def advisory_lock(self, key: int):
+        if self.lock_holder is not None:
+            yield False
+            return
+        self.lock_holder = key
+        try:
+            yield True
+        finally:
+            self.lock_holder = None
+
+    async def claim_maintenance_run(self, task_name: str, period_seconds: float) -> bool:
+        last_run_at = self.last_run_at.get(task_name)
+        if last_run_at is not None and last_run_at > self.now - period_seconds:
+            return False
+        self.last_run_at[task_name] = self.now
+        return True
+
+    async def retry_maintenance_run(self, task_name: str, period_seconds: float, delay_seconds: float) -> None:
+        self.last_run_at[task_name] = self.now + delay_seconds - period_seconds
+
+    async def finish_maintenance_run(self, task_name: str, rows: int) -> None:
+        self.finished[task_name] = rows
+
+
+class FakeConnection:
+    """
+    Records the statements run on it.
+
+    """
+    def __init__(self, status: str = 'INSERT 0 0', value: object = None) -> None:
+        self.status = status
+        self.value = value
+        self.statements: list[tuple] = []
+        self.transactions = 0
+
+    @asynccontextmanager
+    async def transaction(self):
+        self.transactions += 1
+        yield
+
+    async def execute(self, sql: str, *args) -> str:
+        self.statements.append((' '.join(sql.split()),) + args)
+        return self.status
+
+    async def fetchval(self, sql: str, *args) -> object:
+        self.statements.append((' '.join(sql.split()),) + args)
+        return self.value
+
+
+class FakePool:
+    def __init__(self, conn: FakeConnection) -> None:
+        self.conn = conn
+
+    @asynccontextmanager
+    async def connection(self):
+        yield self.conn
+
+
+class TestMaintenanceScheduler(unittest.TestCase):
+    def setUp(self):
+        self.db = FakeMaintenanceDB()
+        for name in ('advisory_lock', 'claim_maintenance_run', 'retry_maintenance_run', 'finish_maintenance_run'):
+            patcher = mock.patch('maintenance.async_db.%s' % name, getattr(self.db, name))
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.calls = 0
+        self.failing = False
+
+    async def purge(self) -> int:
+        self.calls += 1
+        if self.failing:
+            raise RuntimeError('database is down')
+        return 42
+
+    def worker(self) -> MaintenanceScheduler:
+        return MaintenanceScheduler([MaintenanceTask('purge', 3600.0, self.purge)], retry_seconds=60.0)
+
+    def test_run_once_per_period_across_workers(self):
+        a, b = self.worker(), self.worker()
+        asyncio.run(a.run_due())
+        asyncio.run(b.run_due())  # claimed by a within the period
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.db.finished, {'purge': 42})
+        self.assertEqual(a.stats()['tasks']['purge']['rows'], 42)
+        self.assertEqual(b.stats()['tasks']['purge']['runs'], 0)
+
+        self.db.now += 3600
+        asyncio.run(b.run_due())  # due again: whoever checks first takes it
+        asyncio.run(a.run_due())
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(b.stats()['tasks']['purge']['runs'], 1)
+        self.assertIsNone(self.db.lock_holder)
+
+    def test_skip_while_another_worker_holds_the_lock(self):
+        worker = self.worker()
+        self.db.lock_holder = 'other worker'
+        asyncio.run(worker.run_due())
+        self.assertEqual(self.calls, 0)
+        self.assertEqual(self.db.last_run_at, {})
+        self.assertEqual(worker.stats()['lock_busy'], 1)
+        self.assertEqual(worker.stats()['checks'], 1)
+
+    def test_backoff_after_failure(self):
+        worker = self.worker()
+        self.failing = True
+        asyncio.run(worker.run_due())
+        self.assertEqual(worker.stats()['tasks']['purge']['errors'], 1)
+        self.assertNotIn('purge', self.db.finished)
+
+        self.db.now += 59
+        asyncio.run(worker.run_due())
+        self.assertEqual(self.calls, 1)  # still backing off
+        self.db.now += 1
+        asyncio.run(worker.run_due())
+        self.assertEqual(self.calls, 2)  # failed again: wait twice as long
+
+        self.db.now += 119
+        asyncio.run(self.worker().run_due())
+        self.assertEqual(self.calls, 2)
+        self.db.now += 1
+        self.failing = False
+        asyncio.run(self.worker().run_due())  # any worker may retry
+        self.assertEqual(self.calls, 3)
+        self.assertEqual(self.db.finished, {'purge': 42})
+
+    def test_retry_delay(self):
+        worker = self.worker()
+        task = worker.tasks[0]
+        delays = []
+        for failures_in_row in range(1, 8):
+            task.failures_in_row = failures_in_row
+            delays.append(worker.retry_delay(task))
+        self.assertEqual(delays, [60.0, 120.0, 240.0, 480.0, 960.0, 1920.0, 3600.0])
+
+    def test_success_resets_backoff(self):
+        worker = self.worker()
+        self.failing = True
+        asyncio.run(worker.run_due())
+        self.db.now += 60
+        self.failing = False
+        asyncio.run(worker.run_due())
+        self.assertEqual(worker.stats()['tasks']['purge']['failures_in_row'], 0)
+        self.assertEqual(worker.stats()['tasks']['purge']['runs'], 1)
+
+
+class TestHeartbeatLogPartitions(unittest.TestCase):
+    def test_partition_name(self):
+        day = datetime.date(2021, 6, 1)
+        self.assertEqual(async_db.heartbeat_log_partition_name(day), 'heartbeat_log_p20210601')
+        self.assertEqual(async_db.heartbeat_log_partition_day('heartbeat_log_p20210601'), day)
+
+    def test_partitions_to_create(self):
+        now = datetime.datetime(2021, 6, 10, 12, 0)
+        existing = [datetime.date(2021, 6, day) for day in range(1, 11)]
+        self.assertEqual(maintenance.heartbeat_log_partitions_to_create(existing, now, 7, 3),
+                         [datetime.date(2021, 6, 11), datetime.date(2021, 6, 12), datetime.date(2021, 6, 13)])
+        self.assertEqual(len(maintenance.heartbeat_log_partitions_to_create([], now, 7, 3)), 7 + 1 + 3)
+        # the cutoff 0.75 days back falls on the day before; month and year ends are crossed
+        self.assertEqual(maintenance.heartbeat_log_partitions_to_create([], datetime.datetime(2021, 1, 1, 6), 0.75, 1),
+                         [datetime.date(2020, 12, 31), datetime.date(2021, 1, 1), datetime.date(2021, 1, 2)])
+
+    def test_partitions_to_drop(self):
+        existing = [datetime.date(2021, 6, day) for day in range(1, 6)]
+        # the partition of the cutoff day is kept; its old rows are deleted in batches
+        self.assertEqual(maintenance.heartbeat_log_partitions_to_drop(existing, datetime.datetime(2021, 6, 3, 12)),
+                         [datetime.date(2021, 6, 1), datetime.date(2021, 6, 2)])
+        self.assertEqual(maintenance.heartbeat_log_partitions_to_drop(existing, datetime.datetime(2021, 6, 1)), [])
+
+    def test_create_partition(self):
+        conn = FakeConnection(status='INSERT 0 3')
+        with mock.patch('async_db.pool', FakePool(conn)):
+            moved = asyncio.run(async_db.create_heartbeat_log_partition(datetime.date(2021, 12, 31)))
+        self.assertEqual(moved, 3)
+        self.assertEqual(conn.transactions, 1)
+        create, move, attach = conn.statements
+        self.assertIn('CREATE TABLE public.heartbeat_log_p20211231', create[0])
+        self.assertIn('DELETE FROM public.heartbeat_log_default', move[0])
+        self.assertIn('INSERT INTO public.heartbeat_log_p20211231', move[0])
+        self.assertEqual(move[1:], (datetime.date(2021, 12, 31), datetime.date(2022, 1, 1)))
+        self.assertIn("ATTACH PARTITION public.heartbeat_log_p20211231 FOR VALUES FROM ('2021-12-31') TO ('2022-01-01')",
+                      attach[0])
+
+    def test_drop_partition(self):
+        conn = FakeConnection(value=7)
+        with mock.patch('async_db.pool', FakePool(conn)):
+            dropped = asyncio.run(async_db.drop_heartbeat_log_partition(datetime.date(2021, 6, 1)))
+        self.assertEqual(dropped, 7)
+        self.assertEqual([statement[0] for statement in conn.statements], [
+            'SELECT COUNT(*) FROM public.heartbeat_log_p20210601;',
+            'DROP TABLE public.heartbeat_log_p20210601;',
+        ])
+
+    def test_ensure_partitions(self):
+        today = datetime.date.today()
+        existing = [today - datetime.timedelta(days=offset) for offset in range(8)]  # through the cutoff day
+        with mock.patch('async_db.select_heartbeat_log_partitions', mock.AsyncMock(return_value=existing)), \
+             mock.patch('async_db.create_heartbeat_log_partition', mock.AsyncMock(return_value=2)) as create:
+            moved = asyncio.run(maintenance.ensure_heartbeat_log_partitions(retention_days=7, ahead_days=2))
+        self.assertEqual([call.args[0] for call in create.call_args_list],
+                         [today + datetime.timedelta(days=1), today + datetime.timedelta(days=2)])
+        self.assertEqual(moved, 4)
+
+    def test_purge_heartbeat_log(self):
+        today = datetime.date.today()
+        existing = [today - datetime.timedelta(days=offset) for offset in (30, 8, 7, 0)]
+        with mock.patch('async_db.select_heartbeat_log_partitions', mock.AsyncMock(return_value=existing)), \
+             mock.patch('async_db.drop_heartbeat_log_partition', mock.AsyncMock(return_value=10)) as drop, \
+             mock.patch('async_db.delete_heartbeat_log_before', mock.AsyncMock(return_value=1)):
+            deleted = asyncio.run(maintenance.purge_heartbeat_log(retention_days=7, batch_size=5, pause=0))
+        self.assertEqual([call.args[0] for call in drop.call_args_list], existing[:2])
+        self.assertEqual(deleted, 21)
+
+
+class TestDeviceAvailability(unittest.TestCase):
+    def test_lookback_covers_late_rows(self):
+        with mock.patch('async_db.summarize_device_availability', mock.AsyncMock(return_value=9)) as summarize:
+            rows = asyncio.run(maintenance.summarize_device_availability(flush_seconds=5, minute_interval=60))
+        self.assertEqual(rows, 9)
+        summarize.assert_awaited_once_with(datetime.timedelta(hours=1, seconds=5), 60)
+
+
+class TestDeleteInBatches(unittest.TestCase):
+    def test_batches(self):
+        remaining = [12]
+        limits = []
+
+        async def delete(before: datetime.datetime, limit: int) -> int:
+            limits.append(limit)
+            deleted = min(limit, remaining[0])
+            remaining[0] -= deleted
+            return deleted
+
+        total = asyncio.run(maintenance.delete_in_batches(delete, datetime.datetime(2021, 6, 1), 5, pause=0))
+        self.assertEqual(total, 12)
+        self.assertEqual(limits, [5, 5, 5])
+
+
+if __name__ == '__main__':
+    unittest.main()
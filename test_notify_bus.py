@@ -0,0 +1,68 @@
+import asyncio
+import json
+import unittest
+
+from notify_bus import MAX_PAYLOAD_BYTES, WORKER_ID, Coalescer, decode, encode
+
+
+class TestNotifyBus(unittest.TestCase):
+    def test_skip_own_events(self):
+        self.assertIsNone(decode(encode('is_active', {'device_name': 'GPU480', 'is_active': False})))
+
+    def test_decode_other_worker(self):
+        payload = json.dumps({'worker': 'other', 'event': 'user', 'data': {'user_name': 'ryhoh'}})
+        self.assertEqual(decode(payload), ('user', {'user_name': 'ryhoh'}))
+
+    def test_long_report_truncated(self):
+        data = {'device_name': 'GPU480', 'report': 'あ' * 4096}
+        payload = encode('heartbeat', data)
+        self.assertLessEqual(len(payload.encode()), MAX_PAYLOAD_BYTES)
+        message = json.loads(payload)
+        self.assertEqual(message['worker'], WORKER_ID)
+        self.assertEqual(message['data'], {'device_name': 'GPU480', 'report_truncated': True})
+        self.assertIn('report', data)  # the caller's dict is left as is
+
+
+
+class TestCoalescer(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.failing = False
+        self.coalescer = Coalescer('heartbeat', 'device_name', send=self.send)
+
+    async def send(self, event: str, datas: list[dict]) -> None:
+        if self.failing:
+            raise OSError('connection refused')
+        self.sent.append((event, datas))
+
+    def test_last_event_of_each_key(self):
+        for at in ('09:00:00', '09:00:15', '09:00:30'):
+            self.coalescer.add({'device_name': 'GPU480', 'last_heartbeat_timestamp': at})
+        self.coalescer.add({'device_name': 'SMC101', 'last_heartbeat_timestamp': '09:00:05'})
+        asyncio.run(self.coalescer.flush())
+        self.assertEqual(self.sent, [('heartbeat', [
+            {'device_name': 'GPU480', 'last_heartbeat_timestamp': '09:00:30'},
+            {'device_name': 'SMC101', 'last_heartbeat_timestamp': '09:00:05'},
+        ])])
+        asyncio.run(self.coalescer.flush())  # nothing pending: no round trip
+        self.assertEqual(len(self.sent), 1)
+        self.assertEqual(self.coalescer.stats()['added'], 4)
+        self.assertEqual(self.coalescer.stats()['sent'], 2)
+
+    def test_discard(self):
+        self.coalescer.add({'device_name': 'GPU480', 'last_heartbeat_timestamp': '09:00:00'})
+        self.coalescer.discard('GPU480')
+        self.coalescer.discard('unknown')
+        asyncio.run(self.coalescer.flush())
+        self.assertEqual(self.sent, [])
+
+    def test_failure_drops_the_batch(self):
+        self.coalescer.add({'device_name': 'GPU480', 'last_heartbeat_timestamp': '09:00:00'})
+        self.failing = True
+        asyncio.run(self.coalescer.flush())
+        self.assertEqual(self.coalescer.stats()['failures'], 1)
+        self.assertEqual(self.coalescer.stats()['pending'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import unittest
+
+import nvidia_smi
+
+
+REPORT_450 = """Mon Mar  8 21:37:43 2021
++-----------------------------------------------------------------------------+
+| NVIDIA-SMI 450.102.04   Driver Version: 450.102.04   CUDA Version: 11.0     |
+|-------------------------------+----------------------+----------------------+
+| GPU  Name        Persistence-M| Bus-Id        Disp.A | Volatile Uncorr. ECC |
+| Fan  Temp  Perf  Pwr:Usage/Cap|         Memory-Usage | GPU-Util  Compute M. |
+|                               |                      |               MIG M. |
+|===============================+======================+======================|
+|   0  GeForce RTX 208...  Off  | 00000000:01:00.0 Off |                  N/A |
+| 30%   38C    P8    20W / 250W |   9231MiB / 11019MiB |     87%      Default |
+|                               |                      |                  N/A |
++-------------------------------+----------------------+----------------------+
+|   1  GeForce RTX 208...  Off  | 00000000:02:00.0 Off |                  N/A |
+| 27%   31C    P8     1W / 250W |      1MiB / 11019MiB |      0%      Default |
+|                               |                      |                  N/A |
++-------------------------------+----------------------+----------------------+
+
++-----------------------------------------------------------------------------+
+| Processes:                                                                  |
+|  GPU   GI   CI        PID   Type   Process name                  GPU Memory |
+|        ID   ID                                                   Usage      |
+|=============================================================================|
+|    0   N/A  N/A      1503      G   /usr/lib/xorg/Xorg                  9MiB |
+|    0   N/A  N/A     20541      C   python train.py                  9219MiB |
++-----------------------------------------------------------------------------+
+"""
+
+REPORT_418 = """Tue Jun  1 10:00:00 2021
++-----------------------------------------------------------------------------+
+| NVIDIA-SMI 418.87.01    Driver Version: 418.87.01    CUDA Version: 10.1     |
+|-------------------------------+----------------------+----------------------+
+| GPU  Name        Persistence-M| Bus-Id        Disp.A | Volatile Uncorr. ECC |
+| Fan  Temp  Perf  Pwr:Usage/Cap|         Memory-Usage | GPU-Util  Compute M. |
+|===============================+======================+======================|
+|   0  Tesla K80           On   | 00000000:00:04.0 Off |                    0 |
+| N/A   45C    P0    N/A /  N/A |   1024MiB / 11441MiB |    N/A       Default |
++-------------------------------+----------------------+----------------------+
+
++-----------------------------------------------------------------------------+
+| Processes:                                                       GPU Memory |
+|  GPU       PID   Type   Process name                             Usage      |
+|=============================================================================|
+|    0      4242      C   python                                      1013MiB |
++-----------------------------------------------------------------------------+
+"""
+
+REPORT_535 = """Fri Oct  6 12:00:00 2023
++---------------------------------------------------------------------------------------+
+| NVIDIA-SMI 535.104.05             Driver Version: 535.104.05   CUDA Version: 12.2     |
+|-----------------------------------------+----------------------+----------------------+
+| GPU  Name                 Persistence-M | Bus-Id        Disp.A | Volatile Uncorr. ECC |
+| Fan  Temp   Perf          Pwr:Usage/Cap |         Memory-Usage | GPU-Util  Compute M. |
+|                                         |                      |               MIG M. |
+|=========================================+======================+======================|
+|   0  NVIDIA GeForce RTX 3090        Off | 00000000:01:00.0  On |                  N/A |
+|  0%   48C    P8              33W / 350W |    512MiB / 24576MiB |      3%      Default |
+|                                         |                      |                  N/A |
++-----------------------------------------+----------------------+----------------------+
+
++---------------------------------------------------------------------------------------+
+| Processes:                                                                            |
+|  GPU   GI   CI        PID   Type   Process name                            GPU Memory |
+|        ID   ID                                                             Usage      |
+|=======================================================================================|
+|  No running processes found                                                           |
++---------------------------------------------------------------------------------------+
+"""
+
+
+class TestNvidiaSmi(unittest.TestCase):
+    def test_gpus(self):
+        report = nvidia_smi.parse(REPORT_450)
+        self.assertEqual((report.driver_version, report.cuda_version), ('450.102.04', '11.0'))
+        self.assertEqual(len(report.gpus), 2)
+        gpu = report.gpus[0]
+        self.assertEqual((gpu.index, gpu.name, gpu.bus_id), (0, 'GeForce RTX 208...', '00000000:01:00.0'))
+        self.assertEqual((gpu.fan_percent, gpu.temperature_c, gpu.perf_state), (30, 38, 'P8'))
+        self.assertEqual((gpu.power_draw_w, gpu.power_limit_w), (20.0, 250.0))
+        self.assertEqual((gpu.memory_used_mib, gpu.memory_total_mib, gpu.utilization_percent), (9231, 11019, 87))
+        self.assertEqual(report.gpus[1].index, 1)
+
+    def test_processes(self):
+        processes = nvidia_smi.parse(REPORT_450).processes
+        self.assertEqual([(p.gpu_index, p.pid, p.type, p.name, p.memory_mib) for p in processes], [
+            (0, 1503, 'G', '/usr/lib/xorg/Xorg', 9),
+            (0, 20541, 'C', 'python train.py', 9219),
+        ])
+
+    def test_old_format_and_na(self):
+        report = nvidia_smi.parse(REPORT_418)
+        gpu = report.gpus[0]
+        self.assertEqual(gpu.name, 'Tesla K80')
+        self.assertIsNone(gpu.fan_percent)
+        self.assertIsNone(gpu.power_draw_w)
+        self.assertIsNone(gpu.utilization_percent)
+        self.assertEqual([(p.pid, p.name, p.memory_mib) for p in report.processes], [(4242, 'python', 1013)])
+
+    def test_new_format_without_processes(self):
+        report = nvidia_smi.parse(REPORT_535)
+        self.assertEqual(report.gpus[0].name, 'NVIDIA GeForce RTX 3090')
+        self.assertEqual((report.gpus[0].memory_total_mib, report.gpus[0].power_draw_w), (24576, 33.0))
+        self.assertEqual(report.processes, [])
+
+    def test_not_a_report(self):
+        self.assertIsNone(nvidia_smi.parse(None))
+        self.assertIsNone(nvidia_smi.parse('GPU Information Here.'))
+        self.assertIsNone(nvidia_smi.parse(REPORT_450[:300]))  # truncated before any GPU
+
+    def test_cached_regardless_of_clock(self):
+        first = nvidia_smi.parse(REPORT_450)
+        second = nvidia_smi.parse(REPORT_450.replace('21:37:43', '21:38:43'))
+        self.assertIs(first, second)
+
+
+if __name__ == '__main__':
+    unittest.main()
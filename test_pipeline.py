@@ -1,6 +1,9 @@
+import datetime as dt
 import unittest
 
-from pipeline import Function, FunctionNotFoundError, FunctionParamUnmatchError, Message, Pipeline, PlainText
+from db import Device
+from mhpl_functions import EvalContext
+from pipeline import Function, FunctionNotFoundError, FunctionParamUnmatchError, Message, ParseError, Pipeline, PlainText
 
 
 class TestPipeline(unittest.TestCase):
@@ -87,6 +90,56 @@ class TestPipeline(unittest.TestCase):
             ])
         )
 
+    def test_parse_nested_multi_params(self):
+        self.assertEqual(
+            Pipeline.parse('#plus(#plus(1, 2), 3)'),
+            Message([
+                Function(name='plus', messages=[
+                    Message([
+                        Function(name='plus', messages=[
+                            Message([PlainText(name='1')]),
+                            Message([PlainText(name='2')])
+                        ])
+                    ]),
+                    Message([PlainText(name='3')])
+                ])
+            ])
+        )
+
+    def test_parse_parentheses_in_param(self):
+        self.assertEqual(
+            Pipeline.parse('(#report(GPU(480), x))'),
+            Message([
+                PlainText(name='('),
+                Function(name='report', messages=[
+                    Message([PlainText(name='GPU(480)')]),
+                    Message([PlainText(name='x')])
+                ]),
+                PlainText(name=')')
+            ])
+        )
+
+    def test_parse_escaped_param(self):
+        self.assertEqual(
+            Pipeline.parse('#report(\\#GPU\\\\)'),  # means '#report(\#GPU\\)'
+            Message([
+                Function(name='report', messages=[
+                    Message([PlainText(name='#GPU\\')])  # means '#GPU\'
+                ])
+            ])
+        )
+
+    def test_parse_deeply_nested(self):
+        depth = 400  # about 4096 chars; deeper than the recursion limit allows
+        program = Pipeline.compile('#plus(' * depth + '0' + ', 1)' * depth)
+        self.assertEqual(program.run(), str(depth))
+
+    def test_parse_unclosed_error(self):
+        self.assertRaises(ParseError, Pipeline.parse, '#plus(#plus(1, 2)')
+
+    def test_parse_no_parenthesis_error(self):
+        self.assertRaises(ParseError, Pipeline.parse, '#plus(#alives, 2)')
+
     """
     Tests for transforming into str.
     
@@ -274,6 +327,74 @@ class TestPipeline(unittest.TestCase):
             'Alive Device Ratio: 0.75'
         )
 
+    """
+    Compiling tests
+
+    """
+    def test_compile_static(self):
+        program = Pipeline.compile('\\#Hello!')
+        self.assertTrue(program.is_static)
+        self.assertEqual(program.run(), '#Hello!')
+
+    def test_compile_function(self):
+        program = Pipeline.compile('#plus(1, 2) apples')
+        self.assertFalse(program.is_static)
+        self.assertEqual(program.run(), '3 apples')
+
+    def test_compile_cached(self):
+        self.assertIs(Pipeline.compile('#plus(3, 4)'), Pipeline.compile('#plus(3, 4)'))
+
+    def test_precompile(self):
+        Pipeline.precompile('#minus(3, 4)')
+        self.assertEqual(Pipeline.feed('#minus(3, 4)'), '-1')
+
+    def test_compile_parse_error(self):
+        program = Pipeline.compile('#plus')
+        self.assertRaises(ParseError, program.run)
+
+
+    """
+    Evaluation context tests
+
+    """
+    @staticmethod
+    def fleet() -> list[Device]:
+        now = dt.datetime.now(tz=dt.timezone(offset=dt.timedelta(hours=9)))
+        return [
+            Device(device_name='A', last_heartbeat_timestamp=now, report='ok', return_message='', is_active=True),
+            Device(device_name='B', last_heartbeat_timestamp=now - dt.timedelta(days=2),
+                   report='', return_message='', is_active=True),
+            Device(device_name='C', last_heartbeat_timestamp=None, report='', return_message='', is_active=False),
+        ]
+
+    def test_context_device_functions(self):
+        self.assertEqual(
+            Pipeline.feed('#alives()/#deads()/#devices()/#available_devices() #report(A)', EvalContext(self.fleet())),
+            '1/2/3/2 ok'
+        )
+
+    def test_context_unknown_report(self):
+        self.assertEqual(Pipeline.feed('[#report(Z)]', EvalContext(self.fleet())), '[]')
+
+    def test_context_uses_context(self):
+        self.assertTrue(Pipeline.compile('#plus(#alives(), 1)').uses_context)
+        self.assertFalse(Pipeline.compile('#plus(1, 1)').uses_context)
+
+    def test_context_availability_functions(self):
+        availability = {'A': {
+            'last_seen_seconds': 42,
+            'uptime': {'24h': 0.9583, '7d': 1.0},
+            'longest_outage': {'24h': {'seconds': 3600}, '7d': None},
+        }}
+        ctx = EvalContext(self.fleet(), availability=availability)
+        self.assertEqual(
+            Pipeline.feed('#uptime(A)% #uptime(A,7d)% #longest_outage(A) #longest_outage(A,7d) #last_seen(A)', ctx),
+            '95.8% 100.0% 3600 0 42'
+        )
+        self.assertEqual(Pipeline.feed('[#uptime(Z)][#uptime(A,1y)]', ctx), '[][]')
+        self.assertTrue(Pipeline.compile('#uptime(A)').uses_availability)
+        self.assertFalse(Pipeline.compile('#alives()').uses_availability)
+
 
 if __name__ == '__main__':
     unittest.main()
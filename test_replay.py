@@ -0,0 +1,52 @@
+import json
+import os
+import tempfile
+import unittest
+
+import replay
+
+
+class TestReplay(unittest.TestCase):
+    def test_read_capture(self):
+        lines = [
+            json.dumps({'path': '/json/signals'}),
+            '',
+            'not json',
+            json.dumps({'request_id': 'user-001'}),
+            json.dumps({'method': 'post', 'path': '/api/heartbeat?x=1', 'form': {'name': 'A'}}),
+        ]
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as file:
+            file.write('\n'.join(lines) + '\n')
+        try:
+            skipped = [0]
+            requests = list(replay.read_capture(file.name, skipped))
+        finally:
+            os.remove(file.name)
+        self.assertEqual([replay.endpoint_of(request) for request in requests],
+                         ['GET /json/signals', 'POST /api/heartbeat'])
+        self.assertEqual(skipped, [2])
+
+    def test_method_of(self):
+        self.assertEqual(replay.method_of({'path': '/', 'json': {}}), 'POST')
+        self.assertEqual(replay.method_of({'path': '/', 'method': 'put'}), 'PUT')
+
+    def test_percentile(self):
+        values = [float(i) for i in range(1, 101)]
+        self.assertEqual(replay.percentile(values, 50), 50.0)
+        self.assertEqual(replay.percentile(values, 99), 99.0)
+        self.assertEqual(replay.percentile([7.0], 90), 7.0)
+
+    def test_endpoint_stats(self):
+        stats = replay.EndpointStats()
+        for status, seconds in ((200, 0.001), (200, 0.003), (400, 0.002), ('ConnectError', 0.004)):
+            stats.add(status, seconds)
+        summary = stats.summary(elapsed=2.0)
+        self.assertEqual(summary['requests'], 4)
+        self.assertEqual(summary['errors'], 2)
+        self.assertEqual(summary['rps'], 2.0)
+        self.assertAlmostEqual(summary['p50_ms'], 2.0)
+        self.assertAlmostEqual(summary['max_ms'], 4.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import asyncio
+import datetime
+import unittest
+
+import report_history
+from report_history import ReportHistory
+from test_nvidia_smi import REPORT_450
+
+
+T0 = datetime.datetime(2022, 1, 1, 9, 0)
+
+
+def at(minutes):
+    return T0 + datetime.timedelta(minutes=minutes)
+
+
+class TestCodec(unittest.TestCase):
+    def test_keyframe(self):
+        self.assertEqual(report_history.decode(report_history.encode_keyframe(REPORT_450)), REPORT_450)
+
+    def test_delta(self):
+        keyframe = report_history.encode_keyframe(REPORT_450)
+        changed = REPORT_450.replace('21:37:43', '21:38:43').replace('87%', '12%') + 'extra line'
+        delta = report_history.encode_delta(REPORT_450.splitlines(keepends=True), changed)
+        self.assertEqual(report_history.decode(delta, keyframe), changed)
+        self.assertLess(len(delta) * 2, len(keyframe))
+
+    def test_delta_of_empty(self):
+        keyframe = report_history.encode_keyframe('')
+        self.assertEqual(report_history.decode(report_history.encode_delta([], 'a\nb'), keyframe), 'a\nb')
+
+
+class TestReportHistory(unittest.TestCase):
+    def setUp(self):
+        self.rows = []
+
+        async def insert(device_id, recorded_at, keyframe_id, payload):
+            self.rows.append((device_id, recorded_at, keyframe_id, payload))
+            return len(self.rows)
+
+        self.history = ReportHistory(insert, keyframe_interval=3, min_interval=60)
+
+    def record(self, report, minutes, device_id=1):
+        return asyncio.run(self.history.record(device_id, report, at(minutes)))
+
+    def rebuild(self, i):
+        _, _, keyframe_id, payload = self.rows[i]
+        return report_history.decode(payload, self.rows[keyframe_id - 1][3] if keyframe_id else None)
+
+    def test_keyframes_and_deltas(self):
+        reports = [REPORT_450.replace('21:37:43', '21:%02d:00' % minute) for minute in range(5)]
+        for minute, report in enumerate(reports):
+            self.assertTrue(self.record(report, minute))
+        self.assertEqual([row[2] for row in self.rows], [None, 1, 1, None, 4])
+        self.assertEqual([self.rebuild(i) for i in range(5)], reports)
+
+    def test_unchanged_and_throttled(self):
+        self.assertTrue(self.record('a', 0))
+        self.assertFalse(self.record('a', 5))
+        self.assertFalse(self.record('b', 0.5))
+        self.assertTrue(self.record('b', 1))
+        self.assertFalse(self.record(None, 2))
+        stats = self.history.stats()
+        self.assertEqual((stats['unchanged'], stats['throttled'], len(self.rows)), (1, 1, 2))
+
+    def test_rewritten_report_is_a_keyframe(self):
+        self.record(REPORT_450, 0)
+        self.record(''.join('line %d\n' % i for i in range(400)), 1)
+        self.assertEqual([row[2] for row in self.rows], [None, None])
+
+    def test_concurrent_reports_of_a_device(self):
+        async def insert(device_id, recorded_at, keyframe_id, payload):
+            await asyncio.sleep(0)  # the other heartbeat runs meanwhile
+            self.rows.append((device_id, recorded_at, keyframe_id, payload))
+            return len(self.rows)
+
+        reports = [REPORT_450, REPORT_450.replace('21:37:43', '21:38:43')]
+
+        async def run():
+            history = ReportHistory(insert, keyframe_interval=3, min_interval=60)
+            return await asyncio.gather(history.record(1, reports[0], at(0)), history.record(1, reports[1], at(1)))
+
+        self.assertEqual(asyncio.run(run()), [True, True])
+        self.assertEqual([row[2] for row in self.rows], [None, 1])  # one keyframe, then a delta against it
+        self.assertEqual([self.rebuild(i) for i in range(2)], reports)
+
+
+if __name__ == '__main__':
+    unittest.main()
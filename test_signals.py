@@ -0,0 +1,48 @@
+import datetime
+import unittest
+
+from db import Device
+from signals import device_to_json, is_stale_cursor, signals_body
+
+
+def device(name: str, report: str = 'GPU 0: 10 %') -> Device:
+    return Device(device_name=name, last_heartbeat_timestamp=datetime.datetime(2022, 1, 1, 9, 0),
+                  report=report, return_message='', is_active=True)
+
+
+class TestSignals(unittest.TestCase):
+    def test_device_to_json(self):
+        self.assertEqual(device_to_json(device('A')), {
+            'device_name': 'A',
+            'last_heartbeat_timestamp': '2022-01-01 09:00:00',
+            'report': 'GPU 0: 10 %',
+            'return_message': '',
+            'is_active': True,
+        })
+        self.assertNotIn('report', device_to_json(device('A'), summary=True))
+        never = Device(device_name='B', last_heartbeat_timestamp=None, report='', return_message='', is_active=True)
+        self.assertIsNone(device_to_json(never)['last_heartbeat_timestamp'])
+
+    def test_stale_cursor(self):
+        self.assertFalse(is_stale_cursor(100, 100))  # nothing ran in between
+        self.assertFalse(is_stale_cursor(90, 100))
+        self.assertFalse(is_stale_cursor(0, 100))  # an old sequence value: every device is changed since
+        self.assertTrue(is_stale_cursor(5000, 100))  # an old sequence value above the transaction IDs
+
+    def test_full_body(self):
+        log = [['2022-01-01T09:00:00', 2]]
+        body = signals_body(100, [device('A'), device('B')], log)
+        self.assertEqual(body['version'], 100)
+        self.assertFalse(body['delta'])
+        self.assertEqual([d['device_name'] for d in body['devices']], ['A', 'B'])
+        self.assertEqual(body['heartbeat_log'], log)
+
+    def test_delta_summary_body(self):
+        body = signals_body(101, [device('B')], [], summary=True, delta=True)
+        self.assertTrue(body['delta'])
+        self.assertEqual(body['devices'], [device_to_json(device('B'), summary=True)])
+        self.assertEqual(signals_body(101, [], [], delta=True)['devices'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
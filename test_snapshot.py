@@ -0,0 +1,57 @@
+import asyncio
+import email.utils
+import unittest
+
+from snapshot import JSONSnapshot
+
+
+class TestJSONSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.content = {'devices': ['GPU480']}
+        self.calls = 0
+
+        async def build():
+            self.calls += 1
+            return self.content
+
+        self.snapshot = JSONSnapshot(build, max_age=60)
+
+    def get(self, **headers):
+        return asyncio.run(self.snapshot.response(**headers))
+
+    def test_built_once(self):
+        first = self.get()
+        second = self.get()
+        self.assertEqual(first.body, b'{"devices":["GPU480"]}')
+        self.assertEqual(first.headers['etag'], second.headers['etag'])
+        self.assertEqual(first.headers['cache-control'], 'no-cache')
+        self.assertEqual(self.calls, 1)
+
+    def test_not_modified(self):
+        etag = self.get().headers['etag']
+        response = self.get(if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.body, b'')
+        self.assertEqual(self.get(if_none_match='"other"').status_code, 200)
+
+    def test_not_modified_since(self):
+        last_modified = self.get().headers['last-modified']
+        self.assertEqual(self.get(if_modified_since=last_modified).status_code, 304)
+        past = email.utils.formatdate(0, usegmt=True)
+        self.assertEqual(self.get(if_modified_since=past).status_code, 200)
+        self.assertEqual(self.get(if_modified_since='garbage').status_code, 200)
+
+    def test_invalidate(self):
+        etag = self.get().headers['etag']
+        self.snapshot.invalidate()
+        self.assertEqual(self.get(if_none_match=etag).status_code, 304)  # rebuilt, same content
+        self.content = {'devices': ['GPU480', 'SMC101']}
+        self.snapshot.invalidate()
+        response = self.get(if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['etag'], etag)
+        self.assertEqual(self.calls, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from fastapi import HTTPException
+
+with mock.patch('db.read_JWT_secret', return_value='secret'):
+    import user_authorization as user_auth
+from ttl_cache import TTLCache
+
+
+GET = SimpleNamespace(method='GET')
+POST = SimpleNamespace(method='POST')
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestUserCache(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patchers = [
+            mock.patch('ttl_cache.time.monotonic', self.clock),
+            mock.patch.object(user_auth, 'user_cache', TTLCache(8, 60.0)),
+            mock.patch('db.read_password_from_users', side_effect=self.read_password),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.passwords = {'ryhoh': 'hashed'}
+        self.reads = 0
+
+    def read_password(self, username: str) -> str:
+        self.reads += 1
+        if username not in self.passwords:
+            raise ValueError("User not exist:", username)
+        return self.passwords[username]
+
+    def test_cache_hit(self):
+        first = user_auth.get_cached_user('ryhoh')
+        self.assertEqual(first.hashed_password, 'hashed')
+        self.assertIs(user_auth.get_cached_user('ryhoh'), first)
+        self.assertEqual(self.reads, 1)
+        self.assertEqual(user_auth.user_cache.stats()['hits'], 1)
+
+    def test_unknown_user_is_not_cached(self):
+        self.assertIsNone(user_auth.get_cached_user('nobody'))
+        self.assertIsNone(user_auth.get_cached_user('nobody'))
+        self.assertEqual(self.reads, 2)
+        self.assertEqual(len(user_auth.user_cache), 0)
+
+    def test_invalidate(self):
+        user_auth.get_cached_user('ryhoh')
+        self.passwords['ryhoh'] = 'changed'
+        user_auth.invalidate_user('ryhoh')
+        self.assertEqual(user_auth.get_cached_user('ryhoh').hashed_password, 'changed')
+        self.assertEqual(self.reads, 2)
+
+    def test_expiry(self):
+        user_auth.get_cached_user('ryhoh')
+        self.clock.now += 59
+        user_auth.get_cached_user('ryhoh')
+        self.assertEqual(self.reads, 1)
+        self.clock.now += 2
+        user_auth.get_cached_user('ryhoh')
+        self.assertEqual(self.reads, 2)
+
+    def test_current_user_from_cache(self):
+        token = user_auth.create_access_token({'sub': 'ryhoh'})
+        with mock.patch.object(user_auth, 'TRUST_JWT_SUBJECT', False):
+            self.assertEqual(user_auth.get_current_user(POST, token).username, 'ryhoh')
+            self.assertEqual(user_auth.get_current_user(GET, token).username, 'ryhoh')
+            self.assertEqual(self.reads, 1)
+
+            del self.passwords['ryhoh']
+            user_auth.invalidate_user('ryhoh')
+            with self.assertRaises(HTTPException):
+                user_auth.get_current_user(GET, token)
+
+    def test_trust_jwt_subject(self):
+        token = user_auth.create_access_token({'sub': 'nobody'})
+        with mock.patch.object(user_auth, 'TRUST_JWT_SUBJECT', True):
+            user = user_auth.get_current_user(GET, token)
+            self.assertEqual(user, user_auth.User(username='nobody'))
+            self.assertEqual(self.reads, 0)
+            with self.assertRaises(HTTPException):  # a deleted user cannot write
+                user_auth.get_current_user(POST, token)
+            self.assertEqual(self.reads, 1)
+
+    def test_invalid_token(self):
+        with mock.patch.object(user_auth, 'TRUST_JWT_SUBJECT', True):
+            with self.assertRaises(HTTPException):
+                user_auth.get_current_user(GET, 'not a token')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,15 @@
 from datetime import datetime, timedelta
+import os
 from typing import Optional, Union
 
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from pydantic import BaseModel
 
 import db
+from ttl_cache import TTLCache
 
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/token")
@@ -17,6 +19,14 @@ ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 12 * 60 * 60
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+USER_CACHE_TTL_SECONDS = float(os.environ.get('USER_CACHE_TTL_SECONDS') or 60)
+USER_CACHE_MAX_SIZE = int(os.environ.get('USER_CACHE_MAX_SIZE') or 256)
+# Accept the (signed) "sub" claim of a valid JWT without looking the user up, on read-only requests.
+TRUST_JWT_SUBJECT = (os.environ.get('TRUST_JWT_SUBJECT') or '').lower() in ('1', 'true', 'yes')
+READ_ONLY_METHODS = ('GET', 'HEAD')
+
+user_cache = TTLCache(USER_CACHE_MAX_SIZE, USER_CACHE_TTL_SECONDS)
+
 
 class Token(BaseModel):
     access_token: str
@@ -47,6 +57,23 @@ def get_user(username: str) -> Optional[UserInDB]:
         'username': username, 'hashed_password': hashed_password})
 
 
+def get_cached_user(username: str) -> Optional[UserInDB]:
+    """
+    Same as get_user(), answered from the user cache while it is fresh.
+    Unknown users are not cached.
+    """
+    user: Optional[UserInDB] = user_cache.get(username)
+    if user is None:
+        user = get_user(username)
+        if user is not None:
+            user_cache.put(username, user)
+    return user
+
+
+def invalidate_user(username: str) -> None:
+    user_cache.pop(username)
+
+
 def authenticate_user(username: str, password: str) -> Union[UserInDB, bool]:
     user: Optional[UserInDB] = get_user(username)
     if not user:
@@ -67,22 +94,35 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
-def get_current_user(token: str = Depends(oauth2_scheme)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+credentials_exception = HTTPException(
+    status_code=status.HTTP_401_UNAUTHORIZED,
+    detail="Could not validate credentials",
+    headers={"WWW-Authenticate": "Bearer"},
+)
+
+
+def decode_token(token: str) -> TokenData:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
-        token_data = TokenData(username=username)
+        return TokenData(username=username)
     except JWTError:
         raise credentials_exception
 
-    user = get_user(username=token_data.username)
+
+def get_current_user(request: Request, token: str = Depends(oauth2_scheme)):
+    """
+    With TRUST_JWT_SUBJECT, read-only requests are resolved from the JWT alone:
+    a user deleted after the token was issued is still accepted there.
+    Other requests always check that the user exists.
+    """
+    token_data = decode_token(token)
+    if TRUST_JWT_SUBJECT and request.method in READ_ONLY_METHODS:
+        return User(username=token_data.username)
+
+    user = get_cached_user(username=token_data.username)
     if user is None:
         raise credentials_exception
     return user